@@ -0,0 +1,199 @@
+from rollups import rollup_match
+
+# Months counted from year 0, so calendar neighbours differ by one and
+# window ranges skip months without expenses correctly
+MONTH_INDEX = {"$add": [{"$multiply": ["$year", 12]}, "$month", -1]}
+
+
+def relative_change(current: str, previous: str):
+    # null when there is nothing to compare with
+    previous_or_zero = {"$ifNull": [previous, 0]}
+    return {
+        "$cond": [
+            {"$eq": [previous_or_zero, 0]},
+            None,
+            {"$divide": [{"$subtract": [current, previous]}, previous]},
+        ]
+    }
+
+
+def monthly_stages():
+    return [
+        {
+            "$group": {
+                "_id": {"year": "$year", "month": "$month"},
+                "total": {"$sum": "$total_amount"},
+            }
+        },
+        {"$set": {"year": "$_id.year", "month": "$_id.month"}},
+        {"$set": {"index": MONTH_INDEX}},
+        {
+            "$setWindowFields": {
+                "sortBy": {"index": 1},
+                "output": {
+                    # The sum over a month without expenses is 0
+                    "previous_month_total": {
+                        "$sum": "$total",
+                        "window": {"range": [-1, -1]},
+                    },
+                    "previous_year_total": {
+                        "$sum": "$total",
+                        "window": {"range": [-12, -12]},
+                    },
+                },
+            }
+        },
+        {
+            "$project": {
+                "_id": 0,
+                "year": 1,
+                "month": 1,
+                "total": 1,
+                "previous_month_total": 1,
+                "month_over_month": relative_change(
+                    "$total", "$previous_month_total"
+                ),
+                "previous_year_total": 1,
+                "year_over_year": relative_change("$total", "$previous_year_total"),
+            }
+        },
+        {"$sort": {"year": 1, "month": 1}},
+    ]
+
+
+def category_stages():
+    return [
+        {
+            "$group": {
+                "_id": {"category": "$category", "year": "$year", "month": "$month"},
+                "total": {"$sum": "$total_amount"},
+            }
+        },
+        {
+            "$set": {
+                "category": "$_id.category",
+                "year": "$_id.year",
+                "month": "$_id.month",
+            }
+        },
+        {"$set": {"index": MONTH_INDEX}},
+        {
+            "$setWindowFields": {
+                "partitionBy": "$category",
+                "sortBy": {"index": 1},
+                "output": {
+                    "last_3_months": {"$sum": "$total", "window": {"range": [-2, 0]}}
+                },
+            }
+        },
+        {
+            "$project": {
+                "_id": 0,
+                "category": 1,
+                "year": 1,
+                "month": 1,
+                "total": 1,
+                "moving_average_3m": {"$divide": ["$last_3_months", 3]},
+            }
+        },
+        {"$sort": {"category": 1, "year": 1, "month": 1}},
+    ]
+
+
+def top_category_stages(top: int):
+    return [
+        {
+            "$group": {
+                "_id": "$category",
+                "total": {"$sum": "$total_amount"},
+                "count": {"$sum": "$count"},
+            }
+        },
+        {"$sort": {"total": -1, "_id": 1}},
+        {"$limit": top},
+        {"$project": {"_id": 0, "category": "$_id", "total": 1, "count": 1}},
+    ]
+
+
+def analytics_pipeline(collection_name: str, top: int):
+    """
+    Build the pipeline over the rollup collection behind /expenses/analytics.
+
+    One $facet computes, from the monthly category totals:
+    - monthly: the total of every month with its change from the previous
+      month and from the same month a year before,
+    - categories: every category total per month with its 3-month moving
+      average, months without expenses counting as 0,
+    - top_categories: the top categories over all time.
+
+    $setWindowFields needs MongoDB 5.0 or later.
+    """
+    return [
+        {"$match": rollup_match(collection_name)},
+        {
+            "$facet": {
+                "monthly": monthly_stages(),
+                "categories": category_stages(),
+                "top_categories": top_category_stages(top),
+            }
+        },
+    ]
+
+
+def analytics_from_totals(totals, top: int):
+    """
+    Compute what analytics_pipeline returns from the totals per year, month
+    and category (with their total_amount and count), for storages that
+    group expenses directly.
+    """
+    months, categories, overall = {}, {}, {}
+    for row in totals:
+        index = row["year"] * 12 + row["month"] - 1
+        months[index] = months.get(index, 0) + row["total_amount"]
+        category = categories.setdefault(row["category"], {})
+        category[index] = category.get(index, 0) + row["total_amount"]
+        total, count = overall.get(row["category"], (0, 0))
+        overall[row["category"]] = (total + row["total_amount"], count + row["count"])
+
+    def change(current, previous):
+        return None if not previous else (current - previous) / previous
+
+    monthly = []
+    for index, total in sorted(months.items()):
+        previous_month = months.get(index - 1, 0)
+        previous_year = months.get(index - 12, 0)
+        monthly.append(
+            {
+                "year": index // 12,
+                "month": index % 12 + 1,
+                "total": total,
+                "previous_month_total": previous_month,
+                "month_over_month": change(total, previous_month),
+                "previous_year_total": previous_year,
+                "year_over_year": change(total, previous_year),
+            }
+        )
+    category_months = [
+        {
+            "category": name,
+            "year": index // 12,
+            "month": index % 12 + 1,
+            "total": total,
+            # Months without expenses count as 0
+            "moving_average_3m": sum(
+                category.get(index - offset, 0) for offset in range(3)
+            )
+            / 3,
+        }
+        for name, category in sorted(categories.items())
+        for index, total in sorted(category.items())
+    ]
+    ranked = sorted(overall.items(), key=lambda item: (-item[1][0], item[0]))
+    return {
+        "monthly": monthly,
+        "categories": category_months,
+        "top_categories": [
+            {"category": name, "total": total, "count": count}
+            for name, (total, count) in ranked[:top]
+        ],
+    }
@@ -0,0 +1,377 @@
+"""
+Move closed years of expenses out of the collections the API scans.
+
+Years older than the last ARCHIVE_KEEP_YEARS are moved into
+ARCHIVE_COLLECTION, a time-series collection on date that keeps them in
+compressed buckets. ARCHIVED_YEARS_COLLECTION has one document per
+archived year of a user, with its totals per month and per category, and
+tells the list routes to read the archive too when a query reaches back
+that far. The monthly rollup is left as is, so summaries do not change.
+
+Archived expenses are read-only. Run the job from cron, it can be run
+again after a failure:
+
+    python archive.py [--year YEAR] [collection_name ...]
+
+Needs MongoDB 7.0 or later, for deletes in time-series collections.
+"""
+import argparse
+import asyncio
+import heapq
+import os
+from datetime import datetime, timezone
+
+from pymongo import ASCENDING, DeleteOne, IndexModel
+from pymongo.errors import CollectionInvalid
+
+from changes import TOMBSTONE_COLLECTION
+from tenancy import TENANT_FIELD, expense_collection, expense_collection_names
+from versions import bump_version
+
+# Leading underscores: user collection names cannot clash with them
+ARCHIVE_COLLECTION = "_expense_archive"
+ARCHIVED_YEARS_COLLECTION = "_expense_archived_years"
+# The current year and the ones before it that stay in the hot collections
+ARCHIVE_KEEP_YEARS = int(os.environ.get("ARCHIVE_KEEP_YEARS", "2"))
+ARCHIVE_BATCH_SIZE = 5000
+
+# The user an archived expense belongs to is its series
+ARCHIVE_OPTIONS = {"timeField": "date", "metaField": "meta", "granularity": "hours"}
+ARCHIVE_USER_FIELD = "meta.collection"
+ARCHIVE_PROJECTION = {"meta": 0}
+
+ARCHIVE_INDEXES = [
+    IndexModel(
+        [(ARCHIVE_USER_FIELD, ASCENDING), ("date", ASCENDING), ("_id", ASCENDING)],
+        name="collection_date_id",
+    ),
+    IndexModel(
+        [(ARCHIVE_USER_FIELD, ASCENDING), ("_id", ASCENDING)],
+        name="collection_id",
+    ),
+    IndexModel(
+        [
+            (ARCHIVE_USER_FIELD, ASCENDING),
+            ("updated_at", ASCENDING),
+            ("_id", ASCENDING),
+        ],
+        name="collection_updated_at_id",
+    ),
+]
+
+# The totals of a year, without the dates that JSON caches cannot hold
+ARCHIVED_YEAR_PROJECTION = {
+    "_id": 0,
+    "collection": 0,
+    "archived_at": 0,
+    "updated_at": 0,
+}
+
+ARCHIVED_YEARS_INDEXES = [
+    IndexModel(
+        [("collection", ASCENDING), ("year", ASCENDING)],
+        name="collection_year",
+        unique=True,
+    ),
+]
+
+
+# Helper functions
+def year_range(year: int):
+    return {"$gte": datetime(year, 1, 1), "$lt": datetime(year + 1, 1, 1)}
+
+
+def naive_utc(value: datetime):
+    # Stored dates are naive UTC, as the driver returns them
+    if value.tzinfo is not None:
+        value = value.astimezone(timezone.utc).replace(tzinfo=None)
+    return value
+
+
+def spans_archive(query_filter: dict, years):
+    """
+    Whether a list filter can match expenses of the archived years.
+    """
+    if "year" in query_filter:
+        return query_filter["year"] in years
+    dates = query_filter.get("date")
+    if not dates:
+        return bool(years)
+    start, end = dates.get("$gte"), dates.get("$lt")
+    return any(
+        (start is None or datetime(year + 1, 1, 1) > naive_utc(start))
+        and (end is None or datetime(year, 1, 1) < naive_utc(end))
+        for year in years
+    )
+
+
+def archive_filter(query_filter: dict):
+    # A year becomes a date range, which selects the buckets to read
+    if isinstance(query_filter.get("year"), int) and "date" not in query_filter:
+        return {**query_filter, "date": year_range(query_filter["year"])}
+    return query_filter
+
+
+def archived_document(collection_name: str, expense):
+    document = {
+        field: value for field, value in expense.items() if field != TENANT_FIELD
+    }
+    document["meta"] = {"collection": collection_name}
+    return document
+
+
+class ArchivedExpenses:
+    """
+    The archived expenses of one user, for reading.
+
+    Filters are scoped to the user and documents come back without the
+    meta field, shaped like the ones of the hot collection.
+    """
+
+    def __init__(self, db, collection_name: str):
+        self.collection = db[ARCHIVE_COLLECTION]
+        self.collection_name = collection_name
+
+    def scope(self, query_filter=None):
+        return {**(query_filter or {}), ARCHIVE_USER_FIELD: self.collection_name}
+
+    def find(self, query_filter=None):
+        return self.collection.find(self.scope(query_filter), ARCHIVE_PROJECTION)
+
+    async def find_one(self, query_filter=None):
+        return await self.collection.find_one(
+            self.scope(query_filter), ARCHIVE_PROJECTION
+        )
+
+
+class MergedCursor:
+    """
+    Read cursors sorted in ascending order on the same fields as one cursor
+    in that order.
+    """
+
+    def __init__(self, cursors, sort_fields):
+        self.cursors = cursors
+        self.sort_fields = sort_fields
+        self.remaining = None
+
+    def limit(self, limit: int):
+        self.cursors = [cursor.limit(limit) for cursor in self.cursors]
+        self.remaining = limit
+        return self
+
+    def batch_size(self, batch_size: int):
+        self.cursors = [cursor.batch_size(batch_size) for cursor in self.cursors]
+        return self
+
+    def sort_key(self, document):
+        return tuple(document.get(field) for field, _ in self.sort_fields)
+
+    def __aiter__(self):
+        return self.merge()
+
+    async def merge(self):
+        iterators = [cursor.__aiter__() for cursor in self.cursors]
+        # The index breaks ties, documents are never compared
+        heads = []
+        for index, iterator in enumerate(iterators):
+            document = await anext(iterator, None)
+            if document is not None:
+                heads.append((self.sort_key(document), index, document))
+        heapq.heapify(heads)
+        returned = 0
+        while heads and (self.remaining is None or returned < self.remaining):
+            _, index, document = heapq.heappop(heads)
+            yield document
+            returned += 1
+            document = await anext(iterators[index], None)
+            if document is not None:
+                heapq.heappush(heads, (self.sort_key(document), index, document))
+
+    async def to_list(self, length=None):
+        documents = []
+        async for document in self:
+            documents.append(document)
+            if length is not None and len(documents) == length:
+                break
+        return documents
+
+
+async def archived_years(db, collection_name: str):
+    return sorted(
+        await db[ARCHIVED_YEARS_COLLECTION].distinct(
+            "year", {"collection": collection_name}
+        )
+    )
+
+
+async def ensure_archive(db):
+    if not await db.list_collection_names(filter={"name": ARCHIVE_COLLECTION}):
+        try:
+            await db.create_collection(ARCHIVE_COLLECTION, timeseries=ARCHIVE_OPTIONS)
+        except CollectionInvalid:
+            # Created by a concurrent run
+            pass
+    await db[ARCHIVE_COLLECTION].create_indexes(ARCHIVE_INDEXES)
+    await db[ARCHIVED_YEARS_COLLECTION].create_indexes(ARCHIVED_YEARS_INDEXES)
+
+
+async def move_batch(db, collection, collection_name: str, batch):
+    """
+    Copy a batch of expenses to the archive, then delete them.
+
+    Copies left by an interrupted run are not made twice. An expense edited
+    or deleted after it was read keeps its hot document and loses its copy,
+    the next batch reads it again.
+
+    Returns:
+        int: The number of expenses moved.
+    """
+    archive = db[ARCHIVE_COLLECTION]
+    ids = [expense["_id"] for expense in batch]
+    scope = {ARCHIVE_USER_FIELD: collection_name}
+    copied = set(await archive.distinct("_id", {**scope, "_id": {"$in": ids}}))
+    documents = [
+        archived_document(collection_name, expense)
+        for expense in batch
+        if expense["_id"] not in copied
+    ]
+    if documents:
+        await archive.insert_many(documents, ordered=False)
+
+    operations = [
+        DeleteOne({"_id": expense["_id"], "updated_at": expense.get("updated_at")})
+        for expense in batch
+    ]
+    result = await collection.bulk_write(operations, ordered=False)
+    if result.deleted_count < len(batch):
+        cursor = collection.find({"_id": {"$in": ids}}, {"_id": 1})
+        stale = {expense["_id"] for expense in await cursor.to_list(length=None)}
+        stale.update(
+            await db[TOMBSTONE_COLLECTION].distinct("_id", {"_id": {"$in": ids}})
+        )
+        await archive.delete_many({**scope, "_id": {"$in": list(stale)}})
+    return result.deleted_count
+
+
+async def summarize_year(db, collection_name: str, year: int):
+    """
+    The totals per month and per category of an archived year.
+    """
+    pipeline = [
+        {"$match": {ARCHIVE_USER_FIELD: collection_name, "date": year_range(year)}},
+        {
+            "$group": {
+                "_id": {"month": "$month", "category": "$category"},
+                "total_amount": {"$sum": "$amount"},
+                "count": {"$sum": 1},
+            }
+        },
+    ]
+    cursor = db[ARCHIVE_COLLECTION].aggregate(pipeline)
+    months, categories = {}, {}
+    for group in await cursor.to_list(length=None):
+        for totals, key in (
+            (months, group["_id"]["month"]),
+            (categories, group["_id"]["category"]),
+        ):
+            total, count = totals.get(key, (0, 0))
+            totals[key] = (total + group["total_amount"], count + group["count"])
+    return {
+        "total_amount": sum(total for total, _ in months.values()),
+        "count": sum(count for _, count in months.values()),
+        "months": [
+            {"month": month, "total_amount": total, "count": count}
+            for month, (total, count) in sorted(months.items())
+        ],
+        "categories": [
+            {"category": category, "total_amount": total, "count": count}
+            for category, (total, count) in sorted(categories.items())
+        ],
+    }
+
+
+async def archive_year(db, collection_name: str, year: int):
+    """
+    Move the expenses a user has in a year to the archive.
+
+    The year is registered first, so reads look in the archive while its
+    expenses move, and its totals are stored once they are all there.
+
+    Returns:
+        int: The number of expenses moved.
+    """
+    years = db[ARCHIVED_YEARS_COLLECTION]
+    await years.update_one(
+        {"collection": collection_name, "year": year},
+        {"$setOnInsert": {"archived_at": datetime.now()}},
+        upsert=True,
+    )
+    await bump_version(db, collection_name)
+
+    collection = expense_collection(db, collection_name)
+    query_filter = {"date": year_range(year)}
+    moved = 0
+    while True:
+        cursor = (
+            collection.find(query_filter)
+            .sort([("date", ASCENDING), ("_id", ASCENDING)])
+            .limit(ARCHIVE_BATCH_SIZE)
+        )
+        batch = await cursor.to_list(length=None)
+        if not batch:
+            break
+        moved += await move_batch(db, collection, collection_name, batch)
+
+    totals = await summarize_year(db, collection_name, year)
+    await years.update_one(
+        {"collection": collection_name, "year": year},
+        {"$set": {**totals, "updated_at": datetime.now()}},
+    )
+    # Cached results were computed with the expenses in their old place
+    await bump_version(db, collection_name)
+    return moved
+
+
+async def archive_collection(db, collection_name: str, last_year: int):
+    """
+    Archive every year up to last_year that has expenses in the hot
+    collection.
+
+    Returns:
+        dict: year -> the number of expenses moved.
+    """
+    cursor = expense_collection(db, collection_name).aggregate(
+        [
+            {"$match": {"date": {"$lt": datetime(last_year + 1, 1, 1)}}},
+            {"$group": {"_id": {"$year": "$date"}}},
+            {"$sort": {"_id": 1}},
+        ]
+    )
+    years = [group["_id"] for group in await cursor.to_list(length=None)]
+    return {year: await archive_year(db, collection_name, year) for year in years}
+
+
+if __name__ == "__main__":
+    from database import DATABASE_NAME, create_client
+
+    parser = argparse.ArgumentParser(prog="python archive.py")
+    parser.add_argument("collection_names", nargs="*")
+    parser.add_argument(
+        "--year",
+        type=int,
+        default=datetime.now().year - ARCHIVE_KEEP_YEARS,
+        help="the last year to archive",
+    )
+    args = parser.parse_args()
+    db = create_client()[DATABASE_NAME]
+
+    async def archive(names, last_year):
+        await ensure_archive(db)
+        if not names:
+            names = await expense_collection_names(db)
+        for name in names:
+            for year, moved in (await archive_collection(db, name, last_year)).items():
+                print(f"Archived {moved} expenses of {year} from {name}")
+
+    asyncio.run(archive(args.collection_names, args.year))
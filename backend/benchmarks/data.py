@@ -0,0 +1,41 @@
+"""
+Synthetic expenses shared by the benchmarks.
+"""
+import random
+from datetime import datetime, timedelta
+
+from bson import ObjectId
+
+CATEGORIES = ["Bill", "Shopping", "Food & Drink"]
+FIRST_DATE = datetime(2020, 1, 1)
+# Expenses are spread over this many days from FIRST_DATE, about 50 months
+DAYS = 1500
+
+
+def iter_expenses(count: int, seed: int = 0):
+    """
+    Yield stored expense documents, the same ones for the same seed.
+    """
+    rng = random.Random(seed)
+    for i in range(count):
+        date = FIRST_DATE + timedelta(days=i % DAYS)
+        yield {
+            "_id": ObjectId(),
+            "amount": round(rng.uniform(1, 500000), 2),
+            "date": date,
+            "month": date.month,
+            "year": date.year,
+            "category": rng.choice(CATEGORIES),
+            "description": f"Receipt {i}" if i % 3 else None,
+            "created_date": datetime(2024, 1, 1, 12, 0, 0, (i % 1000) * 1000),
+        }
+
+
+def make_expenses(count: int, seed: int = 0):
+    return list(iter_expenses(count, seed))
+
+
+def months(count: int):
+    # (month, year) pairs that hold expenses once count have been seeded
+    dates = [FIRST_DATE + timedelta(days=day) for day in range(min(count, DAYS))]
+    return sorted({(date.month, date.year) for date in dates})
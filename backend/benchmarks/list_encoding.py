@@ -0,0 +1,60 @@
+"""
+Compare the default and the fast encoding of list responses.
+
+Run from the backend directory:
+
+    python -m benchmarks.list_encoding [rows ...]
+"""
+import asyncio
+import sys
+import time
+
+from fastapi.responses import JSONResponse
+from fastapi.routing import serialize_response
+from fastapi.utils import create_model_field
+
+from benchmarks.data import make_expenses
+from main import ExpenseInDB, parse_expense
+from serialization import dumps_expenses
+
+async def default_body(field, expenses):
+    # What a route with response_model=list[ExpenseInDB] does today
+    content = await serialize_response(
+        field=field,
+        response_content=[parse_expense(expense) for expense in expenses],
+        is_coroutine=True,
+    )
+    return JSONResponse(content).body
+
+
+def best_of(repeats: int, run):
+    timings = []
+    for _ in range(repeats):
+        started = time.perf_counter()
+        result = run()
+        timings.append(time.perf_counter() - started)
+    return min(timings), result
+
+
+def main(sizes):
+    field = create_model_field(name="Response", type_=list[ExpenseInDB])
+    loop = asyncio.new_event_loop()
+    print(f"{'rows':>8} {'default ms':>12} {'fast ms':>10} {'speedup':>8}")
+    for size in sizes:
+        expenses = make_expenses(size)
+        repeats = 5 if size <= 10000 else 2
+        default_time, default = best_of(
+            repeats, lambda: loop.run_until_complete(default_body(field, expenses))
+        )
+        fast_time, fast = best_of(repeats, lambda: dumps_expenses(expenses))
+        if fast != default:
+            raise SystemExit(f"Fast output differs from the default at {size} rows")
+        print(
+            f"{size:>8} {default_time * 1000:>12.1f} {fast_time * 1000:>10.1f}"
+            f" {default_time / fast_time:>7.1f}x"
+        )
+    loop.close()
+
+
+if __name__ == "__main__":
+    main([int(arg) for arg in sys.argv[1:]] or [10000, 100000])
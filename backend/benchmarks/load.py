@@ -0,0 +1,362 @@
+"""
+Load test the expense routes and compare runs.
+
+Requests go straight into the ASGI app, so the numbers cover the routes and
+the database but not uvicorn or the network. Needs the packages of
+requirements-test.txt (httpx, and mongomock-motor for --in-memory):
+
+    pip install -r requirements-test.txt
+
+Run from the backend directory against a local mongod:
+
+    python -m benchmarks.load run --mongo-uri mongodb://localhost:27017 \\
+        --rows 10000 100000 1000000 --concurrency 16 --output after.json
+
+or against the in-memory stand-in (needs mongomock-motor, and is only
+practical up to about 100k rows):
+
+    python -m benchmarks.load run --in-memory --rows 10000
+
+or against the embedded SQLite storage, in a file created if missing:
+
+    python -m benchmarks.load run --sqlite bench.db --rows 10000 100000
+
+Two reports are compared route by route, exiting with status 1 when the
+throughput or the p95 latency of any route got worse than the threshold:
+
+    python -m benchmarks.load compare before.json after.json --threshold 0.1
+"""
+import argparse
+import asyncio
+import json
+import math
+import platform
+import random
+import sys
+import time
+from datetime import datetime, timedelta, timezone
+
+import httpx
+
+import main
+from benchmarks.data import CATEGORIES, DAYS, FIRST_DATE, iter_expenses, months
+from database import create_client
+from indexes import EXPENSE_INDEXES
+from sqlite_storage import SQLiteStorage
+from storage import MongoStorage
+
+SEED_BATCH_SIZE = 10000
+# Seeded ids the get and update requests pick from
+MAX_SAMPLED_IDS = 10000
+
+
+class Bench:
+    """
+    What the requests of one seeded collection draw from.
+    """
+
+    def __init__(self, collection_name: str, rows: int, seed: int, fast: bool):
+        self.collection_name = collection_name
+        self.rng = random.Random(seed)
+        self.ids = []
+        self.created = []
+        self.months = months(rows)
+        self.fast = fast
+
+    def params(self, **params):
+        return {"collection_name": self.collection_name, **params}
+
+    def expense(self):
+        date = FIRST_DATE + timedelta(days=self.rng.randrange(DAYS))
+        return {
+            "amount": round(self.rng.uniform(1, 500000), 2),
+            "date": date.isoformat(),
+            "category": self.rng.choice(CATEGORIES),
+            "description": "Benchmark",
+        }
+
+    def month(self):
+        month, year = self.rng.choice(self.months)
+        return {"month": month, "year": year}
+
+
+async def create(http, bench):
+    body = bench.expense()
+    response = await http.post("/expenses/", params=bench.params(), json=body)
+    if response.status_code == 200:
+        bench.created.append(response.json()["id"])
+    return response
+
+
+async def get(http, bench):
+    expense_id = bench.rng.choice(bench.ids)
+    return await http.get(f"/expenses/{expense_id}", params=bench.params())
+
+
+async def list_page(http, bench):
+    month = bench.month()
+    start = datetime(month["year"], month["month"], 1)
+    params = bench.params(start=start.isoformat(), limit=100, fast=bench.fast)
+    return await http.get("/expenses/", params=params)
+
+
+async def ls_month_year(http, bench):
+    params = bench.params(fast=bench.fast, **bench.month())
+    return await http.get("/expenses/ls_month_year/", params=params)
+
+
+async def summary(http, bench):
+    return await http.get("/expenses/summary/", params=bench.params(**bench.month()))
+
+
+async def month_year(http, bench):
+    return await http.get("/month/year", params=bench.params())
+
+
+async def update(http, bench):
+    expense_id = bench.rng.choice(bench.ids)
+    return await http.put(
+        f"/expenses/{expense_id}", params=bench.params(), json=bench.expense()
+    )
+
+
+async def delete(http, bench):
+    # Only removes what the create requests added, the seeded rows stay
+    expense_id = bench.created.pop()
+    return await http.delete(f"/expenses/{expense_id}", params=bench.params())
+
+
+# Run in this order: delete needs the ids create made
+ROUTES = {
+    "create": create,
+    "get": get,
+    "list": list_page,
+    "ls_month_year": ls_month_year,
+    "summary": summary,
+    "month_year": month_year,
+    "update": update,
+    "delete": delete,
+}
+
+
+def percentile(latencies, fraction: float):
+    # Nearest rank on sorted latencies
+    index = max(0, math.ceil(fraction * len(latencies)) - 1)
+    return latencies[min(index, len(latencies) - 1)]
+
+
+def route_stats(latencies, errors: int, seconds: float):
+    latencies = sorted(latencies)
+    stats = {
+        "requests": len(latencies),
+        "errors": errors,
+        "seconds": round(seconds, 3),
+        "throughput": round(len(latencies) / seconds, 1) if seconds else 0.0,
+    }
+    if latencies:
+        stats["mean_ms"] = round(sum(latencies) / len(latencies) * 1000, 3)
+        for name, fraction in (("p50", 0.5), ("p95", 0.95), ("p99", 0.99)):
+            stats[f"{name}_ms"] = round(percentile(latencies, fraction) * 1000, 3)
+    return stats
+
+
+async def drive(http, bench, route, requests: int, concurrency: int):
+    """
+    Send requests to one route from concurrency workers.
+    """
+    latencies = []
+    errors = 0
+    pending = iter(range(requests))
+
+    async def worker():
+        nonlocal errors
+        # Workers share the iterator, so requests are split between them
+        for _ in pending:
+            started = time.perf_counter()
+            response = await route(http, bench)
+            latencies.append(time.perf_counter() - started)
+            if response.status_code >= 400:
+                errors += 1
+
+    started = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    return route_stats(latencies, errors, time.perf_counter() - started)
+
+
+async def seed(storage, collection_name: str, rows: int, seed: int, reseed: bool):
+    """
+    Fill a collection with synthetic expenses and build its rollup.
+
+    A collection that already holds the same number of rows is reused,
+    unless reseed is set.
+
+    Returns:
+        list[str]: Up to MAX_SAMPLED_IDS ids of seeded expenses.
+    """
+    collection = await storage.expenses(collection_name)
+    if reseed or await collection.estimated_document_count() != rows:
+        await collection.drop()
+        await collection.create_indexes(EXPENSE_INDEXES)
+        batch = []
+        for expense in iter_expenses(rows, seed):
+            batch.append(expense)
+            if len(batch) == SEED_BATCH_SIZE:
+                await collection.insert_many(batch, ordered=False)
+                batch = []
+        if batch:
+            await collection.insert_many(batch, ordered=False)
+        await storage.rebuild_rollups(collection_name)
+
+    ids = await storage.sample_ids(collection_name, min(rows, MAX_SAMPLED_IDS))
+    return [str(expense_id) for expense_id in ids]
+
+
+def connect(args):
+    if args.sqlite:
+        return SQLiteStorage(args.sqlite)
+    if not args.in_memory:
+        return MongoStorage(create_client(args.mongo_uri), args.database)
+    try:
+        from mongomock_motor import AsyncMongoMockClient
+    except ImportError:
+        raise SystemExit("--in-memory needs mongomock-motor installed")
+    return MongoStorage(AsyncMongoMockClient(), args.database)
+
+
+def database_label(args):
+    if args.sqlite:
+        return "sqlite"
+    return "in-memory" if args.in_memory else "mongod"
+
+
+async def run(args):
+    # The routes read the module level storage on every request, the app
+    # lifespan does not run under the ASGI transport
+    main.storage = connect(args)
+    await main.storage.open()
+    report = {
+        "meta": {
+            "started": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+            "database": database_label(args),
+            "concurrency": args.concurrency,
+            "requests": args.requests,
+            "seed": args.seed,
+            "fast": args.fast,
+            "python": platform.python_version(),
+        },
+        "runs": [],
+    }
+    transport = httpx.ASGITransport(app=main.app)
+    async with httpx.AsyncClient(
+        transport=transport, base_url="http://bench", timeout=None
+    ) as http:
+        for rows in args.rows:
+            collection_name = f"bench_{rows}"
+            started = time.perf_counter()
+            bench = Bench(collection_name, rows, args.seed, args.fast)
+            bench.ids = await seed(
+                main.storage, collection_name, rows, args.seed, args.reseed
+            )
+            seed_seconds = time.perf_counter() - started
+            print(f"{rows} rows seeded in {seed_seconds:.1f}s", file=sys.stderr)
+
+            routes = {}
+            for name, route in ROUTES.items():
+                if name not in args.routes:
+                    continue
+                requests = args.requests
+                if name == "delete":
+                    requests = min(requests, len(bench.created))
+                routes[name] = await drive(
+                    http, bench, route, requests, args.concurrency
+                )
+                print(
+                    f"  {name:<14} {routes[name]['throughput']:>9.1f} req/s"
+                    f"  p95 {routes[name].get('p95_ms', 0):>9.2f} ms",
+                    file=sys.stderr,
+                )
+            report["runs"].append(
+                {"rows": rows, "seed_seconds": round(seed_seconds, 3), "routes": routes}
+            )
+    await main.storage.close()
+    return report
+
+
+def change(before: float, after: float):
+    return (after - before) / before if before else 0.0
+
+
+def compare(before, after, threshold: float):
+    """
+    Compare the routes two reports have in common.
+
+    Returns:
+        list[str]: One line per slower route, empty when nothing regressed.
+    """
+    regressions = []
+    previous = {run["rows"]: run["routes"] for run in before["runs"]}
+    print(
+        f"{'rows':>8} {'route':<14} {'req/s':>9} {'change':>8}"
+        f" {'p50 ms':>9} {'p95 ms':>9} {'change':>8} {'p99 ms':>9}"
+    )
+    for run in after["runs"]:
+        for name, stats in run["routes"].items():
+            old = previous.get(run["rows"], {}).get(name)
+            if not old or "p95_ms" not in old or "p95_ms" not in stats:
+                continue
+            throughput = change(old["throughput"], stats["throughput"])
+            p95 = change(old["p95_ms"], stats["p95_ms"])
+            print(
+                f"{run['rows']:>8} {name:<14} {stats['throughput']:>9.1f}"
+                f" {throughput:>+8.1%} {stats['p50_ms']:>9.2f}"
+                f" {stats['p95_ms']:>9.2f} {p95:>+8.1%} {stats['p99_ms']:>9.2f}"
+            )
+            if throughput < -threshold or p95 > threshold:
+                regressions.append(
+                    f"{name} at {run['rows']} rows: throughput {throughput:+.1%},"
+                    f" p95 {p95:+.1%}"
+                )
+    return regressions
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(prog="python -m benchmarks.load")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    run_parser = commands.add_parser("run", help="seed, load and report as JSON")
+    database = run_parser.add_mutually_exclusive_group()
+    database.add_argument("--mongo-uri", default="mongodb://localhost:27017")
+    database.add_argument("--in-memory", action="store_true")
+    database.add_argument("--sqlite", metavar="PATH", help="SQLite file to use")
+    run_parser.add_argument("--database", default="expense_tracker_bench")
+    run_parser.add_argument("--rows", type=int, nargs="+", default=[10000])
+    run_parser.add_argument("--requests", type=int, default=500)
+    run_parser.add_argument("--concurrency", type=int, default=8)
+    run_parser.add_argument("--routes", nargs="+", choices=ROUTES, default=ROUTES)
+    run_parser.add_argument("--seed", type=int, default=0)
+    run_parser.add_argument("--fast", action="store_true", help="fast list encoding")
+    run_parser.add_argument("--reseed", action="store_true")
+    run_parser.add_argument("--output", help="write the report here, not stdout")
+
+    compare_parser = commands.add_parser("compare", help="compare two reports")
+    compare_parser.add_argument("before")
+    compare_parser.add_argument("after")
+    compare_parser.add_argument("--threshold", type=float, default=0.1)
+    return parser.parse_args(argv)
+
+
+if __name__ == "__main__":
+    args = parse_args(sys.argv[1:])
+    if args.command == "run":
+        report = json.dumps(asyncio.run(run(args)), indent=2)
+        if args.output:
+            with open(args.output, "w") as output:
+                output.write(report + "\n")
+        else:
+            print(report)
+    else:
+        with open(args.before) as before, open(args.after) as after:
+            regressions = compare(json.load(before), json.load(after), args.threshold)
+        for regression in regressions:
+            print(f"Regression: {regression}", file=sys.stderr)
+        sys.exit(1 if regressions else 0)
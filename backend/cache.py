@@ -0,0 +1,150 @@
+import json
+import math
+import os
+
+from cachetools import TTLCache
+
+from singleflight import CollectionLimiter, SingleFlight
+
+# Cache settings, CACHE_URL points at a shared Redis when several workers run
+CACHE_URL = os.environ.get("CACHE_URL")
+CACHE_MAXSIZE = int(os.environ.get("CACHE_MAXSIZE", "1024"))
+CACHE_TTL_SECONDS = float(os.environ.get("CACHE_TTL_SECONDS", "300"))
+# Aggregations computed at once per collection, in each worker
+AGGREGATION_CONCURRENCY = int(os.environ.get("AGGREGATION_CONCURRENCY", "4"))
+
+
+class LocalBackend:
+    """
+    In-process storage: least recently used entries are evicted once
+    maxsize is reached and every entry expires after ttl seconds.
+    """
+
+    name = "local"
+
+    def __init__(self, maxsize: int, ttl: float):
+        self.entries = TTLCache(maxsize=maxsize, ttl=ttl)
+        self.generations = {}
+
+    async def generation(self, collection_name: str):
+        return self.generations.get(collection_name, 0)
+
+    async def bump(self, collection_name: str):
+        generation = self.generations.get(collection_name, 0)
+        self.generations[collection_name] = generation + 1
+
+    async def get(self, key: str):
+        return self.entries.get(key)
+
+    async def set(self, key: str, value):
+        self.entries[key] = value
+
+    async def size(self):
+        return len(self.entries)
+
+
+class RedisBackend:
+    """
+    Shared storage so that every uvicorn worker sees the same entries and
+    invalidations. Eviction is left to the server's maxmemory-policy.
+    """
+
+    name = "redis"
+    prefix = "expense-cache:"
+
+    def __init__(self, url: str, ttl: float, client=None):
+        if client is None:
+            try:
+                import redis.asyncio as redis
+            except ImportError:
+                raise RuntimeError("CACHE_URL is set but redis is not installed")
+            client = redis.from_url(url)
+        self.client = client
+        self.ttl = ttl
+
+    async def generation(self, collection_name: str):
+        value = await self.client.get(f"{self.prefix}gen:{collection_name}")
+        return int(value or 0)
+
+    async def bump(self, collection_name: str):
+        await self.client.incr(f"{self.prefix}gen:{collection_name}")
+
+    async def get(self, key: str):
+        value = await self.client.get(self.prefix + key)
+        return None if value is None else json.loads(value)
+
+    async def set(self, key: str, value):
+        # In milliseconds: ex= would round sub-second TTLs down to 0
+        px = math.ceil(self.ttl * 1000)
+        await self.client.set(self.prefix + key, json.dumps(value), px=px)
+
+    async def size(self):
+        return None
+
+
+class ResultCache:
+    """
+    Cache of aggregation results keyed by collection and query params.
+
+    Every key embeds a per-collection generation. invalidate() bumps it, so
+    all results computed before a write stop being served at once, while
+    a query that races with the write stores its result under the old
+    generation where nobody will read it.
+
+    Identical misses arriving together share one computation, and at most
+    concurrency computations run per collection.
+    """
+
+    def __init__(self, backend, concurrency: int = AGGREGATION_CONCURRENCY):
+        self.backend = backend
+        self.flights = SingleFlight()
+        self.limiter = CollectionLimiter(concurrency)
+        self.hits = 0
+        self.misses = 0
+
+    async def get_or_compute(self, collection_name: str, params: dict, compute):
+        """
+        Return the cached result for the query or compute and store it.
+
+        Args:
+            collection_name (str): The collection the query reads.
+            params (dict): The route and query parameters of the query.
+            compute: Coroutine function producing a JSON-serializable result.
+        """
+        generation = await self.backend.generation(collection_name)
+        key = json.dumps([collection_name, generation, params], sort_keys=True)
+        result = await self.backend.get(key)
+        if result is not None:
+            self.hits += 1
+            return result
+        self.misses += 1
+        return await self.flights.do(
+            key, lambda: self.compute_and_store(collection_name, key, compute)
+        )
+
+    async def compute_and_store(self, collection_name: str, key: str, compute):
+        async with self.limiter.hold(collection_name):
+            result = await compute()
+        await self.backend.set(key, result)
+        return result
+
+    async def invalidate(self, collection_name: str):
+        await self.backend.bump(collection_name)
+
+    async def stats(self):
+        return {
+            "backend": self.backend.name,
+            "hits": self.hits,
+            "misses": self.misses,
+            # Misses served by a computation already in flight
+            "coalesced": self.flights.shared,
+            # Computations that waited for their collection's limit
+            "throttled": self.limiter.waited,
+            "size": await self.backend.size(),
+        }
+
+
+def create_cache():
+    if CACHE_URL:
+        return ResultCache(RedisBackend(CACHE_URL, CACHE_TTL_SECONDS))
+    return ResultCache(LocalBackend(CACHE_MAXSIZE, CACHE_TTL_SECONDS))
@@ -0,0 +1,129 @@
+import os
+from datetime import timedelta
+
+from bson import ObjectId
+from pymongo import ASCENDING, IndexModel, UpdateOne
+
+from pagination import decode_cursor, encode_cursor, keyset_filter
+from tenancy import expense_collection, expense_collection_names
+
+# One document per deleted expense, its _id is the id of the expense
+TOMBSTONE_COLLECTION = "_expense_tombstones"
+# Deletions are kept this long, clients whose token is older start over
+TOMBSTONE_RETENTION_DAYS = int(os.environ.get("TOMBSTONE_RETENTION_DAYS", "30"))
+# A write stamped just before a poll can commit after it, so a caught-up
+# token reads this many milliseconds again; clients merge by id
+CHANGES_OVERLAP_MS = int(os.environ.get("CHANGES_OVERLAP_MS", "5000"))
+
+CHANGE_SORT = [("updated_at", ASCENDING), ("_id", ASCENDING)]
+# Sorts before every generated id
+FIRST_ID = ObjectId("0" * 24)
+
+TOMBSTONE_INDEXES = [
+    IndexModel(
+        [("collection", ASCENDING), ("updated_at", ASCENDING), ("_id", ASCENDING)],
+        name="collection_updated_at_id",
+    ),
+    IndexModel(
+        [("updated_at", ASCENDING)],
+        name="updated_at_ttl",
+        expireAfterSeconds=TOMBSTONE_RETENTION_DAYS * 24 * 3600,
+    ),
+]
+
+
+async def record_tombstones(db, collection_name: str, removed, deleted_at):
+    if not removed:
+        return
+    operations = [
+        UpdateOne(
+            {"_id": expense["_id"]},
+            {"$set": {"collection": collection_name, "updated_at": deleted_at}},
+            upsert=True,
+        )
+        for expense in removed
+    ]
+    await db[TOMBSTONE_COLLECTION].bulk_write(operations, ordered=False)
+
+
+async def list_changes(
+    db, collection, collection_name: str, since, limit, now, archived=None
+):
+    """
+    Read the expenses written and deleted after a change token.
+
+    Expenses, archived expenses when given, and tombstones are merged in
+    (updated_at, _id) order; moving an expense to the archive keeps its
+    updated_at, so it is not sent again. Without a token, or with one
+    older than the tombstone retention, every expense is returned and
+    reset tells the client to drop its copy first.
+
+    Returns:
+        tuple: Changed expense documents, deleted ids, the token to send
+        next, whether more changes are waiting and whether to reset.
+    """
+    keyset = None
+    if since is not None:
+        values = decode_cursor(since, CHANGE_SORT)
+        horizon = now - timedelta(days=TOMBSTONE_RETENTION_DAYS)
+        if values[0] is not None and values[0] > horizon:
+            keyset = keyset_filter(CHANGE_SORT, values)
+    reset = keyset is None
+
+    cursor = collection.find(keyset or {}).sort(CHANGE_SORT).limit(limit + 1)
+    page = [(expense, False) for expense in await cursor.to_list(length=None)]
+    if archived is not None:
+        cursor = archived.find(keyset or {}).sort(CHANGE_SORT).limit(limit + 1)
+        page += [(expense, False) for expense in await cursor.to_list(length=None)]
+    if keyset is not None:
+        # A full read has nothing to delete from
+        cursor = (
+            db[TOMBSTONE_COLLECTION]
+            .find({"collection": collection_name, **keyset})
+            .sort(CHANGE_SORT)
+            .limit(limit + 1)
+        )
+        tombstones = await cursor.to_list(length=None)
+        page += [(tombstone, True) for tombstone in tombstones]
+    page.sort(key=lambda item: (item[0].get("updated_at") or now, item[0]["_id"]))
+
+    has_more = len(page) > limit
+    page = page[:limit]
+    if has_more:
+        token = encode_cursor(page[-1][0], CHANGE_SORT)
+    elif page:
+        # Only writes stamped within the overlap can still commit behind the
+        # last one; older ones are not read again
+        last = page[-1][0].get("updated_at") or now
+        after = now - timedelta(milliseconds=CHANGES_OVERLAP_MS)
+        if last < after:
+            token = encode_cursor(page[-1][0], CHANGE_SORT)
+        else:
+            token = encode_cursor({"updated_at": after, "_id": FIRST_ID}, CHANGE_SORT)
+    elif not reset:
+        token = since
+    else:
+        after = now - timedelta(milliseconds=CHANGES_OVERLAP_MS)
+        token = encode_cursor({"updated_at": after, "_id": FIRST_ID}, CHANGE_SORT)
+
+    changed = [document for document, deleted in page if not deleted]
+    deleted = [str(document["_id"]) for document, deleted in page if deleted]
+    return changed, deleted, token, has_more, reset
+
+
+async def backfill_changes(db):
+    """
+    Create the tombstone indexes and stamp updated_at on expenses written
+    before it was tracked.
+
+    Returns:
+        list[str]: The names of the collections that were checked.
+    """
+    await db[TOMBSTONE_COLLECTION].create_indexes(TOMBSTONE_INDEXES)
+    names = await expense_collection_names(db)
+    for name in names:
+        await expense_collection(db, name).update_many(
+            {"updated_at": {"$exists": False}},
+            [{"$set": {"updated_at": "$created_date"}}],
+        )
+    return names
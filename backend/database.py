@@ -0,0 +1,45 @@
+import os
+
+from motor.motor_asyncio import AsyncIOMotorClient
+
+from metrics import event_listeners
+
+# MongoDB connection settings
+MONGO_URI = os.environ.get("MONGO_URI", "mongodb://mongodb_app:27017")
+DATABASE_NAME = os.environ.get("MONGO_DATABASE", "expense_tracker")
+
+# Environment variable -> MongoClient option and its type, unset variables
+# keep the driver default
+CLIENT_SETTINGS = {
+    "MONGO_MAX_POOL_SIZE": ("maxPoolSize", int),
+    "MONGO_MIN_POOL_SIZE": ("minPoolSize", int),
+    "MONGO_MAX_IDLE_TIME_MS": ("maxIdleTimeMS", int),
+    "MONGO_WAIT_QUEUE_TIMEOUT_MS": ("waitQueueTimeoutMS", int),
+    "MONGO_CONNECT_TIMEOUT_MS": ("connectTimeoutMS", int),
+    "MONGO_SOCKET_TIMEOUT_MS": ("socketTimeoutMS", int),
+    "MONGO_SERVER_SELECTION_TIMEOUT_MS": ("serverSelectionTimeoutMS", int),
+    # primary, primaryPreferred, secondary, secondaryPreferred or nearest
+    "MONGO_READ_PREFERENCE": ("readPreference", str),
+    # Comma separated, zlib needs no extra package, zstd and snappy do
+    "MONGO_COMPRESSORS": ("compressors", str),
+    "MONGO_APP_NAME": ("appname", str),
+}
+
+
+def client_options():
+    options = {}
+    for variable, (option, convert) in CLIENT_SETTINGS.items():
+        value = os.environ.get(variable)
+        if value:
+            options[option] = convert(value)
+    return options
+
+
+def create_client(uri: str = MONGO_URI):
+    """
+    Build a Motor client from the environment settings, with the metrics
+    listeners attached. It connects lazily, on the first command.
+    """
+    return AsyncIOMotorClient(
+        uri, event_listeners=event_listeners(), **client_options()
+    )
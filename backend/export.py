@@ -0,0 +1,168 @@
+import csv
+import io
+from tempfile import SpooledTemporaryFile
+
+import pyarrow as pa
+import pyarrow.parquet as pq
+import xlsxwriter
+from starlette.concurrency import run_in_threadpool
+
+EXPORT_COLUMNS = [
+    "id",
+    "date",
+    "amount",
+    "category",
+    "description",
+    "month",
+    "year",
+    "created_date",
+    "updated_at",
+]
+# Documents converted and written at a time
+EXPORT_BATCH_SIZE = 2000
+# Chunks an XLSX file is streamed in once written
+FILE_CHUNK_SIZE = 64 * 1024
+XLSX_MAX_ROWS = 1048576
+
+MEDIA_TYPES = {
+    "csv": "text/csv; charset=utf-8",
+    "xlsx": "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+    "parquet": "application/vnd.apache.parquet",
+}
+
+PARQUET_SCHEMA = pa.schema(
+    [
+        ("id", pa.string()),
+        ("date", pa.timestamp("ms")),
+        ("amount", pa.float64()),
+        ("category", pa.string()),
+        ("description", pa.string()),
+        ("month", pa.int32()),
+        ("year", pa.int32()),
+        ("created_date", pa.timestamp("ms")),
+        ("updated_at", pa.timestamp("ms")),
+    ]
+)
+
+
+def export_row(expense):
+    return [
+        str(expense["_id"]),
+        expense["date"],
+        expense["amount"],
+        expense["category"],
+        expense.get("description"),
+        expense["month"],
+        expense["year"],
+        expense["created_date"],
+        expense.get("updated_at"),
+    ]
+
+
+async def iter_batches(cursor):
+    batch = []
+    async for expense in cursor.batch_size(EXPORT_BATCH_SIZE):
+        batch.append(export_row(expense))
+        if len(batch) == EXPORT_BATCH_SIZE:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+async def stream_csv(cursor):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(EXPORT_COLUMNS)
+    async for batch in iter_batches(cursor):
+        for row in batch:
+            # Dates as ISO 8601, like the JSON routes
+            row[1], row[7] = row[1].isoformat(), row[7].isoformat()
+            if row[8] is not None:
+                row[8] = row[8].isoformat()
+        writer.writerows(batch)
+        yield buffer.getvalue().encode()
+        buffer.seek(0)
+        buffer.truncate()
+    if buffer.tell():
+        yield buffer.getvalue().encode()
+
+
+class ChunkSink(io.RawIOBase):
+    """
+    A write-only file that keeps what was written until it is drained.
+    """
+
+    def __init__(self):
+        self.chunks = []
+        self.position = 0
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        self.position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self.position
+
+    def drain(self):
+        data = b"".join(self.chunks)
+        self.chunks = []
+        return data
+
+
+async def stream_parquet(cursor):
+    # One row group per batch, each sent as soon as it is written
+    sink = ChunkSink()
+    writer = pq.ParquetWriter(sink, PARQUET_SCHEMA)
+    try:
+        async for batch in iter_batches(cursor):
+            columns = [list(column) for column in zip(*batch)]
+            table = pa.Table.from_arrays(columns, schema=PARQUET_SCHEMA)
+            await run_in_threadpool(writer.write_table, table)
+            yield sink.drain()
+    finally:
+        writer.close()
+    yield sink.drain()
+
+
+async def stream_xlsx(cursor):
+    """
+    Write the rows to a workbook in a temporary file, then stream it.
+
+    XLSX is a zip archive that can only be sent once complete, but rows are
+    flushed to disk as they come, so memory stays flat. Rows past the sheet
+    limit of XLSX_MAX_ROWS are left out.
+    """
+    workbook_file = SpooledTemporaryFile(max_size=8 * 1024 * 1024)
+    workbook = xlsxwriter.Workbook(
+        workbook_file,
+        {"constant_memory": True, "default_date_format": "yyyy-mm-dd hh:mm:ss"},
+    )
+    worksheet = workbook.add_worksheet("expenses")
+    worksheet.write_row(0, 0, EXPORT_COLUMNS)
+    row_number = 1
+
+    def write_batch(batch, first_row):
+        for offset, row in enumerate(batch):
+            worksheet.write_row(first_row + offset, 0, row)
+
+    try:
+        async for batch in iter_batches(cursor):
+            batch = batch[: XLSX_MAX_ROWS - row_number]
+            await run_in_threadpool(write_batch, batch, row_number)
+            row_number += len(batch)
+            if row_number >= XLSX_MAX_ROWS:
+                break
+        await run_in_threadpool(workbook.close)
+        workbook_file.seek(0)
+        while chunk := workbook_file.read(FILE_CHUNK_SIZE):
+            yield chunk
+    finally:
+        workbook_file.close()
+
+
+STREAMS = {"csv": stream_csv, "xlsx": stream_xlsx, "parquet": stream_parquet}
@@ -0,0 +1,228 @@
+import codecs
+import csv
+import re
+from datetime import datetime
+
+from pydantic import ValidationError
+from pymongo.errors import BulkWriteError
+
+# Only the first errors are kept so memory does not grow with the file
+MAX_REPORTED_ERRORS = 100
+
+OFX_TAG = re.compile(r"<(/?)([A-Za-z0-9_.]+)>([^<]*)")
+
+
+class UploadError(ValueError):
+    """
+    The upload cannot be read past a line; the rows before it stand.
+    """
+
+    def __init__(self, row: int, detail: str):
+        super().__init__(detail)
+        self.row = row
+
+
+# Parsers, each yields (row_number, fields) pairs
+def decode_lines(upload, encoding: str):
+    # Line by line, so an undecodable byte is reported with its line
+    decoder = codecs.getincrementaldecoder(encoding)()
+    for number, line in enumerate(upload, start=1):
+        try:
+            yield decoder.decode(line, final=True)
+        except UnicodeDecodeError as e:
+            raise UploadError(
+                number,
+                f"byte {line[e.start]:#04x} is not valid {encoding}, "
+                "set encoding to the one of the file (e.g. cp1252)",
+            )
+
+
+def iter_csv_rows(upload, encoding: str = "utf-8-sig"):
+    """
+    Read a CSV export one row at a time.
+
+    The header row names the columns; date, amount, category and
+    description are matched case-insensitively.
+
+    Raises:
+        UploadError: At the first line that cannot be decoded or parsed.
+    """
+    reader = csv.reader(decode_lines(upload, encoding))
+    try:
+        header = next(reader, None)
+        if header is None:
+            return
+        fieldnames = [name.strip().lower() for name in header]
+        for values in reader:
+            if not any(value.strip() for value in values):
+                continue
+            yield reader.line_num, dict(zip(fieldnames, values))
+    except csv.Error as e:
+        raise UploadError(reader.line_num, f"invalid CSV: {e}")
+
+
+def iter_ofx_rows(upload, chunk_size=64 * 1024):
+    """
+    Read the STMTTRN transactions of an OFX statement.
+
+    Works for both SGML (unclosed tags) and XML flavours of OFX. Credits
+    are yielded with None fields, for import_rows to skip.
+    """
+    decoder = codecs.getincrementaldecoder("latin-1")()
+    pending = ""
+    transaction = None
+    number = 0
+    while True:
+        chunk = upload.read(chunk_size)
+        pending += decoder.decode(chunk, final=not chunk)
+        # Keep a possibly incomplete trailing tag for the next chunk
+        cut = pending.rfind("<") if chunk else len(pending)
+        complete, pending = pending[:cut], pending[cut:]
+        for closing, tag, value in OFX_TAG.findall(complete):
+            tag = tag.upper()
+            if tag == "STMTTRN":
+                if closing and transaction is not None:
+                    number += 1
+                    yield number, ofx_fields(transaction)
+                transaction = None if closing else {}
+            elif transaction is not None and not closing:
+                transaction[tag] = value.strip()
+        if not chunk:
+            break
+
+
+def ofx_fields(transaction):
+    """
+    The fields of a debit, or None for a credit (money in), which is not an
+    expense.
+    """
+    description = " ".join(
+        part for part in (transaction.get("NAME"), transaction.get("MEMO")) if part
+    )
+    amount = transaction.get("TRNAMT", "").strip()
+    # Debits are negative in OFX, expenses are stored as positive amounts
+    if amount.startswith("-"):
+        amount = amount[1:]
+    elif amount:
+        return None
+    return {
+        "date": transaction.get("DTPOSTED", "")[:8],
+        "amount": amount,
+        "description": description or None,
+    }
+
+
+# Helper functions
+def parse_date(value: str, date_format=None):
+    value = value.strip()
+    if date_format:
+        return datetime.strptime(value, date_format)
+    if len(value) == 8 and value.isdigit():
+        return datetime.strptime(value, "%Y%m%d")
+    return datetime.fromisoformat(value)
+
+
+def format_errors(error: ValidationError):
+    return "; ".join(
+        f"{'.'.join(str(loc) for loc in item['loc'])}: {item['msg']}"
+        for item in error.errors()
+    )
+
+
+def to_expense(model, fields: dict, date_format=None, default_category=None):
+    """
+    Validate one parsed row against the expense model, which derives month
+    and year from the row's date.
+
+    Raises:
+        ValueError: If the row is not a valid expense.
+    """
+    raw_date = fields.get("date") or ""
+    try:
+        date = parse_date(raw_date, date_format)
+    except ValueError:
+        raise ValueError(f"date: invalid date {raw_date!r}")
+    try:
+        expense = model(
+            amount=(fields.get("amount") or "").strip(),
+            date=date,
+            category=(fields.get("category") or "").strip() or default_category,
+            description=(fields.get("description") or "").strip() or None,
+        )
+    except ValidationError as e:
+        raise ValueError(format_errors(e))
+    return expense.dict()
+
+
+async def import_rows(
+    collection,
+    rows,
+    model,
+    created_date,
+    batch_size,
+    date_format=None,
+    default_category=None,
+    after_insert=None,
+):
+    """
+    Insert parsed rows with bounded insert_many batches.
+
+    after_insert, if given, is awaited with the documents of every batch
+    that were written. Yields a progress dict after every batch and a final
+    summary that includes the first MAX_REPORTED_ERRORS row errors. Rows
+    whose fields are None are counted as skipped, not as errors. A row
+    that cannot be read at all (UploadError) is the last error reported,
+    the rows read before it are still written.
+    """
+    progress = {"processed": 0, "inserted": 0, "skipped": 0, "failed": 0}
+    errors = []
+
+    def record_error(row, detail):
+        progress["failed"] += 1
+        if len(errors) < MAX_REPORTED_ERRORS:
+            errors.append({"row": row, "detail": detail})
+
+    async def flush(batch, batch_rows):
+        failed = set()
+        try:
+            result = await collection.insert_many(batch, ordered=False)
+            progress["inserted"] += len(result.inserted_ids)
+        except BulkWriteError as e:
+            progress["inserted"] += e.details["nInserted"]
+            for error in e.details["writeErrors"]:
+                failed.add(error["index"])
+                record_error(batch_rows[error["index"]], error["errmsg"])
+        if after_insert is not None:
+            await after_insert(
+                [expense for i, expense in enumerate(batch) if i not in failed]
+            )
+
+    batch = []
+    batch_rows = []
+    try:
+        for row, fields in rows:
+            progress["processed"] += 1
+            if fields is None:
+                progress["skipped"] += 1
+                continue
+            try:
+                expense_data = to_expense(
+                    model, fields, date_format, default_category
+                )
+            except ValueError as e:
+                record_error(row, str(e))
+                continue
+            expense_data["created_date"] = expense_data["updated_at"] = created_date
+            batch.append(expense_data)
+            batch_rows.append(row)
+            if len(batch) >= batch_size:
+                await flush(batch, batch_rows)
+                batch = []
+                batch_rows = []
+                yield dict(progress)
+    except UploadError as e:
+        progress["processed"] += 1
+        record_error(e.row, f"{e}; the rest of the file was not read")
+    if batch:
+        await flush(batch, batch_rows)
+    yield {**progress, "done": True, "errors": errors}
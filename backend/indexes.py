@@ -0,0 +1,66 @@
+import asyncio
+
+from pymongo import ASCENDING, TEXT, IndexModel
+
+from tenancy import expense_collection, expense_collection_names
+
+# Indexes every per-user expense collection should have
+EXPENSE_INDEXES = [
+    IndexModel(
+        [("year", ASCENDING), ("month", ASCENDING), ("category", ASCENDING)],
+        name="year_month_category",
+    ),
+    # Serves date range scans and their (date, _id) keyset order
+    IndexModel([("date", ASCENDING), ("_id", ASCENDING)], name="date_id"),
+    IndexModel([("created_date", ASCENDING)], name="created_date"),
+    # Serves /expenses/changes in its (updated_at, _id) order
+    IndexModel([("updated_at", ASCENDING), ("_id", ASCENDING)], name="updated_at_id"),
+    # Serves /expenses/search, a match on the category counts double
+    IndexModel(
+        [("description", TEXT), ("category", TEXT)],
+        name="description_category_text",
+        weights={"description": 1, "category": 2},
+    ),
+]
+
+# Names of the collections whose indexes are already in place
+_provisioned = set()
+
+
+async def ensure_indexes(collection):
+    """
+    Create the expense indexes the first time a collection is seen.
+
+    Args:
+        collection: The Motor collection to provision.
+
+    Returns:
+        The same collection, so calls can be chained.
+    """
+    if collection.name not in _provisioned:
+        # create_indexes is a no-op for indexes that already exist
+        await collection.create_indexes(EXPENSE_INDEXES)
+        _provisioned.add(collection.name)
+    return collection
+
+
+async def backfill_indexes(db):
+    """
+    Provision the indexes on every existing collection of the database.
+
+    Returns:
+        list[str]: The names of the collections that were checked.
+    """
+    names = await expense_collection_names(db)
+    for name in names:
+        await ensure_indexes(expense_collection(db, name))
+    return names
+
+
+if __name__ == "__main__":
+    from database import DATABASE_NAME, create_client
+
+    db = create_client()[DATABASE_NAME]
+
+    for name in asyncio.run(backfill_indexes(db)):
+        print(f"Indexes ensured on {name}")
@@ -1,37 +1,138 @@
 from fastapi import FastAPI
 from fastapi import Query
 from fastapi import HTTPException
+from fastapi import Request
+from fastapi import Response
+from fastapi.responses import StreamingResponse
 from bson import ObjectId
 from bson.errors import InvalidId
-from motor.motor_asyncio import AsyncIOMotorClient
-from pydantic import BaseModel, Field
+from pymongo import DeleteOne, InsertOne, ReturnDocument, UpdateOne
+from pymongo.errors import BulkWriteError
+from pydantic import BaseModel, Field, model_validator
 from typing import Optional
 from datetime import datetime
+from tempfile import SpooledTemporaryFile
+from contextlib import asynccontextmanager
+import codecs
+import json
+import os
+from archive import (
+    ArchivedExpenses,
+    MergedCursor,
+    archive_filter,
+    naive_utc,
+    spans_archive,
+)
+from cache import create_cache
+from changes import TOMBSTONE_COLLECTION, list_changes, record_tombstones
+from export import MEDIA_TYPES, STREAMS
+from importer import import_rows, iter_csv_rows, iter_ofx_rows
+from metrics import record_request, render
+from serialization import ExpenseListResponse
+from storage import create_storage
+from pivot import ARROW_STREAM_MEDIA_TYPE, build_pivot, pivot_to_arrow
+from pagination import decode_cursor, encode_cursor, keyset_filter, stream_ndjson
+from versions import bump_version, etag_matches, get_version, make_etag
 
-app = FastAPI()
+# Set by the lifespan for as long as the app runs
+storage = None
+# serve.py backfills once before starting its workers and turns this off
+BACKFILL_ON_STARTUP = os.environ.get("BACKFILL_ON_STARTUP", "1") == "1"
 
-# MongoDB connection settings
-MONGO_URI = "mongodb://mongodb_app:27017"
-DATABASE_NAME = "expense_tracker"
-client = AsyncIOMotorClient(MONGO_URI)
-db = client[DATABASE_NAME]
 
-class Expense(BaseModel):
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """
+    Open the storage (see storage.py), check it answers and close it on
+    shutdown.
+    """
+    global storage
+    storage = create_storage()
+    # Fails the start if MongoDB does not answer within the selection timeout
+    await storage.open()
+    if BACKFILL_ON_STARTUP:
+        # Backfill indexes and rollups on the collections created before
+        # they were managed
+        await storage.backfill()
+    yield
+    await storage.close()
+
+
+app = FastAPI(lifespan=lifespan)
+app.middleware("http")(record_request)
+
+# Cache for the summary and month-list aggregations
+result_cache = create_cache()
+
+class ExpenseFields(BaseModel):
     amount: float = Field(..., gt=0)
     date: datetime
-    month: int
-    year: int
+    month: Optional[int] = None
+    year: Optional[int] = None
     category: str
     description: Optional[str] = None
 
     class Config:
         orm_mode = True
 
-class ExpenseInDB(Expense):
+class Expense(ExpenseFields):
+    # Input only: responses return month and year as stored, legacy
+    # documents are realigned by rollups.py
+    @model_validator(mode="after")
+    def derive_month_and_year(self):
+        # Dates are stored as naive UTC, and month and year follow the
+        # stored date (as rollups.py and archive.py compute them), whatever
+        # the client sent
+        date = naive_utc(self.date)
+        # BSON dates keep milliseconds, so responses match stored documents
+        self.date = date.replace(microsecond=date.microsecond // 1000 * 1000)
+        self.month = self.date.month
+        self.year = self.date.year
+        return self
+
+class ExpenseInDB(ExpenseFields):
     id: str
     created_date: datetime
+    updated_at: Optional[datetime] = None
+
+class ExpenseUpdate(BaseModel):
+    id: str
+    data: Expense
+
+class BulkExpenseRequest(BaseModel):
+    creates: list[Expense] = []
+    updates: list[ExpenseUpdate] = []
+    deletes: list[str] = []
+    ordered: bool = True
+
+class BulkItemResult(BaseModel):
+    op: str
+    index: int
+    status: str
+    id: Optional[str] = None
+    expense: Optional[ExpenseInDB] = None
+    detail: Optional[str] = None
+
+class BulkExpenseResponse(BaseModel):
+    inserted_count: int
+    modified_count: int
+    deleted_count: int
+    results: list[BulkItemResult]
+
+class ExpenseChanges(BaseModel):
+    changes: list[ExpenseInDB]
+    deleted: list[str]
+    token: str
+    has_more: bool
+    reset: bool
 
 # Helper functions
+def now_ms():
+    # BSON dates keep milliseconds, so returned documents match stored ones
+    now = datetime.now()
+    return now.replace(microsecond=now.microsecond // 1000 * 1000)
+
+
 def parse_expense(expense):
     return {
         "id": str(expense["_id"]),
@@ -42,65 +143,724 @@ def parse_expense(expense):
         "category": expense["category"],
         "description": expense.get("description"),
         "created_date": expense["created_date"],
+        "updated_at": expense.get("updated_at"),
     }
 
 
-def get_collection(collection_name: str):
+def check_collection_name(collection_name: str):
     if not collection_name:
         raise HTTPException(status_code=400, detail="Collection name is required")
-    return db[collection_name]
+    # Names starting with an underscore are reserved for derived data
+    if collection_name.startswith(("_", "system.")):
+        raise HTTPException(status_code=400, detail="Invalid collection name")
+
+
+async def get_collection(collection_name: str, provision: bool = False):
+    # Only routes that insert provision, reads never create a collection
+    check_collection_name(collection_name)
+    return await storage.expenses(collection_name, provision)
+
+
+async def get_archive(collection_name: str, version: int, query_filter: dict):
+    """
+    The archived expenses a list filter can match, or None when only the
+    hot collection needs to be read.
+    """
+    years = await result_cache.get_or_compute(
+        collection_name,
+        {"route": "archived_years", "version": version},
+        lambda: storage.archived_years(collection_name),
+    )
+    if spans_archive(query_filter, years):
+        return storage.archive(collection_name)
+    return None
+
+
+async def check_not_archived(collection_name: str, object_id: ObjectId):
+    archive = storage.archive(collection_name)
+    if archive is not None and await archive.find_one({"_id": object_id}):
+        raise HTTPException(status_code=409, detail="Expense is archived")
+
+
+async def record_writes(collection_name: str, added=(), removed=()):
+    """
+    Bookkeeping after expenses were written: fold them into the rollup,
+    drop the cached aggregation results and bump the collection version.
+    """
+    await storage.apply_rollup(collection_name, added=added, removed=removed)
+    await result_cache.invalidate(collection_name)
+    await bump_version(storage.db, collection_name)
+
+
+async def check_not_modified(
+    request: Request, response: Response, collection_name: str
+):
+    """
+    Compare the client's If-None-Match with the collection version.
+
+    Returns:
+        tuple: The collection version, and a 304 response to send instead
+        of running the query or None when the client's copy is stale.
+    """
+    version = await get_version(storage.db, collection_name)
+    headers = {
+        "ETag": make_etag(version),
+        "Cache-Control": "private, no-cache",
+    }
+    if etag_matches(request.headers.get("if-none-match"), headers["ETag"]):
+        return version, Response(status_code=304, headers=headers)
+    response.headers.update(headers)
+    return version, None
+
+
+def unchanged_filter(expense):
+    # Matches the expense only while it is as read, in what the rollup counts
+    return {
+        field: expense.get(field)
+        for field in ("_id", "updated_at", "amount", "category", "year", "month")
+    }
+
+
+async def check_bulk_applied(expenses_collection, written, counts):
+    """
+    Mark the updates and deletes of a bulk write that matched nothing as
+    errors, from the expenses as they are now: an applied update left the
+    expense as it wrote it, an applied delete left neither the expense nor
+    the tombstone of another delete.
+
+    Returns:
+        bool: Whether the items left ok add up to the server counts, so the
+        rollup can replay them.
+    """
+    object_ids = [
+        ObjectId(result["id"]) for result, _ in written if result["op"] != "create"
+    ]
+    cursor = expenses_collection.find({"_id": {"$in": object_ids}})
+    current = {expense["_id"]: expense for expense in await cursor.to_list(None)}
+    # Tombstones are only written after the bulk write, these are others'
+    cursor = storage.db[TOMBSTONE_COLLECTION].find({"_id": {"$in": object_ids}})
+    tombstones = {tombstone["_id"] for tombstone in await cursor.to_list(None)}
+
+    applied = {"update": 0, "delete": 0}
+    for result, payload in written:
+        if result["op"] == "create":
+            continue
+        object_id = ObjectId(result["id"])
+        expense = current.get(object_id)
+        if result["op"] == "update":
+            _, after = payload
+            done = expense is not None and all(
+                expense.get(field) == value for field, value in after.items()
+            )
+        else:
+            done = expense is None and object_id not in tombstones
+        if done:
+            applied[result["op"]] += 1
+        else:
+            result["status"] = "error"
+            result["detail"] = (
+                "Expense not found" if expense is None else "Expense was modified"
+            )
+    return (
+        applied["update"] == counts["nMatched"]
+        and applied["delete"] == counts["nRemoved"]
+    )
+
+
+def expense_filter(
+    start: Optional[datetime] = None,
+    end: Optional[datetime] = None,
+    category: Optional[str] = None,
+    min_amount: Optional[float] = None,
+    max_amount: Optional[float] = None,
+):
+    # Date range from start (inclusive) to end (exclusive), amounts inclusive
+    query_filter = {}
+    if start is not None or end is not None:
+        query_filter["date"] = {}
+        if start is not None:
+            query_filter["date"]["$gte"] = start
+        if end is not None:
+            query_filter["date"]["$lt"] = end
+    if category is not None:
+        query_filter["category"] = category
+    if min_amount is not None or max_amount is not None:
+        query_filter["amount"] = {}
+        if min_amount is not None:
+            query_filter["amount"]["$gte"] = min_amount
+        if max_amount is not None:
+            query_filter["amount"]["$lte"] = max_amount
+    return query_filter
+
+
+async def find_expenses(
+    expenses_collection,
+    query_filter: dict,
+    sort_fields: list,
+    response: Response,
+    limit: Optional[int] = None,
+    page_cursor: Optional[str] = None,
+    stream: bool = False,
+    fast: bool = False,
+    archived: Optional[ArchivedExpenses] = None,
+):
+    """
+    Run a find for one of the list routes.
+
+    With a limit the results are keyset paginated on sort_fields and the
+    cursor of the next page is returned in the X-Next-Cursor header. With
+    stream the documents are sent as NDJSON as the driver produces them.
+    With fast the documents are encoded straight to JSON bytes, skipping
+    parse_expense and response model validation. With archived the
+    archive is read too and merged in sort order.
+    """
+    archive_query = archive_filter(query_filter)
+    if page_cursor is not None:
+        keyset = keyset_filter(sort_fields, decode_cursor(page_cursor, sort_fields))
+        query_filter = {"$and": [query_filter, keyset]} if query_filter else keyset
+        archive_query = {"$and": [archive_query, keyset]} if archive_query else keyset
+    cursor = expenses_collection.find(query_filter).sort(sort_fields)
+    if archived is not None:
+        archive_cursor = archived.find(archive_query).sort(sort_fields)
+        cursor = MergedCursor([cursor, archive_cursor], sort_fields)
+
+    if stream:
+        if limit is not None:
+            cursor = cursor.limit(limit)
+        return StreamingResponse(
+            stream_ndjson(cursor, parse_expense),
+            media_type="application/x-ndjson",
+            headers=dict(response.headers),
+        )
+
+    if limit is None:
+        expenses = await cursor.to_list(length=None)
+    else:
+        # Fetch one extra document to know whether there is a next page
+        expenses = await cursor.limit(limit + 1).to_list(length=None)
+        if len(expenses) > limit:
+            expenses = expenses[:limit]
+            response.headers["X-Next-Cursor"] = encode_cursor(
+                expenses[-1], sort_fields
+            )
+
+    if fast:
+        return ExpenseListResponse(expenses, headers=dict(response.headers))
+    return [parse_expense(expense) for expense in expenses]
 
 
 # Routes
 @app.post("/expenses/", response_model=ExpenseInDB)
 async def create_expense(expense: Expense, collection_name: str = Query(...)):
     expense_data = expense.dict()
-    expense_data["created_date"] = datetime.now()
-    expenses_collection = get_collection(collection_name)
-    result = await expenses_collection.insert_one(expense_data)
-    created_expense = await expenses_collection.find_one({"_id": result.inserted_id})
-    return parse_expense(created_expense)
+    expense_data["created_date"] = expense_data["updated_at"] = now_ms()
+    expenses_collection = await get_collection(collection_name, provision=True)
+    # insert_one sets the generated _id on expense_data
+    await expenses_collection.insert_one(expense_data)
+    await record_writes(collection_name, added=[expense_data])
+    return parse_expense(expense_data)
 
 
-@app.get("/expenses/{expense_id}", response_model=ExpenseInDB)
-async def get_expense(expense_id: str, collection_name: str = Query(...)):
+@app.post("/expenses/bulk/", response_model=BulkExpenseResponse)
+async def bulk_write_expenses(
+    bulk: BulkExpenseRequest, collection_name: str = Query(...)
+):
+    """
+    Creates, updates and deletes many expenses with a single bulk_write.
+
+    Operations run in the order creates, updates, deletes. When ordered is
+    true the first failing item stops the batch and the items after it are
+    reported as skipped. Updates and deletes apply to the expenses as they
+    were looked up: one changed or deleted by another request in between is
+    reported as an error.
+
+    Returns:
+        BulkExpenseResponse: The write counts and one result per item.
+    """
+    if not (bulk.creates or bulk.updates or bulk.deletes):
+        raise HTTPException(status_code=400, detail="No operations provided")
+
+    expenses_collection = await get_collection(collection_name, provision=True)
+
+    # Look up the targeted ids once so missing expenses are reported per item
+    object_ids = {
+        item_id: ObjectId(item_id)
+        for item_id in [update.id for update in bulk.updates] + bulk.deletes
+        if ObjectId.is_valid(item_id)
+    }
+    existing = {}
+    if object_ids:
+        cursor = expenses_collection.find({"_id": {"$in": list(object_ids.values())}})
+        existing = {expense["_id"]: expense for expense in await cursor.to_list(None)}
+
+    def target_error(item_id):
+        if item_id not in object_ids:
+            return "Invalid expense ID"
+        if object_ids[item_id] not in existing:
+            return "Expense not found"
+        return None
+
+    created_date = now_ms()
+    items = []
+    for index, expense in enumerate(bulk.creates):
+        expense_data = expense.dict()
+        expense_data["created_date"] = expense_data["updated_at"] = created_date
+        items.append(("create", index, None, InsertOne(expense_data), expense_data))
+    # Updates and deletes only apply to an expense as it was looked up (or
+    # left by the items before), so the rollup replays the right before-image
+    for index, update in enumerate(bulk.updates):
+        update_fields = update.data.dict(exclude_unset=True)
+        update_fields["updated_at"] = created_date
+        error = target_error(update.id)
+        operation, payload = None, error
+        if error is None:
+            before = existing[object_ids[update.id]]
+            operation = UpdateOne(unchanged_filter(before), {"$set": update_fields})
+            existing[before["_id"]] = {**before, **update_fields}
+            payload = (before, existing[before["_id"]])
+        items.append(("update", index, update.id, operation, payload))
+    for index, expense_id in enumerate(bulk.deletes):
+        error = target_error(expense_id)
+        operation, payload = None, error
+        if error is None:
+            before = existing.pop(object_ids[expense_id])
+            operation = DeleteOne(unchanged_filter(before))
+            payload = (before, None)
+        items.append(("delete", index, expense_id, operation, payload))
+
+    # Items failing validation never reach the server; in ordered mode
+    # they also end the batch
+    results = []
+    pending = []
+    stopped = False
+    for op, index, item_id, operation, payload in items:
+        result = {"op": op, "index": index, "id": item_id}
+        results.append(result)
+        if stopped:
+            result["status"] = "skipped"
+        elif operation is None:
+            result["status"] = "error"
+            result["detail"] = payload
+            stopped = bulk.ordered
+        else:
+            pending.append((operation, result, payload))
+
+    counts = {"nInserted": 0, "nMatched": 0, "nModified": 0, "nRemoved": 0}
+    write_errors = {}
+    if pending:
+        try:
+            bulk_result = await expenses_collection.bulk_write(
+                [operation for operation, _, _ in pending], ordered=bulk.ordered
+            )
+            counts = bulk_result.bulk_api_result
+        except BulkWriteError as e:
+            counts = e.details
+            write_errors = {
+                error["index"]: error["errmsg"] for error in e.details["writeErrors"]
+            }
+
+    succeeded = []
+    first_error = min(write_errors, default=None)
+    for position, (operation, result, payload) in enumerate(pending):
+        if position in write_errors:
+            result["status"] = "error"
+            result["detail"] = write_errors[position]
+            continue
+        if bulk.ordered and first_error is not None and position > first_error:
+            result["status"] = "skipped"
+            continue
+        result["status"] = "ok"
+        if result["op"] == "create":
+            result["id"] = str(payload["_id"])
+            result["expense"] = parse_expense(payload)
+        succeeded.append((result, payload))
+
+    # Fewer matches than sent: an expense changed or went away since it was
+    # looked up, read them again to tell which items applied
+    sent = {
+        op: sum(result["op"] == op for result, _ in succeeded)
+        for op in ("update", "delete")
+    }
+    exact = True
+    if sent["update"] > counts["nMatched"] or sent["delete"] > counts["nRemoved"]:
+        exact = await check_bulk_applied(expenses_collection, succeeded, counts)
+
+    added, removed, deleted = [], [], []
+    for result, payload in succeeded:
+        if result["status"] != "ok":
+            continue
+        if result["op"] == "create":
+            added.append(payload)
+            continue
+        before, after = payload
+        removed.append(before)
+        if after is None:
+            deleted.append(before)
+        else:
+            added.append(after)
+    await record_tombstones(storage.db, collection_name, deleted, created_date)
+    if exact:
+        await record_writes(collection_name, added=added, removed=removed)
+    else:
+        # Which of the missing matches were ours cannot be told apart
+        await storage.rebuild_rollups(collection_name)
+        await record_writes(collection_name)
+
+    return {
+        "inserted_count": counts["nInserted"],
+        "modified_count": counts["nModified"],
+        "deleted_count": counts["nRemoved"],
+        "results": results,
+    }
+
+
+@app.post("/expenses/import/")
+async def import_expenses(
+    request: Request,
+    collection_name: str = Query(...),
+    format: str = Query("csv", pattern="^(csv|ofx)$"),
+    date_format: Optional[str] = Query(None),
+    default_category: str = Query("Uncategorized"),
+    batch_size: int = Query(1000, ge=1, le=10000),
+    encoding: str = Query("utf-8-sig"),
+):
+    """
+    Imports a CSV or OFX bank export sent as the raw request body.
+
+    The upload is spooled to a temporary file, then rows are validated
+    against Expense and written with bounded insert_many batches. The
+    response is NDJSON: one progress line per batch and a final summary
+    with the per-row errors. encoding is the one of a CSV file (bank
+    exports are often cp1252); reading stops at the first line that does
+    not decode, which is reported as the last error.
+    """
     try:
-        expenses_collection = get_collection(collection_name)
-        expense = await expenses_collection.find_one({"_id": ObjectId(expense_id)})
+        codecs.lookup(encoding)
+    except LookupError:
+        raise HTTPException(status_code=400, detail="Unknown encoding")
+    expenses_collection = await get_collection(collection_name, provision=True)
+
+    upload = SpooledTemporaryFile(max_size=1024 * 1024)
+    async for chunk in request.stream():
+        upload.write(chunk)
+    upload.seek(0)
+
+    if format == "csv":
+        rows = iter_csv_rows(upload, encoding)
+    else:
+        rows = iter_ofx_rows(upload)
+
+    async def progress_lines():
+        try:
+            async for progress in import_rows(
+                expenses_collection,
+                rows,
+                Expense,
+                now_ms(),
+                batch_size,
+                date_format=date_format,
+                default_category=default_category,
+                after_insert=lambda expenses: record_writes(
+                    collection_name, added=expenses
+                ),
+            ):
+                yield json.dumps(progress) + "\n"
+        finally:
+            upload.close()
+
+    return StreamingResponse(progress_lines(), media_type="application/x-ndjson")
+
+
+# Declared before /expenses/{expense_id}, which would take "changes" as an id
+@app.get("/expenses/changes", response_model=ExpenseChanges)
+async def get_expense_changes(
+    collection_name: str = Query(...),
+    since: Optional[str] = Query(None),
+    limit: int = Query(1000, ge=1, le=10000),
+):
+    """
+    Expenses written and deleted since a change token, for clients that
+    keep a local copy.
+
+    Start without since and pass the returned token on the next call.
+    Apply changes and deleted by id; when reset is true drop the local
+    copy first. While has_more is true, call again straight away.
+    """
+    expenses_collection = await get_collection(collection_name)
+    archived = await get_archive(
+        collection_name, await get_version(storage.db, collection_name), {}
+    )
+    changed, deleted, token, has_more, reset = await list_changes(
+        storage.db,
+        expenses_collection,
+        collection_name,
+        since,
+        limit,
+        now_ms(),
+        archived,
+    )
+    return {
+        "changes": [parse_expense(expense) for expense in changed],
+        "deleted": deleted,
+        "token": token,
+        "has_more": has_more,
+        "reset": reset,
+    }
+
+
+# Declared before /expenses/{expense_id}, which would take "export" as an id
+@app.get("/expenses/export")
+async def export_expenses(
+    collection_name: str = Query(...),
+    format: str = Query("csv", pattern="^(csv|xlsx|parquet)$"),
+    month: Optional[int] = Query(None, ge=1, le=12),
+    year: Optional[int] = Query(None),
+    start: Optional[datetime] = Query(None),
+    end: Optional[datetime] = Query(None),
+    category: Optional[str] = Query(None),
+):
+    """
+    Download expenses as CSV, XLSX or Parquet, oldest first.
+
+    The rows are read from one cursor and written as they arrive: CSV and
+    Parquet (one row group per batch) are streamed straight out, XLSX is
+    spooled to a temporary file first. month and year filter like
+    /month_year/, start and end like GET /expenses/.
+    """
+    query_filter = expense_filter(start, end, category)
+    if month is not None:
+        query_filter["month"] = month
+    if year is not None:
+        query_filter["year"] = year
+
+    sort_fields = [("date", 1), ("_id", 1)]
+    expenses_collection = await get_collection(collection_name)
+    cursor = expenses_collection.find(query_filter).sort(sort_fields)
+    version = await get_version(storage.db, collection_name)
+    archived = await get_archive(collection_name, version, query_filter)
+    if archived is not None:
+        archive_cursor = archived.find(archive_filter(query_filter)).sort(sort_fields)
+        cursor = MergedCursor([cursor, archive_cursor], sort_fields)
+    return StreamingResponse(
+        STREAMS[format](cursor),
+        media_type=MEDIA_TYPES[format],
+        headers={"Content-Disposition": f'attachment; filename="expenses.{format}"'},
+    )
+
+
+# Declared before /expenses/{expense_id}, which would take "analytics" as an id
+@app.get("/expenses/analytics")
+async def get_expense_analytics(
+    request: Request,
+    response: Response,
+    collection_name: str = Query(...),
+    top: int = Query(5, ge=1, le=50),
+):
+    """
+    Month-over-month and year-over-year changes of the monthly totals,
+    3-month moving averages per category and the top categories, computed
+    from the monthly totals in a single query.
+    """
+    check_collection_name(collection_name)
+    version, not_modified = await check_not_modified(
+        request, response, collection_name
+    )
+    if not_modified:
+        return not_modified
+    return await result_cache.get_or_compute(
+        collection_name,
+        {"route": "analytics", "top": top, "version": version},
+        lambda: storage.analytics(collection_name, top),
+    )
+
+
+# Declared before /expenses/{expense_id}, which would take "search" as an id
+@app.get("/expenses/search", response_model=list[ExpenseInDB])
+async def search_expenses(
+    request: Request,
+    response: Response,
+    q: str = Query(..., min_length=1),
+    collection_name: str = Query(...),
+    start: Optional[datetime] = Query(None),
+    end: Optional[datetime] = Query(None),
+    min_amount: Optional[float] = Query(None, ge=0),
+    max_amount: Optional[float] = Query(None, ge=0),
+    limit: int = Query(50, ge=1, le=1000),
+    offset: int = Query(0, ge=0),
+):
+    """
+    Full-text search of descriptions and categories, best matches first.
+
+    Words also match their other forms ("groceries" finds "grocery"), a
+    quoted phrase must appear as is and a leading "-" excludes a word. The
+    date and amount filters are the ones of GET /expenses/. Pages are
+    taken by offset, the offset of the next page is returned in the
+    X-Next-Offset header. Archived years are not searched: time-series
+    collections have no text index.
+    """
+    query_filter = expense_filter(start, end, None, min_amount, max_amount)
+
+    check_collection_name(collection_name)
+    _, not_modified = await check_not_modified(request, response, collection_name)
+    if not_modified:
+        return not_modified
+    # One more than asked to know whether there is a next page
+    expenses = await storage.search(
+        collection_name, q, query_filter, offset, limit + 1
+    )
+    if len(expenses) > limit:
+        expenses = expenses[:limit]
+        response.headers["X-Next-Offset"] = str(offset + limit)
+    return [parse_expense(expense) for expense in expenses]
+
+
+# Declared before /expenses/{expense_id}, which would take "archive" as an id
+@app.get("/expenses/archive")
+async def get_archived_years(
+    request: Request, response: Response, collection_name: str = Query(...)
+):
+    """
+    The archived years, oldest first, with their totals per month and per
+    category as stored by the archive job.
+    """
+    check_collection_name(collection_name)
+    version, not_modified = await check_not_modified(
+        request, response, collection_name
+    )
+    if not_modified:
+        return not_modified
+
+    return await result_cache.get_or_compute(
+        collection_name,
+        {"route": "archive", "version": version},
+        lambda: storage.archived_year_totals(collection_name),
+    )
+
+
+@app.get("/expenses/{expense_id}", response_model=ExpenseInDB)
+async def get_expense(
+    expense_id: str,
+    request: Request,
+    response: Response,
+    collection_name: str = Query(...),
+):
+    async def find_expense():
+        expense = await expenses_collection.find_one({"_id": object_id})
+        archive = storage.archive(collection_name)
+        if not expense and archive is not None:
+            expense = await archive.find_one({"_id": object_id})
         if not expense:
             raise HTTPException(status_code=404, detail="Expense not found")
+        return expense
+
+    try:
+        expenses_collection = await get_collection(collection_name)
+        object_id = ObjectId(expense_id)
+        expense = None
+        # If-None-Match: * only matches an existing expense, other validators
+        # are answered from the collection version alone
+        if "*" in request.headers.get("if-none-match", ""):
+            expense = await find_expense()
+        _, not_modified = await check_not_modified(request, response, collection_name)
+        if not_modified:
+            return not_modified
+        if expense is None:
+            expense = await find_expense()
         return parse_expense(expense)
     except InvalidId:
         raise HTTPException(status_code=400, detail="Invalid expense ID")
 
 
 @app.get("/expenses/", response_model=list[ExpenseInDB])
-async def list_expenses(collection_name: str = Query(...)):
-    expenses_collection = get_collection(collection_name)
-    cursor = expenses_collection.find()
-    expenses = await cursor.to_list(length=None)
-    return [parse_expense(expense) for expense in expenses]
+async def list_expenses(
+    request: Request,
+    response: Response,
+    collection_name: str = Query(...),
+    start: Optional[datetime] = Query(None),
+    end: Optional[datetime] = Query(None),
+    category: Optional[str] = Query(None),
+    min_amount: Optional[float] = Query(None, ge=0),
+    max_amount: Optional[float] = Query(None, ge=0),
+    limit: Optional[int] = Query(None, ge=1, le=1000),
+    page_cursor: Optional[str] = Query(None, alias="cursor"),
+    stream: bool = Query(False),
+    fast: bool = Query(False),
+):
+    """
+    Lists expenses, optionally filtered by date range, category and amount.
+
+    The range includes start and excludes end, so Q3 is start=2024-07-01
+    and end=2024-10-01. A date range is served by the date index and the
+    results are then ordered by date.
+    """
+    query_filter = expense_filter(start, end, category, min_amount, max_amount)
+    sort_fields = [("date", 1), ("_id", 1)] if "date" in query_filter else [("_id", 1)]
+
+    expenses_collection = await get_collection(collection_name)
+    version, not_modified = await check_not_modified(
+        request, response, collection_name
+    )
+    if not_modified:
+        return not_modified
+    return await find_expenses(
+        expenses_collection,
+        query_filter,
+        sort_fields,
+        response,
+        limit=limit,
+        page_cursor=page_cursor,
+        stream=stream,
+        fast=fast,
+        archived=await get_archive(collection_name, version, query_filter),
+    )
 
 
 @app.get("/expenses/ls_month_year/", response_model=list[ExpenseInDB])
 async def list_expenses_by_month_and_year(
+    request: Request,
+    response: Response,
     month: Optional[int] = Query(None, ge=1, le=12),
     year: Optional[int] = Query(None),
     collection_name: str = Query(...),
+    limit: Optional[int] = Query(None, ge=1, le=1000),
+    page_cursor: Optional[str] = Query(None, alias="cursor"),
+    stream: bool = Query(False),
+    fast: bool = Query(False),
 ):
-    expenses_collection = get_collection(collection_name)
-    cursor = expenses_collection.find({"month": month, "year": year})
-    expenses = await cursor.to_list(length=None)
-    return [parse_expense(expense) for expense in expenses]
+    query_filter = {"month": month, "year": year}
+    expenses_collection = await get_collection(collection_name)
+    version, not_modified = await check_not_modified(
+        request, response, collection_name
+    )
+    if not_modified:
+        return not_modified
+    return await find_expenses(
+        expenses_collection,
+        query_filter,
+        [("_id", 1)],
+        response,
+        limit=limit,
+        page_cursor=page_cursor,
+        stream=stream,
+        fast=fast,
+        archived=await get_archive(collection_name, version, query_filter),
+    )
 
 
 @app.delete("/expenses/{expense_id}", response_model=dict)
 async def delete_expense(expense_id: str, collection_name: str = Query(...)):
     try:
-        expenses_collection = get_collection(collection_name)
-        result = await expenses_collection.delete_one({"_id": ObjectId(expense_id)})
-        if result.deleted_count == 0:
+        expenses_collection = await get_collection(collection_name)
+        deleted_expense = await expenses_collection.find_one_and_delete(
+            {"_id": ObjectId(expense_id)}
+        )
+        if deleted_expense is None:
+            await check_not_archived(collection_name, ObjectId(expense_id))
             raise HTTPException(status_code=404, detail="Expense not found")
+        await record_tombstones(
+            storage.db, collection_name, [deleted_expense], now_ms()
+        )
+        await record_writes(collection_name, removed=[deleted_expense])
         return {"message": "Expense deleted successfully"}
     except InvalidId:
         raise HTTPException(status_code=400, detail="Invalid expense ID")
@@ -108,6 +868,8 @@ async def delete_expense(expense_id: str, collection_name: str = Query(...)):
 
 @app.get("/expenses/summary/")
 async def get_expense_summary(
+    request: Request,
+    response: Response,
     month: Optional[int] = Query(None, ge=1, le=12),
     year: Optional[int] = Query(None),
     collection_name: str = Query(...),
@@ -115,47 +877,91 @@ async def get_expense_summary(
     """
     Summarize expenses grouped by month, year, and category.
     Optional query parameters for filtering by month and year.
+    Reads the monthly rollup (on MongoDB) instead of grouping the raw
+    expenses.
     """
-    match_stage = {}
-    if month:
-        match_stage["month"] = month
-    if year:
-        match_stage["year"] = year
-
-    pipeline = [
-        {"$match": match_stage}
-        if match_stage
-        else {},  # Match stage if filters are provided
-        {
-            "$group": {
-                "_id": {"month": "$month", "year": "$year", "category": "$category",},
-                "total_amount": {"$sum": "$amount"},
-            }
-        },
-        {
-            "$project": {
-                "_id": 0,
-                "month": "$_id.month",
-                "year": "$_id.year",
-                "category": "$_id.category",
-                "total_amount": 1,
-            }
-        },
-        {
-            "$sort": {"year": 1, "month": 1, "category": 1}
-        },  # Sort results for better readability
-    ]
-    expenses_collection = get_collection(collection_name)
-    cursor = expenses_collection.aggregate(pipeline)
-    result = await cursor.to_list(length=None)  # Await and convert results to a list
-    return result
+    check_collection_name(collection_name)
+    version, not_modified = await check_not_modified(
+        request, response, collection_name
+    )
+    if not_modified:
+        return not_modified
+    return await result_cache.get_or_compute(
+        collection_name,
+        {"route": "summary", "month": month, "year": year, "version": version},
+        lambda: storage.summary(collection_name, month, year),
+    )
+
+
+@app.get("/expenses/summary/periods/")
+async def get_expense_summary_by_period(
+    request: Request, response: Response, collection_name: str = Query(...)
+):
+    """
+    Summarize every month of history in a single aggregation.
+    Returns the totals per month, year and category along with the
+    totals per month, so the summary page needs only one request.
+    """
+    check_collection_name(collection_name)
+    version, not_modified = await check_not_modified(
+        request, response, collection_name
+    )
+    if not_modified:
+        return not_modified
+    return await result_cache.get_or_compute(
+        collection_name,
+        {"route": "summary_periods", "version": version},
+        lambda: storage.summary_periods(collection_name),
+    )
+
+
+@app.get("/expenses/summary/pivot/")
+async def get_expense_pivot(
+    request: Request,
+    response: Response,
+    collection_name: str = Query(...),
+    format: str = Query("json", pattern="^(json|arrow)$"),
+):
+    """
+    Pivot the monthly totals into one row per month and one column per
+    category, plus year, month, time and total columns, oldest month first.
+    format=arrow sends the pivot as an Apache Arrow IPC stream that pandas
+    loads without per-row parsing; the JSON fallback maps each column name
+    to its list of values.
+    """
+    check_collection_name(collection_name)
+    version, not_modified = await check_not_modified(
+        request, response, collection_name
+    )
+    if not_modified:
+        return not_modified
+
+    async def compute():
+        return build_pivot(await storage.summary(collection_name))
+
+    pivot = await result_cache.get_or_compute(
+        collection_name, {"route": "summary_pivot", "version": version}, compute
+    )
+    if format == "arrow":
+        return Response(
+            content=pivot_to_arrow(pivot),
+            media_type=ARROW_STREAM_MEDIA_TYPE,
+            headers=dict(response.headers),
+        )
+    return pivot
 
 
 @app.get("/month_year/", response_model=list[ExpenseInDB])
 async def list_expenses_by_month_and_year(
+    request: Request,
+    response: Response,
     month: Optional[int] = Query(None, ge=1, le=12),
     year: Optional[int] = Query(None),
     collection_name: str = Query(...),
+    limit: Optional[int] = Query(None, ge=1, le=1000),
+    page_cursor: Optional[str] = Query(None, alias="cursor"),
+    stream: bool = Query(False),
+    fast: bool = Query(False),
 ):
     # Build the query filter
     query_filter = {}
@@ -164,15 +970,24 @@ async def list_expenses_by_month_and_year(
     if year is not None:
         query_filter["year"] = year
 
-    # Perform the query and sort by category
-    expenses_collection = get_collection(collection_name)
-    cursor = expenses_collection.find(query_filter).sort(
-        "category", 1
-    )  # 1 for ascending, -1 for descending
-    expenses = await cursor.to_list(length=None)
-
-    # Parse the expenses to handle ObjectId conversion
-    return [parse_expense(expense) for expense in expenses]
+    # Perform the query and sort by category, _id keeps the order stable
+    expenses_collection = await get_collection(collection_name)
+    version, not_modified = await check_not_modified(
+        request, response, collection_name
+    )
+    if not_modified:
+        return not_modified
+    return await find_expenses(
+        expenses_collection,
+        query_filter,
+        [("category", 1), ("_id", 1)],  # 1 for ascending, -1 for descending
+        response,
+        limit=limit,
+        page_cursor=page_cursor,
+        stream=stream,
+        fast=fast,
+        archived=await get_archive(collection_name, version, query_filter),
+    )
 
 
 @app.put("/expenses/{expense_id}", response_model=ExpenseInDB)
@@ -195,41 +1010,85 @@ async def update_expense(
     update_fields = updated_data.dict(exclude_unset=True)
     if not update_fields:
         raise HTTPException(status_code=400, detail="No fields provided for update")
+    update_fields["updated_at"] = now_ms()
 
     try:
-        # Perform the update
-        expenses_collection = get_collection(collection_name)
-        result = await expenses_collection.update_one(
-            {"_id": ObjectId(expense_id)}, {"$set": update_fields}
+        # Perform the update and get the previous document back in one call
+        expenses_collection = await get_collection(collection_name)
+        previous_expense = await expenses_collection.find_one_and_update(
+            {"_id": ObjectId(expense_id)},
+            {"$set": update_fields},
+            return_document=ReturnDocument.BEFORE,
         )
 
-        if result.matched_count == 0:
+        if previous_expense is None:
+            await check_not_archived(collection_name, ObjectId(expense_id))
             raise HTTPException(status_code=404, detail="Expense not found")
 
-        # Fetch the updated document
-        updated_expense = await expenses_collection.find_one(
-            {"_id": ObjectId(expense_id)}
+        # Moves the amount when the category, month or year changed
+        updated_expense = {**previous_expense, **update_fields}
+        await record_writes(
+            collection_name, added=[updated_expense], removed=[previous_expense]
         )
         return parse_expense(updated_expense)
 
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"An error occurred: {e}")
 
 
 @app.get("/month/year")
-async def get_month_and_year(collection_name: str = Query(...)):
+async def get_month_and_year(
+    request: Request, response: Response, collection_name: str = Query(...)
+):
     """
     Summarize expenses grouped by month, year, and category.
     Optional query parameters for filtering by month and year.
     """
+    check_collection_name(collection_name)
+    version, not_modified = await check_not_modified(
+        request, response, collection_name
+    )
+    if not_modified:
+        return not_modified
+    return await result_cache.get_or_compute(
+        collection_name,
+        {"route": "month_year", "version": version},
+        lambda: storage.months(collection_name),
+    )
+
+
+@app.get("/cache/stats")
+async def get_cache_stats():
+    """
+    Hit and miss counters of the aggregation result cache.
+    """
+    return await result_cache.stats()
+
+
+@app.get("/metrics")
+async def get_metrics():
+    """
+    Request, Mongo command and connection pool metrics for Prometheus.
+    """
+    content, media_type = render()
+    return Response(content=content, media_type=media_type)
 
-    pipeline = [
-        {"$group": {"_id": {"month": "$month", "year": "$year"}}},
-        {"$project": {"month": "$_id.month", "year": "$_id.year", "_id": 0}},
-        {"$sort": {"year": 1, "month": 1}},  # Optional: Sort by year and month
-    ]
 
-    expenses_collection = get_collection(collection_name)
-    cursor = expenses_collection.aggregate(pipeline)
-    result = await cursor.to_list(length=None)  # Await and convert results to a list
-    return result
+@app.get("/health/live")
+async def get_liveness():
+    # The process is up and serving requests
+    return {"status": "ok"}
+
+
+@app.get("/health/ready")
+async def get_readiness():
+    """
+    Ready when the storage answers a ping, 503 otherwise.
+    """
+    try:
+        await storage.ping()
+    except Exception as e:
+        raise HTTPException(status_code=503, detail=f"Storage unavailable: {e}")
+    return {"status": "ok"}
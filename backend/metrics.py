@@ -0,0 +1,209 @@
+import logging
+import os
+import time
+
+from fastapi import Request
+from prometheus_client import (
+    CONTENT_TYPE_LATEST,
+    REGISTRY,
+    CollectorRegistry,
+    Counter,
+    Histogram,
+    generate_latest,
+    multiprocess,
+)
+from pymongo import monitoring
+
+# Commands slower than this many milliseconds are logged, unset turns it off
+SLOW_QUERY_MS = os.environ.get("SLOW_QUERY_MS")
+
+logger = logging.getLogger("expense_tracker.slow_queries")
+
+# Mongo commands mostly take well under the default 5ms first bucket
+COMMAND_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1)
+
+REQUEST_LATENCY = Histogram(
+    "http_request_duration_seconds",
+    "Time to the response headers, per route template.",
+    ["method", "route"],
+)
+REQUESTS = Counter(
+    "http_requests_total", "Requests served.", ["method", "route", "status"]
+)
+COLLECTION_LATENCY = Histogram(
+    "http_collection_request_duration_seconds",
+    "Time to the response headers, per expense collection.",
+    ["collection"],
+)
+COMMAND_LATENCY = Histogram(
+    "mongodb_command_duration_seconds",
+    "Server round trip of a Mongo command.",
+    ["command", "collection"],
+    buckets=COMMAND_BUCKETS,
+)
+COMMAND_FAILURES = Counter(
+    "mongodb_command_failures_total",
+    "Failed Mongo commands.",
+    ["command", "collection"],
+)
+DOCUMENTS_RETURNED = Counter(
+    "mongodb_documents_returned_total",
+    "Documents in cursor batches and findAndModify replies.",
+    ["command", "collection"],
+)
+DOCUMENTS_WRITTEN = Counter(
+    "mongodb_documents_written_total",
+    "Documents inserted, matched by updates or deleted.",
+    ["command", "collection"],
+)
+POOL_WAIT = Histogram(
+    "mongodb_pool_wait_seconds",
+    "Time spent waiting to check a connection out of the pool.",
+    ["outcome"],
+    buckets=COMMAND_BUCKETS,
+)
+
+
+def command_collection(command_name: str, command):
+    # The collection is the value of the command key, getMore names it apart
+    if command_name == "getMore":
+        return command.get("collection", "")
+    target = command.get(command_name)
+    return target if isinstance(target, str) else ""
+
+
+def returned_count(reply):
+    if "cursor" in reply:
+        cursor = reply["cursor"]
+        return len(cursor.get("firstBatch", cursor.get("nextBatch", ())))
+    if "value" in reply:
+        return 0 if reply["value"] is None else 1
+    return 0
+
+
+class CommandMetrics(monitoring.CommandListener):
+    """
+    Time every command Motor sends and count the documents it moved.
+
+    pymongo calls listeners from the thread running the command, the
+    pending commands are only added and popped by request id.
+    """
+
+    def __init__(self, slow_query_ms=None):
+        self.slow_query_ms = slow_query_ms
+        self.pending = {}
+
+    def started(self, event):
+        command = event.command if self.slow_query_ms is not None else None
+        collection = command_collection(event.command_name, event.command)
+        self.pending[event.request_id] = (collection, command)
+
+    def succeeded(self, event):
+        collection = self.finish(event)
+        labels = (event.command_name, collection)
+        reply = event.reply
+        if event.command_name in ("insert", "update", "delete"):
+            DOCUMENTS_WRITTEN.labels(*labels).inc(reply.get("n", 0))
+        else:
+            DOCUMENTS_RETURNED.labels(*labels).inc(returned_count(reply))
+
+    def failed(self, event):
+        collection = self.finish(event)
+        COMMAND_FAILURES.labels(event.command_name, collection).inc()
+
+    def finish(self, event):
+        collection, command = self.pending.pop(event.request_id, ("", None))
+        seconds = event.duration_micros / 1e6
+        COMMAND_LATENCY.labels(event.command_name, collection).observe(seconds)
+        if command is not None and seconds * 1000 >= self.slow_query_ms:
+            logger.warning(
+                "Slow %s on %s.%s took %.1fms: %s",
+                event.command_name,
+                event.database_name,
+                collection,
+                seconds * 1000,
+                command,
+            )
+        return collection
+
+
+class PoolMetrics(monitoring.ConnectionPoolListener):
+    """
+    Time the wait for a pooled connection, a full pool shows up here.
+    """
+
+    def connection_checked_out(self, event):
+        POOL_WAIT.labels("checked_out").observe(event.duration or 0)
+
+    def connection_check_out_failed(self, event):
+        POOL_WAIT.labels("failed").observe(event.duration or 0)
+
+    # The remaining pool events are not measured
+    def pool_created(self, event):
+        pass
+
+    def pool_ready(self, event):
+        pass
+
+    def pool_cleared(self, event):
+        pass
+
+    def pool_closed(self, event):
+        pass
+
+    def connection_created(self, event):
+        pass
+
+    def connection_ready(self, event):
+        pass
+
+    def connection_closed(self, event):
+        pass
+
+    def connection_check_out_started(self, event):
+        pass
+
+    def connection_checked_in(self, event):
+        pass
+
+
+def event_listeners():
+    """
+    The listeners to pass to the Motor client as event_listeners.
+    """
+    slow_query_ms = float(SLOW_QUERY_MS) if SLOW_QUERY_MS else None
+    return [CommandMetrics(slow_query_ms), PoolMetrics()]
+
+
+async def record_request(request: Request, call_next):
+    """
+    HTTP middleware timing each request by route template and collection.
+
+    Streamed responses are timed up to their headers, not their last chunk.
+    """
+    started = time.perf_counter()
+    response = await call_next(request)
+    seconds = time.perf_counter() - started
+    # The router stores the matched route in the scope, the template keeps
+    # ids out of the labels
+    route = request.scope.get("route")
+    template = route.path if route is not None else "unmatched"
+    REQUEST_LATENCY.labels(request.method, template).observe(seconds)
+    REQUESTS.labels(request.method, template, response.status_code).inc()
+    # Every collection label is a histogram series of its own: requests
+    # the routes rejected (invalid names among them) do not get one
+    collection_name = request.query_params.get("collection_name")
+    rejected = 400 <= response.status_code < 500
+    if collection_name and route is not None and not rejected:
+        COLLECTION_LATENCY.labels(collection_name).observe(seconds)
+    return response
+
+
+def render():
+    # Prometheus text exposition format of every metric above
+    registry = REGISTRY
+    if "PROMETHEUS_MULTIPROC_DIR" in os.environ:
+        # Several workers: add up what every process wrote to the directory
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    return generate_latest(registry), CONTENT_TYPE_LATEST
@@ -0,0 +1,65 @@
+import base64
+import json
+from datetime import datetime
+
+from bson import ObjectId, json_util
+from fastapi import HTTPException
+from fastapi.encoders import jsonable_encoder
+
+# The types of the fields lists are sorted by; _id is never missing, the
+# others can be (updated_at on documents written before it was tracked)
+CURSOR_TYPES = {
+    "_id": ObjectId,
+    "date": datetime,
+    "updated_at": datetime,
+    "category": str,
+}
+
+# Helper functions
+def encode_cursor(document, sort_fields):
+    """
+    Build an opaque cursor pointing just after the given document.
+
+    Args:
+        document (dict): The last document of the current page.
+        sort_fields (list): The (field, direction) pairs the page is sorted by.
+
+    Returns:
+        str: A URL-safe token for the next page.
+    """
+    values = [document.get(field) for field, _ in sort_fields]
+    raw = json_util.dumps(values).encode()
+    return base64.urlsafe_b64encode(raw).decode()
+
+
+def decode_cursor(token: str, sort_fields):
+    try:
+        values = json_util.loads(base64.urlsafe_b64decode(token.encode()))
+    except (ValueError, TypeError):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+    if not isinstance(values, list) or len(values) != len(sort_fields):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+    for (field, _), value in zip(sort_fields, values):
+        if value is None and field != "_id":
+            continue
+        if not isinstance(value, CURSOR_TYPES[field]):
+            raise HTTPException(status_code=400, detail="Invalid cursor")
+    return values
+
+
+def keyset_filter(sort_fields, values):
+    """
+    Match the documents that sort strictly after the given key values.
+    """
+    clauses = []
+    for i, (field, direction) in enumerate(sort_fields):
+        clause = {prev: value for (prev, _), value in zip(sort_fields[:i], values)}
+        clause[field] = {"$gt" if direction == 1 else "$lt": values[i]}
+        clauses.append(clause)
+    return {"$or": clauses}
+
+
+async def stream_ndjson(cursor, parse):
+    # Yield one JSON line per document as the driver hands out batches
+    async for document in cursor:
+        yield json.dumps(jsonable_encoder(parse(document))) + "\n"
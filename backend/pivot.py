@@ -0,0 +1,67 @@
+import pyarrow as pa
+
+ARROW_STREAM_MEDIA_TYPE = "application/vnd.apache.arrow.stream"
+INDEX_COLUMNS = ["year", "month", "time"]
+TOTAL_COLUMN = "total"
+
+
+def category_column(category: str):
+    # Keep categories from shadowing the index and total columns
+    if category in INDEX_COLUMNS or category == TOTAL_COLUMN:
+        return f"{category} (category)"
+    return category
+
+
+def build_pivot(rows):
+    """
+    Pivot monthly category totals into one row per month.
+
+    Args:
+        rows (list): Rollup rows with year, month, category and
+            total_amount, sorted by year and month.
+
+    Returns:
+        dict: Column name -> list of values, oldest month first. Categories
+        without expenses in a month are None.
+    """
+    months = []
+    totals = {}
+    for row in rows:
+        month = (row["year"], row["month"])
+        if not months or months[-1] != month:
+            months.append(month)
+        column = category_column(row["category"])
+        totals.setdefault(column, {})[month] = row["total_amount"]
+
+    pivot = {
+        "year": [year for year, _ in months],
+        "month": [month for _, month in months],
+        "time": [f"{month}-{year}" for year, month in months],
+    }
+    for column in sorted(totals):
+        pivot[column] = [totals[column].get(month) for month in months]
+    pivot[TOTAL_COLUMN] = [
+        sum(totals[column].get(month, 0) for column in totals) for month in months
+    ]
+    return pivot
+
+
+def pivot_to_arrow(pivot):
+    """
+    Encode a pivot as an Arrow IPC stream.
+
+    Returns:
+        bytes: A single record batch stream with int32 year and month, a
+        string time and float64 amount columns.
+    """
+    types = {"year": pa.int32(), "month": pa.int32(), "time": pa.string()}
+    table = pa.table(
+        {
+            name: pa.array(values, type=types.get(name, pa.float64()))
+            for name, values in pivot.items()
+        }
+    )
+    sink = pa.BufferOutputStream()
+    with pa.ipc.new_stream(sink, table.schema) as writer:
+        writer.write_table(table)
+    return sink.getvalue().to_pybytes()
@@ -0,0 +1,219 @@
+import asyncio
+import sys
+from datetime import datetime
+
+from pymongo import ASCENDING, IndexModel, UpdateOne
+
+from archive import ARCHIVE_COLLECTION, ARCHIVE_USER_FIELD, ARCHIVED_YEARS_COLLECTION
+from tenancy import expense_collection, expense_collection_names
+from versions import bump_version
+
+# One document per (collection, year, month, category) with its running
+# total and count; the leading underscore keeps it apart from user names
+ROLLUP_COLLECTION = "_expense_rollups"
+
+ROLLUP_INDEXES = [
+    IndexModel(
+        [
+            ("collection", ASCENDING),
+            ("year", ASCENDING),
+            ("month", ASCENDING),
+            ("category", ASCENDING),
+        ],
+        name="collection_year_month_category",
+        unique=True,
+    ),
+]
+
+
+# Helper functions
+def rollup_deltas(added=(), removed=()):
+    """
+    Net the amount and count changes per (year, month, category).
+
+    Args:
+        added (list): Expense documents as they are after the write.
+        removed (list): Expense documents as they were before the write.
+
+    Returns:
+        dict: (year, month, category) -> (amount delta, count delta).
+    """
+    deltas = {}
+    for expenses, sign in ((added, 1), (removed, -1)):
+        for expense in expenses:
+            key = (expense["year"], expense["month"], expense["category"])
+            total, count = deltas.get(key, (0, 0))
+            deltas[key] = (total + sign * expense["amount"], count + sign)
+    return deltas
+
+
+async def apply_rollup(db, collection_name: str, added=(), removed=()):
+    """
+    Fold written expenses into the rollup with $inc upserts.
+
+    Each rollup document is updated atomically. The rollup write is not in
+    the same transaction as the expense write, so rebuild_rollups repairs
+    any drift left by a failure in between.
+    """
+    operations = [
+        UpdateOne(
+            {
+                "collection": collection_name,
+                "year": year,
+                "month": month,
+                "category": category,
+            },
+            {"$inc": {"total_amount": total, "count": count}},
+            upsert=True,
+        )
+        for (year, month, category), (total, count) in rollup_deltas(
+            added, removed
+        ).items()
+        if total or count
+    ]
+    if operations:
+        await db[ROLLUP_COLLECTION].bulk_write(operations, ordered=False)
+
+
+def rollup_match(collection_name: str, month=None, year=None):
+    match_stage = {"collection": collection_name, "count": {"$gt": 0}}
+    if month:
+        match_stage["month"] = month
+    if year:
+        match_stage["year"] = year
+    return match_stage
+
+
+async def realign_month_and_year(db, collection_name: str):
+    """
+    Reset month and year from date on expenses where they disagree, as
+    written by clients before the server derived them.
+
+    Returns:
+        int: The number of expenses fixed.
+    """
+    result = await expense_collection(db, collection_name).update_many(
+        {
+            "$expr": {
+                "$or": [
+                    {"$ne": ["$month", {"$month": "$date"}]},
+                    {"$ne": ["$year", {"$year": "$date"}]},
+                ]
+            }
+        },
+        [
+            {
+                "$set": {
+                    "month": {"$month": "$date"},
+                    "year": {"$year": "$date"},
+                    # Synced copies pick up the repaired fields
+                    "updated_at": datetime.now(),
+                }
+            }
+        ],
+    )
+    return result.modified_count
+
+
+async def rebuild_rollups(db, collection_name: str):
+    """
+    Recompute the rollup of a collection from its raw expenses, hot and
+    archived.
+
+    Safe to run while the API serves the collection: every rebuilt key is
+    overwritten in place, so summaries never see an empty rollup, and keys
+    left without expenses are taken back by the totals read before the
+    aggregation with $inc, which keeps the writes made to them since.
+
+    Returns:
+        int: The number of rollup documents written.
+    """
+    pipeline = [
+        {
+            "$group": {
+                "_id": {"year": "$year", "month": "$month", "category": "$category"},
+                "total_amount": {"$sum": "$amount"},
+                "count": {"$sum": 1},
+            }
+        },
+    ]
+    if await db[ARCHIVED_YEARS_COLLECTION].find_one({"collection": collection_name}):
+        archived = [{"$match": {ARCHIVE_USER_FIELD: collection_name}}]
+        pipeline.insert(
+            0, {"$unionWith": {"coll": ARCHIVE_COLLECTION, "pipeline": archived}}
+        )
+    cursor = db[ROLLUP_COLLECTION].find({"collection": collection_name})
+    previous = await cursor.to_list(length=None)
+    cursor = expense_collection(db, collection_name).aggregate(pipeline)
+    groups = await cursor.to_list(length=None)
+    operations = [
+        UpdateOne(
+            {"collection": collection_name, **group["_id"]},
+            {
+                "$set": {
+                    "total_amount": group["total_amount"],
+                    "count": group["count"],
+                }
+            },
+            upsert=True,
+        )
+        for group in groups
+    ]
+    rebuilt = {
+        (group["_id"]["year"], group["_id"]["month"], group["_id"]["category"])
+        for group in groups
+    }
+    operations += [
+        UpdateOne(
+            {"_id": rollup["_id"]},
+            {
+                "$inc": {
+                    "total_amount": -rollup["total_amount"],
+                    "count": -rollup["count"],
+                }
+            },
+        )
+        for rollup in previous
+        if (rollup["year"], rollup["month"], rollup["category"]) not in rebuilt
+    ]
+    if operations:
+        await db[ROLLUP_COLLECTION].bulk_write(operations, ordered=False)
+    await db[ROLLUP_COLLECTION].delete_many(
+        {"collection": collection_name, "count": {"$lte": 0}}
+    )
+    # Summaries served before the rebuild may differ from the repaired ones
+    await bump_version(db, collection_name)
+    return len(groups)
+
+
+async def backfill_rollups(db):
+    """
+    Build the rollup of every collection that does not have one yet.
+
+    Returns:
+        list[str]: The names of the collections that were rebuilt.
+    """
+    await db[ROLLUP_COLLECTION].create_indexes(ROLLUP_INDEXES)
+    built = set(await db[ROLLUP_COLLECTION].distinct("collection"))
+    names = [
+        name for name in await expense_collection_names(db) if name not in built
+    ]
+    for name in names:
+        await rebuild_rollups(db, name)
+    return names
+
+
+if __name__ == "__main__":
+    from database import DATABASE_NAME, create_client
+
+    db = create_client()[DATABASE_NAME]
+
+    async def rebuild(names):
+        await db[ROLLUP_COLLECTION].create_indexes(ROLLUP_INDEXES)
+        if not names:
+            names = await expense_collection_names(db)
+        for name in names:
+            print(f"Realigned {await realign_month_and_year(db, name)} dates in {name}")
+            print(f"Rebuilt {await rebuild_rollups(db, name)} rollups for {name}")
+
+    asyncio.run(rebuild(sys.argv[1:]))
@@ -0,0 +1,55 @@
+"""
+Run the API in several worker processes, the production entry point.
+
+    python serve.py
+
+WEB_CONCURRENCY sets the number of uvicorn workers (one per core by
+default). The workers share MONGO_MAX_CONNECTIONS connections (200 by
+default) unless MONGO_MAX_POOL_SIZE sets the pool size of each worker.
+Indexes and rollups are backfilled once here, before the workers start,
+instead of concurrently by every worker.
+"""
+import asyncio
+import os
+import tempfile
+
+import uvicorn
+
+from storage import create_storage
+
+HOST = os.environ.get("HOST", "0.0.0.0")
+PORT = int(os.environ.get("PORT", "8000"))
+WORKERS = int(os.environ.get("WEB_CONCURRENCY", os.cpu_count() or 1))
+MONGO_MAX_CONNECTIONS = int(os.environ.get("MONGO_MAX_CONNECTIONS", "200"))
+# Seconds in-flight requests get to finish on shutdown
+GRACEFUL_TIMEOUT = int(os.environ.get("GRACEFUL_TIMEOUT", "30"))
+
+
+async def backfill():
+    storage = create_storage()
+    await storage.open()
+    try:
+        await storage.backfill()
+    finally:
+        await storage.close()
+
+
+if __name__ == "__main__":
+    asyncio.run(backfill())
+    # The workers inherit the environment
+    os.environ["BACKFILL_ON_STARTUP"] = "0"
+    os.environ.setdefault(
+        "MONGO_MAX_POOL_SIZE", str(max(1, MONGO_MAX_CONNECTIONS // WORKERS))
+    )
+    if WORKERS > 1:
+        # /metrics then reports the samples of all workers, not only its own
+        os.environ.setdefault(
+            "PROMETHEUS_MULTIPROC_DIR", tempfile.mkdtemp(prefix="metrics-")
+        )
+    uvicorn.run(
+        "main:app",
+        host=HOST,
+        port=PORT,
+        workers=WORKERS,
+        timeout_graceful_shutdown=GRACEFUL_TIMEOUT,
+    )
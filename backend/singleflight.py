@@ -0,0 +1,58 @@
+import asyncio
+from contextlib import asynccontextmanager
+
+
+class SingleFlight:
+    """
+    Run one call per key at a time: callers that ask for a key while its
+    call is in flight wait for the same result, or the same exception.
+    """
+
+    def __init__(self):
+        self.calls = {}
+        self.shared = 0
+
+    async def do(self, key: str, call):
+        task = self.calls.get(key)
+        if task is None:
+            task = asyncio.ensure_future(call())
+            self.calls[key] = task
+            task.add_done_callback(lambda _: self.calls.pop(key, None))
+        else:
+            self.shared += 1
+        # A caller that goes away (client disconnect) does not cancel the
+        # call the others are waiting for
+        return await asyncio.shield(task)
+
+
+class CollectionLimiter:
+    """
+    Cap the number of queries running at once against each collection, so
+    one user's heavy queries cannot hold the whole connection pool.
+    """
+
+    def __init__(self, limit: int):
+        self.limit = limit
+        self.semaphores = {}
+        # Callers holding or waiting on each semaphore, to drop idle ones
+        self.users = {}
+        self.waited = 0
+
+    @asynccontextmanager
+    async def hold(self, collection_name: str):
+        semaphore = self.semaphores.get(collection_name)
+        if semaphore is None:
+            semaphore = self.semaphores[collection_name] = asyncio.Semaphore(
+                self.limit
+            )
+        self.users[collection_name] = self.users.get(collection_name, 0) + 1
+        if semaphore.locked():
+            self.waited += 1
+        try:
+            async with semaphore:
+                yield
+        finally:
+            self.users[collection_name] -= 1
+            if not self.users[collection_name]:
+                del self.users[collection_name]
+                del self.semaphores[collection_name]
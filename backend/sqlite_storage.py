@@ -0,0 +1,695 @@
+"""
+An embedded storage in a single SQLite file, see storage.py.
+
+The expenses of all users share one table keyed by collection, indexed
+for the orders the list routes sort in. Summaries are GROUP BY queries
+over a covering index instead of reads of a rollup, and search uses an
+FTS5 index kept up to date by triggers. Collection objects understand
+the MongoDB filters and updates the routes send: equality, $gt, $gte,
+$lt, $lte, $in, $and and $or; $set, $inc and $setOnInsert.
+
+All calls go through one connection in the thread pool, one at a time.
+WAL mode lets several worker processes share the file. The archive of
+archive.py is MongoDB only.
+"""
+import re
+import sqlite3
+import threading
+from datetime import datetime, timedelta
+
+from bson import ObjectId
+from pymongo import DeleteOne, InsertOne, ReturnDocument, UpdateOne
+from pymongo.errors import BulkWriteError
+from pymongo.results import (
+    BulkWriteResult,
+    DeleteResult,
+    InsertManyResult,
+    InsertOneResult,
+    UpdateResult,
+)
+from starlette.concurrency import run_in_threadpool
+
+from analytics import analytics_from_totals
+from archive import naive_utc
+from changes import TOMBSTONE_COLLECTION, TOMBSTONE_RETENTION_DAYS
+from versions import VERSION_COLLECTION
+
+SQLITE_BUSY_TIMEOUT_MS = 5000
+# Rows fetched at a time when a cursor is iterated
+SQLITE_BATCH_SIZE = 1000
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS expenses (
+    seq INTEGER PRIMARY KEY,
+    id TEXT NOT NULL UNIQUE,
+    collection TEXT NOT NULL,
+    amount REAL NOT NULL,
+    date TEXT NOT NULL,
+    month INTEGER NOT NULL,
+    year INTEGER NOT NULL,
+    category TEXT NOT NULL,
+    description TEXT,
+    created_date TEXT NOT NULL,
+    updated_at TEXT
+);
+CREATE INDEX IF NOT EXISTS expenses_collection_id
+    ON expenses (collection, id);
+CREATE INDEX IF NOT EXISTS expenses_collection_date_id
+    ON expenses (collection, date, id);
+CREATE INDEX IF NOT EXISTS expenses_collection_category_id
+    ON expenses (collection, category, id);
+CREATE INDEX IF NOT EXISTS expenses_collection_updated_at_id
+    ON expenses (collection, updated_at, id);
+-- Covers the summaries, which never read the table itself
+CREATE INDEX IF NOT EXISTS expenses_collection_year_month_category
+    ON expenses (collection, year, month, category, amount);
+
+CREATE VIRTUAL TABLE IF NOT EXISTS expenses_search USING fts5(
+    description, category, content='expenses', content_rowid='seq',
+    tokenize='porter unicode61'
+);
+CREATE TRIGGER IF NOT EXISTS expenses_search_insert AFTER INSERT ON expenses
+BEGIN
+    INSERT INTO expenses_search (rowid, description, category)
+    VALUES (new.seq, new.description, new.category);
+END;
+CREATE TRIGGER IF NOT EXISTS expenses_search_delete AFTER DELETE ON expenses
+BEGIN
+    INSERT INTO expenses_search (expenses_search, rowid, description, category)
+    VALUES ('delete', old.seq, old.description, old.category);
+END;
+CREATE TRIGGER IF NOT EXISTS expenses_search_update AFTER UPDATE ON expenses
+BEGIN
+    INSERT INTO expenses_search (expenses_search, rowid, description, category)
+    VALUES ('delete', old.seq, old.description, old.category);
+    INSERT INTO expenses_search (rowid, description, category)
+    VALUES (new.seq, new.description, new.category);
+END;
+
+CREATE TABLE IF NOT EXISTS tombstones (
+    id TEXT PRIMARY KEY,
+    collection TEXT NOT NULL,
+    updated_at TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS tombstones_collection_updated_at_id
+    ON tombstones (collection, updated_at, id);
+
+CREATE TABLE IF NOT EXISTS versions (
+    id TEXT PRIMARY KEY,
+    version INTEGER NOT NULL
+);
+"""
+
+OPERATORS = {"$gt": ">", "$gte": ">=", "$lt": "<", "$lte": "<="}
+DATE_FIELDS = {"date", "created_date", "updated_at"}
+# A quoted phrase or a word, either one negated by a leading "-"
+SEARCH_TERM = re.compile(r'(-?)"([^"]*)"|(-?)([^\s"]+)')
+
+
+class Table:
+    def __init__(self, name: str, fields, object_ids: bool):
+        self.name = name
+        self.fields = set(fields)
+        # Whether _id holds ObjectIds, stored as their hex string
+        self.object_ids = object_ids
+
+
+EXPENSES = Table(
+    "expenses",
+    [
+        "_id",
+        "collection",
+        "amount",
+        "date",
+        "month",
+        "year",
+        "category",
+        "description",
+        "created_date",
+        "updated_at",
+    ],
+    object_ids=True,
+)
+TOMBSTONES = Table("tombstones", ["_id", "collection", "updated_at"], object_ids=True)
+VERSIONS = Table("versions", ["_id", "version"], object_ids=False)
+
+
+# Helper functions
+def to_sql(value):
+    if isinstance(value, ObjectId):
+        return str(value)
+    if isinstance(value, datetime):
+        # Milliseconds, like BSON dates; a fixed width keeps text order
+        value = naive_utc(value)
+        value = value.replace(microsecond=value.microsecond // 1000 * 1000)
+        return value.isoformat(timespec="microseconds")
+    return value
+
+
+def column(field: str, table: Table, prefix: str = ""):
+    if field not in table.fields:
+        raise ValueError(f"Unsupported field {field} in {table.name}")
+    return prefix + ("id" if field == "_id" else field)
+
+
+def where_clause(query_filter: dict, table: Table, prefix: str = ""):
+    """
+    Translate a MongoDB filter into a WHERE condition and its parameters.
+    """
+    clauses, params = [], []
+    for field, value in query_filter.items():
+        if field in ("$and", "$or"):
+            parts = [where_clause(part, table, prefix) for part in value]
+            joiner = " AND " if field == "$and" else " OR "
+            empty = "1" if field == "$and" else "0"
+            clauses.append(
+                "(" + (joiner.join(f"({sql})" for sql, _ in parts) or empty) + ")"
+            )
+            params.extend(param for _, part_params in parts for param in part_params)
+        elif isinstance(value, dict):
+            name = column(field, table, prefix)
+            for operator, operand in value.items():
+                if operator == "$in":
+                    placeholders = ", ".join("?" * len(operand))
+                    clauses.append(f"{name} IN ({placeholders})")
+                    params.extend(to_sql(item) for item in operand)
+                elif operator in OPERATORS:
+                    clauses.append(f"{name} {OPERATORS[operator]} ?")
+                    params.append(to_sql(operand))
+                else:
+                    raise ValueError(f"Unsupported operator {operator}")
+        elif value is None:
+            clauses.append(f"{column(field, table, prefix)} IS NULL")
+        else:
+            clauses.append(f"{column(field, table, prefix)} = ?")
+            params.append(to_sql(value))
+    return " AND ".join(clauses) or "1", params
+
+
+def apply_update(document: dict, update: dict):
+    document = dict(document)
+    for operator, fields in update.items():
+        if operator == "$set":
+            document.update(fields)
+        elif operator == "$inc":
+            for field, amount in fields.items():
+                document[field] = document.get(field, 0) + amount
+        elif operator != "$setOnInsert":
+            raise ValueError(f"Unsupported update operator {operator}")
+    return document
+
+
+def fts_query(q: str):
+    """
+    Translate a $text search string into an FTS5 query, or None when it
+    has no term to look for.
+
+    As with $text, documents must contain every phrase, or any of the
+    words when there is no phrase, and none of the negated terms.
+    """
+    words, phrases, negated = [], [], []
+    for negated_phrase, phrase, negated_word, word in SEARCH_TERM.findall(q):
+        term = phrase or word
+        if not term.strip():
+            continue
+        quoted = '"' + term.replace('"', '""') + '"'
+        if negated_phrase or negated_word:
+            negated.append(quoted)
+        elif phrase:
+            phrases.append(quoted)
+        else:
+            words.append(quoted)
+    if phrases:
+        query = " AND ".join(phrases)
+    elif words:
+        query = " OR ".join(words)
+    else:
+        return None
+    for term in negated:
+        query = f"({query}) NOT {term}"
+    return query
+
+
+class SQLiteDatabase:
+    """
+    The connection, and collection objects by MongoDB collection name:
+    versions, tombstones, or else the expenses of the named user.
+    """
+
+    def __init__(self, connection):
+        self.connection = connection
+        self.lock = threading.Lock()
+
+    def __getitem__(self, name: str):
+        if name == VERSION_COLLECTION:
+            return SQLiteCollection(self, VERSIONS)
+        if name == TOMBSTONE_COLLECTION:
+            return SQLiteCollection(self, TOMBSTONES)
+        return SQLiteCollection(self, EXPENSES, {"collection": name})
+
+    def call(self, function):
+        with self.lock:
+            return function(self.connection)
+
+    async def run(self, function):
+        return await run_in_threadpool(self.call, function)
+
+    async def rows(self, sql: str, params=()):
+        return await self.run(
+            lambda connection: [
+                dict(row) for row in connection.execute(sql, params).fetchall()
+            ]
+        )
+
+
+def transaction(connection, function):
+    connection.execute("BEGIN IMMEDIATE")
+    try:
+        result = function()
+    except BaseException:
+        connection.execute("ROLLBACK")
+        raise
+    connection.execute("COMMIT")
+    return result
+
+
+class SQLiteCursor:
+    """
+    The part of a Motor cursor the routes use.
+    """
+
+    def __init__(self, collection, query_filter: dict):
+        self.collection = collection
+        self.query_filter = query_filter
+        self.sort_fields = []
+        self.limit_count = 0
+        self.skip_count = 0
+        self.batch = SQLITE_BATCH_SIZE
+
+    def sort(self, key_or_list, direction=1):
+        if isinstance(key_or_list, str):
+            key_or_list = [(key_or_list, direction)]
+        self.sort_fields = list(key_or_list)
+        return self
+
+    def limit(self, limit: int):
+        self.limit_count = limit
+        return self
+
+    def skip(self, skip: int):
+        self.skip_count = skip
+        return self
+
+    def batch_size(self, batch_size: int):
+        self.batch = batch_size
+        return self
+
+    def execute(self, connection, length=None):
+        limit = self.limit_count
+        if length is not None:
+            limit = min(limit, length) if limit else length
+        return self.collection.select(
+            connection, self.query_filter, self.sort_fields, limit, self.skip_count
+        )
+
+    async def to_list(self, length=None):
+        rows = await self.collection.database.run(
+            lambda connection: self.execute(connection, length).fetchall()
+        )
+        return [self.collection.document(row) for row in rows]
+
+    def __aiter__(self):
+        return self.iterate()
+
+    async def iterate(self):
+        database = self.collection.database
+        rows = await database.run(self.execute)
+        while batch := await database.run(lambda _: rows.fetchmany(self.batch)):
+            for row in batch:
+                yield self.collection.document(row)
+
+
+class SQLiteCollection:
+    """
+    One table, or the rows of one user in it, with the Motor collection
+    methods the routes call.
+    """
+
+    def __init__(self, database: SQLiteDatabase, table: Table, scope=None):
+        self.database = database
+        self.table = table
+        self.scope = scope or {}
+        self.name = self.scope.get("collection", table.name)
+
+    def where(self, query_filter=None, prefix: str = ""):
+        return where_clause({**(query_filter or {}), **self.scope}, self.table, prefix)
+
+    def document(self, row):
+        document = {}
+        for field in self.table.fields:
+            value = row["id" if field == "_id" else field]
+            if field == "_id" and self.table.object_ids:
+                value = ObjectId(value)
+            elif field in DATE_FIELDS and value is not None:
+                value = datetime.fromisoformat(value)
+            if field not in self.scope:
+                document[field] = value
+        return document
+
+    def select(self, connection, query_filter, sort_fields=(), limit=0, skip=0):
+        where, params = self.where(query_filter)
+        sql = f"SELECT * FROM {self.table.name} WHERE {where}"
+        if sort_fields:
+            order = ", ".join(
+                f"{column(field, self.table)} {'ASC' if direction == 1 else 'DESC'}"
+                for field, direction in sort_fields
+            )
+            sql += f" ORDER BY {order}"
+        if limit or skip:
+            sql += " LIMIT ? OFFSET ?"
+            params = [*params, limit or -1, skip]
+        return connection.execute(sql, params)
+
+    def insert_document(self, connection, document: dict):
+        if "_id" not in document and self.table.object_ids:
+            document["_id"] = ObjectId()
+        values = {**document, **self.scope}
+        names = [column(field, self.table) for field in values]
+        placeholders = ", ".join("?" * len(names))
+        connection.execute(
+            f"INSERT INTO {self.table.name} ({', '.join(names)})"
+            f" VALUES ({placeholders})",
+            [to_sql(value) for value in values.values()],
+        )
+
+    def replace_document(self, connection, document: dict):
+        fields = [field for field in document if field != "_id"]
+        assignments = ", ".join(f"{column(field, self.table)} = ?" for field in fields)
+        connection.execute(
+            f"UPDATE {self.table.name} SET {assignments} WHERE id = ?",
+            [to_sql(document[field]) for field in fields] + [to_sql(document["_id"])],
+        )
+
+    def delete_document(self, connection, document: dict):
+        connection.execute(
+            f"DELETE FROM {self.table.name} WHERE id = ?", [to_sql(document["_id"])]
+        )
+
+    def first(self, connection, query_filter):
+        row = self.select(connection, query_filter, limit=1).fetchone()
+        return None if row is None else self.document(row)
+
+    def update_document(self, connection, query_filter, update, upsert=False):
+        """
+        Returns:
+            tuple: The document before and after the update, None for a
+            missing document.
+        """
+        before = self.first(connection, query_filter)
+        if before is None:
+            if not upsert:
+                return None, None
+            # An upsert starts from the equality conditions of the filter
+            after = {
+                field: value
+                for field, value in query_filter.items()
+                if not field.startswith("$") and not isinstance(value, dict)
+            }
+            after = apply_update({**after, **update.get("$setOnInsert", {})}, update)
+            self.insert_document(connection, after)
+            return None, after
+        after = apply_update(before, update)
+        if after != before:
+            self.replace_document(connection, after)
+        return before, after
+
+    def write(self, connection, request, counts):
+        if isinstance(request, InsertOne):
+            self.insert_document(connection, request._doc)
+            counts["nInserted"] += 1
+        elif isinstance(request, UpdateOne):
+            before, after = self.update_document(
+                connection, request._filter, request._doc, request._upsert
+            )
+            if before is not None:
+                counts["nMatched"] += 1
+                counts["nModified"] += int(after != before)
+            elif after is not None:
+                counts["nUpserted"] += 1
+                counts["upserted"].append({"index": None, "_id": after.get("_id")})
+        elif isinstance(request, DeleteOne):
+            document = self.first(connection, request._filter)
+            if document is not None:
+                self.delete_document(connection, document)
+                counts["nRemoved"] += 1
+        else:
+            raise TypeError(f"Unsupported bulk operation {request!r}")
+
+    def find(self, query_filter=None, projection=None):
+        # Projections are ignored, rows are small
+        return SQLiteCursor(self, query_filter or {})
+
+    async def find_one(self, query_filter=None, projection=None):
+        documents = await self.find(query_filter).limit(1).to_list(length=None)
+        return documents[0] if documents else None
+
+    async def insert_one(self, document: dict):
+        await self.database.run(
+            lambda connection: transaction(
+                connection, lambda: self.insert_document(connection, document)
+            )
+        )
+        return InsertOneResult(document["_id"], True)
+
+    async def insert_many(self, documents, ordered: bool = True):
+        await self.bulk_write(
+            [InsertOne(document) for document in documents], ordered=ordered
+        )
+        return InsertManyResult([document["_id"] for document in documents], True)
+
+    async def bulk_write(self, requests, ordered: bool = True):
+        """
+        Run the operations in one transaction, each in a savepoint so a
+        failing one is reported like MongoDB does, without undoing the
+        others.
+        """
+        counts = {
+            "writeErrors": [],
+            "writeConcernErrors": [],
+            "nInserted": 0,
+            "nUpserted": 0,
+            "nMatched": 0,
+            "nModified": 0,
+            "nRemoved": 0,
+            "upserted": [],
+        }
+
+        def write_all(connection):
+            for index, request in enumerate(requests):
+                connection.execute("SAVEPOINT operation")
+                try:
+                    self.write(connection, request, counts)
+                except sqlite3.IntegrityError as e:
+                    connection.execute("ROLLBACK TO operation")
+                    # 11000 is MongoDB's duplicate key error
+                    counts["writeErrors"].append(
+                        {"index": index, "code": 11000, "errmsg": str(e)}
+                    )
+                    if ordered:
+                        break
+                finally:
+                    connection.execute("RELEASE operation")
+
+        await self.database.run(
+            lambda connection: transaction(connection, lambda: write_all(connection))
+        )
+        if counts["writeErrors"]:
+            raise BulkWriteError(counts)
+        return BulkWriteResult(counts, True)
+
+    async def update_one(self, query_filter, update, upsert: bool = False):
+        before, after = await self.database.run(
+            lambda connection: transaction(
+                connection,
+                lambda: self.update_document(connection, query_filter, update, upsert),
+            )
+        )
+        if before is None:
+            upserted = None if after is None else after.get("_id")
+            result = {"n": int(after is not None), "nModified": 0, "upserted": upserted}
+        else:
+            result = {"n": 1, "nModified": int(after != before), "upserted": None}
+        return UpdateResult(result, True)
+
+    async def find_one_and_update(
+        self, query_filter, update, return_document=ReturnDocument.BEFORE
+    ):
+        before, after = await self.database.run(
+            lambda connection: transaction(
+                connection,
+                lambda: self.update_document(connection, query_filter, update),
+            )
+        )
+        return after if return_document == ReturnDocument.AFTER else before
+
+    async def find_one_and_delete(self, query_filter):
+        def delete(connection):
+            document = self.first(connection, query_filter)
+            if document is not None:
+                self.delete_document(connection, document)
+            return document
+
+        return await self.database.run(
+            lambda connection: transaction(connection, lambda: delete(connection))
+        )
+
+    async def delete_many(self, query_filter):
+        where, params = self.where(query_filter)
+        cursor = await self.database.run(
+            lambda connection: transaction(
+                connection,
+                lambda: connection.execute(
+                    f"DELETE FROM {self.table.name} WHERE {where}", params
+                ),
+            )
+        )
+        return DeleteResult({"n": cursor.rowcount}, True)
+
+    async def count_documents(self, query_filter):
+        where, params = self.where(query_filter)
+        rows = await self.database.rows(
+            f"SELECT COUNT(*) AS count FROM {self.table.name} WHERE {where}", params
+        )
+        return rows[0]["count"]
+
+    async def estimated_document_count(self):
+        return await self.count_documents({})
+
+    async def drop(self):
+        await self.delete_many({})
+
+    async def create_indexes(self, indexes):
+        # The schema has the indexes
+        return []
+
+
+class SQLiteStorage:
+    """
+    Expenses in a SQLite file, see storage.py for the methods.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.db = None
+
+    async def open(self):
+        connection = sqlite3.connect(
+            self.path, check_same_thread=False, isolation_level=None
+        )
+        connection.row_factory = sqlite3.Row
+        connection.execute("PRAGMA journal_mode=WAL")
+        connection.execute("PRAGMA synchronous=NORMAL")
+        connection.execute(f"PRAGMA busy_timeout={SQLITE_BUSY_TIMEOUT_MS}")
+        connection.executescript(SCHEMA)
+        self.db = SQLiteDatabase(connection)
+
+    async def close(self):
+        self.db.connection.close()
+
+    async def ping(self):
+        await self.db.rows("SELECT 1")
+
+    async def backfill(self):
+        # Tombstones expire here, there is no TTL index
+        horizon = datetime.now() - timedelta(days=TOMBSTONE_RETENTION_DAYS)
+        await self.db[TOMBSTONE_COLLECTION].delete_many(
+            {"updated_at": {"$lt": horizon}}
+        )
+
+    async def expenses(self, collection_name: str, provision: bool = False):
+        # The table is shared, there is nothing to set up
+        return self.db[collection_name]
+
+    async def apply_rollup(self, collection_name: str, added=(), removed=()):
+        # Summaries group the expenses themselves
+        pass
+
+    async def rebuild_rollups(self, collection_name: str):
+        return 0
+
+    async def sample_ids(self, collection_name: str, size: int):
+        rows = await self.db.rows(
+            "SELECT id FROM expenses WHERE collection = ? ORDER BY random() LIMIT ?",
+            (collection_name, size),
+        )
+        return [ObjectId(row["id"]) for row in rows]
+
+    async def summary(self, collection_name: str, month=None, year=None):
+        sql = (
+            "SELECT year, month, category, SUM(amount) AS total_amount"
+            " FROM expenses WHERE collection = ?"
+        )
+        params = [collection_name]
+        if month:
+            sql += " AND month = ?"
+            params.append(month)
+        if year:
+            sql += " AND year = ?"
+            params.append(year)
+        sql += " GROUP BY year, month, category ORDER BY year, month, category"
+        return await self.db.rows(sql, params)
+
+    async def summary_periods(self, collection_name: str):
+        months = await self.db.rows(
+            "SELECT month, year, SUM(amount) AS total_amount FROM expenses"
+            " WHERE collection = ? GROUP BY year, month ORDER BY year, month",
+            (collection_name,),
+        )
+        return {"categories": await self.summary(collection_name), "months": months}
+
+    async def months(self, collection_name: str):
+        return await self.db.rows(
+            "SELECT DISTINCT month, year FROM expenses WHERE collection = ?"
+            " ORDER BY year, month",
+            (collection_name,),
+        )
+
+    async def analytics(self, collection_name: str, top: int):
+        totals = await self.db.rows(
+            "SELECT year, month, category, SUM(amount) AS total_amount,"
+            " COUNT(*) AS count FROM expenses WHERE collection = ?"
+            " GROUP BY year, month, category",
+            (collection_name,),
+        )
+        return analytics_from_totals(totals, top)
+
+    async def search(
+        self, collection_name: str, q: str, query_filter, offset: int, limit: int
+    ):
+        match = fts_query(q)
+        if match is None:
+            return []
+        expenses = self.db[collection_name]
+        where, params = expenses.where(query_filter, prefix="e.")
+        # Category matches weigh twice as much, like in the MongoDB text index
+        sql = (
+            "SELECT e.* FROM expenses_search"
+            " JOIN expenses AS e ON e.seq = expenses_search.rowid"
+            f" WHERE expenses_search MATCH ? AND {where}"
+            " ORDER BY bm25(expenses_search, 1.0, 2.0), e.id LIMIT ? OFFSET ?"
+        )
+        rows = await self.db.run(
+            lambda connection: connection.execute(
+                sql, [match, *params, limit, offset]
+            ).fetchall()
+        )
+        return [expenses.document(row) for row in rows]
+
+    async def archived_years(self, collection_name: str):
+        return []
+
+    def archive(self, collection_name: str):
+        return None
+
+    async def archived_year_totals(self, collection_name: str):
+        return []
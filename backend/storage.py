@@ -0,0 +1,223 @@
+"""
+Where the API keeps expenses: MongoDB, or an embedded SQLite file.
+
+STORAGE=mongo (the default) uses the MongoDB server of database.py.
+STORAGE=sqlite keeps everything in the SQLite file at SQLITE_PATH, for
+single-node deployments and tests that should not need a server.
+
+Both storages offer the same methods to the routes:
+
+- open(), close() and ping() manage the connection; backfill() brings
+  data written before indexes, rollups and tombstones were managed up
+  to date.
+- db maps the version and tombstone collection names of versions.py and
+  changes.py to collection objects.
+- expenses(collection_name) returns the expenses of a user as a collection
+  object with the Motor methods the routes call (find, find_one, insert,
+  find_one_and_update/delete, bulk_write, ...). Routes that insert pass
+  provision=True to have the collection set up first.
+- summary(), summary_periods(), months() and analytics() compute the
+  summaries; search() runs a full-text search.
+- apply_rollup() and rebuild_rollups() maintain whatever the summaries
+  read from.
+- archived_years(), archive() and archived_year_totals() expose the
+  archive of archive.py, which only MongoDB has.
+"""
+import os
+
+from analytics import analytics_pipeline
+from archive import (
+    ARCHIVED_YEAR_PROJECTION,
+    ARCHIVED_YEARS_COLLECTION,
+    ArchivedExpenses,
+    archived_years,
+)
+from changes import backfill_changes
+from database import DATABASE_NAME, create_client
+from indexes import backfill_indexes, ensure_indexes
+from rollups import (
+    ROLLUP_COLLECTION,
+    ROLLUP_INDEXES,
+    apply_rollup,
+    backfill_rollups,
+    rebuild_rollups,
+    rollup_match,
+)
+from tenancy import expense_collection
+
+STORAGE = os.environ.get("STORAGE", "mongo")
+SQLITE_PATH = os.environ.get("SQLITE_PATH", "expenses.db")
+
+ROLLUP_SORT = [("year", 1), ("month", 1), ("category", 1)]
+
+
+class MongoStorage:
+    """
+    Expenses in MongoDB, one collection per user (or the shared one, see
+    tenancy.py), summarized from the rollup collection.
+    """
+
+    def __init__(self, client=None, database_name: str = DATABASE_NAME):
+        self.client = client
+        self.database_name = database_name
+        self.db = None if client is None else client[database_name]
+
+    async def open(self):
+        if self.client is None:
+            self.client = create_client()
+            self.db = self.client[self.database_name]
+        # Fails if no server answers within the selection timeout
+        await self.ping()
+
+    async def close(self):
+        self.client.close()
+
+    async def ping(self):
+        await self.client.admin.command("ping")
+
+    async def backfill(self):
+        await backfill_indexes(self.db)
+        await backfill_rollups(self.db)
+        await backfill_changes(self.db)
+
+    async def expenses(self, collection_name: str, provision: bool = False):
+        collection = expense_collection(self.db, collection_name)
+        if provision:
+            # create_indexes creates the collection: reads must not
+            await ensure_indexes(collection)
+        return collection
+
+    async def apply_rollup(self, collection_name: str, added=(), removed=()):
+        await apply_rollup(self.db, collection_name, added=added, removed=removed)
+
+    async def rebuild_rollups(self, collection_name: str):
+        await self.db[ROLLUP_COLLECTION].create_indexes(ROLLUP_INDEXES)
+        return await rebuild_rollups(self.db, collection_name)
+
+    async def sample_ids(self, collection_name: str, size: int):
+        cursor = expense_collection(self.db, collection_name).aggregate(
+            [{"$sample": {"size": size}}, {"$project": {"_id": 1}}]
+        )
+        return [expense["_id"] for expense in await cursor.to_list(length=None)]
+
+    async def summary(self, collection_name: str, month=None, year=None):
+        """
+        The total of every month and category, oldest first.
+        """
+        cursor = (
+            self.db[ROLLUP_COLLECTION]
+            .find(
+                rollup_match(collection_name, month, year),
+                {"_id": 0, "month": 1, "year": 1, "category": 1, "total_amount": 1},
+            )
+            .sort(ROLLUP_SORT)
+        )
+        return await cursor.to_list(length=None)
+
+    async def summary_periods(self, collection_name: str):
+        """
+        The totals per month and category and the totals per month, from a
+        single aggregation.
+        """
+        pipeline = [
+            {"$match": rollup_match(collection_name)},
+            {
+                "$facet": {
+                    "categories": [
+                        {
+                            "$project": {
+                                "_id": 0,
+                                "month": 1,
+                                "year": 1,
+                                "category": 1,
+                                "total_amount": 1,
+                            }
+                        },
+                        {"$sort": {"year": 1, "month": 1, "category": 1}},
+                    ],
+                    "months": [
+                        {
+                            "$group": {
+                                "_id": {"month": "$month", "year": "$year"},
+                                "total_amount": {"$sum": "$total_amount"},
+                            }
+                        },
+                        {
+                            "$project": {
+                                "_id": 0,
+                                "month": "$_id.month",
+                                "year": "$_id.year",
+                                "total_amount": 1,
+                            }
+                        },
+                        {"$sort": {"year": 1, "month": 1}},
+                    ],
+                }
+            },
+        ]
+        cursor = self.db[ROLLUP_COLLECTION].aggregate(pipeline)
+        result = await cursor.to_list(length=1)
+        if not result:
+            return {"categories": [], "months": []}
+        return result[0]
+
+    async def months(self, collection_name: str):
+        """
+        The months that have expenses, oldest first.
+        """
+        pipeline = [
+            {"$match": rollup_match(collection_name)},
+            {"$group": {"_id": {"month": "$month", "year": "$year"}}},
+            {"$project": {"month": "$_id.month", "year": "$_id.year", "_id": 0}},
+            {"$sort": {"year": 1, "month": 1}},
+        ]
+        cursor = self.db[ROLLUP_COLLECTION].aggregate(pipeline)
+        return await cursor.to_list(length=None)
+
+    async def analytics(self, collection_name: str, top: int):
+        cursor = self.db[ROLLUP_COLLECTION].aggregate(
+            analytics_pipeline(collection_name, top)
+        )
+        facets = await cursor.to_list(length=None)
+        return facets[0]
+
+    async def search(
+        self, collection_name: str, q: str, query_filter, offset: int, limit: int
+    ):
+        """
+        Expenses matching a $text search, best first, with the text index of
+        indexes.py.
+        """
+        score = {"$meta": "textScore"}
+        expenses_collection = await self.expenses(collection_name)
+        cursor = (
+            expenses_collection.find(
+                {"$text": {"$search": q}, **query_filter}, {"score": score}
+            )
+            .sort([("score", score), ("_id", 1)])
+            .skip(offset)
+            .limit(limit)
+        )
+        return await cursor.to_list(length=None)
+
+    async def archived_years(self, collection_name: str):
+        return await archived_years(self.db, collection_name)
+
+    def archive(self, collection_name: str):
+        return ArchivedExpenses(self.db, collection_name)
+
+    async def archived_year_totals(self, collection_name: str):
+        cursor = (
+            self.db[ARCHIVED_YEARS_COLLECTION]
+            .find({"collection": collection_name}, ARCHIVED_YEAR_PROJECTION)
+            .sort("year", 1)
+        )
+        return await cursor.to_list(length=None)
+
+
+def create_storage():
+    if STORAGE == "sqlite":
+        from sqlite_storage import SQLiteStorage
+
+        return SQLiteStorage(SQLITE_PATH)
+    return MongoStorage()
@@ -0,0 +1,210 @@
+"""
+Where the expenses of a user live.
+
+With TENANCY=collection (the default) every user has a collection named
+after them. With TENANCY=shared all expenses are kept in SHARED_COLLECTION
+and tagged with the user in TENANT_FIELD, which every index leads with.
+Routes get a collection object that behaves the same in both modes.
+
+Copy per-user collections into the shared one, in batches:
+
+    python tenancy.py [--drop] [collection_name ...]
+"""
+import argparse
+import asyncio
+import os
+
+from pymongo import IndexModel
+from pymongo.errors import BulkWriteError
+
+TENANCY = os.environ.get("TENANCY", "collection")
+# Leading underscore: user collection names cannot clash with it
+SHARED_COLLECTION = os.environ.get("SHARED_COLLECTION", "_expenses")
+TENANT_FIELD = "user_id"
+MIGRATION_BATCH_SIZE = 5000
+
+
+def is_expense_collection(name: str):
+    # Collections starting with an underscore hold shared or derived data
+    return not name.startswith(("system.", "_"))
+
+
+class TenantCollection:
+    """
+    The expenses of one user in the shared collection.
+
+    Filters, pipelines and written documents are scoped to the user, and
+    index keys are prefixed with TENANT_FIELD. Cursors and results are the
+    ones of the underlying Motor collection.
+    """
+
+    def __init__(self, collection, tenant: str):
+        self.collection = collection
+        self.tenant = tenant
+        # Indexes are provisioned once for all users
+        self.name = collection.name
+
+    def scope(self, query_filter=None):
+        return {**(query_filter or {}), TENANT_FIELD: self.tenant}
+
+    def stamp(self, document):
+        document[TENANT_FIELD] = self.tenant
+        return document
+
+    def find(self, query_filter=None, *args, **kwargs):
+        return self.collection.find(self.scope(query_filter), *args, **kwargs)
+
+    async def find_one(self, query_filter=None, *args, **kwargs):
+        return await self.collection.find_one(
+            self.scope(query_filter), *args, **kwargs
+        )
+
+    async def find_one_and_delete(self, query_filter, *args, **kwargs):
+        return await self.collection.find_one_and_delete(
+            self.scope(query_filter), *args, **kwargs
+        )
+
+    async def find_one_and_update(self, query_filter, update, *args, **kwargs):
+        return await self.collection.find_one_and_update(
+            self.scope(query_filter), update, *args, **kwargs
+        )
+
+    async def update_many(self, query_filter, update, *args, **kwargs):
+        return await self.collection.update_many(
+            self.scope(query_filter), update, *args, **kwargs
+        )
+
+    async def delete_many(self, query_filter, *args, **kwargs):
+        return await self.collection.delete_many(
+            self.scope(query_filter), *args, **kwargs
+        )
+
+    async def count_documents(self, query_filter, *args, **kwargs):
+        return await self.collection.count_documents(
+            self.scope(query_filter), *args, **kwargs
+        )
+
+    async def estimated_document_count(self, **kwargs):
+        return await self.collection.count_documents(self.scope(), **kwargs)
+
+    async def drop(self):
+        # Only the documents of this user, the collection is shared
+        await self.delete_many({})
+
+    async def insert_one(self, document, *args, **kwargs):
+        return await self.collection.insert_one(self.stamp(document), *args, **kwargs)
+
+    async def insert_many(self, documents, *args, **kwargs):
+        documents = [self.stamp(document) for document in documents]
+        return await self.collection.insert_many(documents, *args, **kwargs)
+
+    async def bulk_write(self, requests, *args, **kwargs):
+        # The operations keep their document and filter privately, they are
+        # scoped in place as the dicts belong to the caller
+        for request in requests:
+            if hasattr(request, "_filter"):
+                request._filter[TENANT_FIELD] = self.tenant
+            else:
+                self.stamp(request._doc)
+        return await self.collection.bulk_write(requests, *args, **kwargs)
+
+    def aggregate(self, pipeline, *args, **kwargs):
+        pipeline = [{"$match": self.scope()}, *pipeline]
+        return self.collection.aggregate(pipeline, *args, **kwargs)
+
+    async def create_indexes(self, indexes, *args, **kwargs):
+        indexes = [tenant_index(index) for index in indexes]
+        return await self.collection.create_indexes(indexes, *args, **kwargs)
+
+
+def tenant_index(index: IndexModel):
+    document = dict(index.document)
+    keys = [(TENANT_FIELD, 1), *document.pop("key").items()]
+    document["name"] = f"{TENANT_FIELD}_{document['name']}"
+    return IndexModel(keys, **document)
+
+
+def expense_collection(db, collection_name: str):
+    """
+    The expenses of a user, in either tenancy mode.
+    """
+    if TENANCY == "shared":
+        return TenantCollection(db[SHARED_COLLECTION], collection_name)
+    return db[collection_name]
+
+
+async def expense_collection_names(db):
+    """
+    The names of all users with expenses, in either tenancy mode.
+    """
+    if TENANCY == "shared":
+        return sorted(await db[SHARED_COLLECTION].distinct(TENANT_FIELD))
+    names = await db.list_collection_names()
+    return [name for name in names if is_expense_collection(name)]
+
+
+async def migrate_collection(db, collection_name: str, drop: bool = False):
+    """
+    Copy a per-user collection into the shared one, keeping the ids.
+
+    Copies that were already made are skipped, so an interrupted migration
+    can be run again.
+
+    Returns:
+        int: The number of expenses the user has in the shared collection.
+    """
+    source = db[collection_name]
+    target = TenantCollection(db[SHARED_COLLECTION], collection_name)
+    batch = []
+    async for expense in source.find().sort("_id"):
+        batch.append(expense)
+        if len(batch) == MIGRATION_BATCH_SIZE:
+            await copy_batch(target, batch)
+            batch = []
+    if batch:
+        await copy_batch(target, batch)
+
+    copied = await target.count_documents({})
+    if copied != await source.count_documents({}):
+        raise RuntimeError(f"{collection_name} was written during its migration")
+    if drop:
+        await source.drop()
+    return copied
+
+
+async def copy_batch(target, batch):
+    try:
+        await target.insert_many(batch, ordered=False)
+    except BulkWriteError as e:
+        # 11000 is a duplicate key: copied by an earlier run
+        errors = e.details["writeErrors"]
+        if any(error["code"] != 11000 for error in errors):
+            raise
+
+
+if __name__ == "__main__":
+    from database import DATABASE_NAME, create_client
+    from indexes import EXPENSE_INDEXES
+
+    parser = argparse.ArgumentParser(prog="python tenancy.py")
+    parser.add_argument("collection_names", nargs="*")
+    parser.add_argument(
+        "--drop", action="store_true", help="drop each collection once copied"
+    )
+    args = parser.parse_args()
+    db = create_client()[DATABASE_NAME]
+
+    async def migrate(names, drop):
+        shared = db[SHARED_COLLECTION]
+        await shared.create_indexes([tenant_index(index) for index in EXPENSE_INDEXES])
+        if not names:
+            names = [
+                name
+                for name in await db.list_collection_names()
+                if is_expense_collection(name)
+            ]
+        for name in names:
+            copied = await migrate_collection(db, name, drop)
+            print(f"Copied {copied} expenses of {name}")
+
+    asyncio.run(migrate(args.collection_names, args.drop))
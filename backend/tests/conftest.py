@@ -0,0 +1,96 @@
+"""
+Every test that takes client runs once per storage: MongoDB (the
+mongomock-motor stand-in) and SQLite, with the same expected results.
+"""
+import asyncio
+
+import pytest
+from fastapi.testclient import TestClient
+from mongomock_motor import AsyncMongoMockClient
+
+import main
+import tenancy
+from cache import create_cache
+from sqlite_storage import SQLiteStorage
+from storage import MongoStorage
+
+USER = {"collection_name": "alice"}
+
+EXPENSES = [
+    {
+        "amount": 800,
+        "category": "rent",
+        "date": "2024-01-01T00:00:00",
+        "description": "January rent",
+    },
+    {
+        "amount": 12.5,
+        "category": "food",
+        "date": "2024-01-05T00:00:00",
+        "description": "groceries at the market",
+    },
+    {
+        "amount": 800,
+        "category": "rent",
+        "date": "2024-02-01T00:00:00",
+        "description": "February rent",
+    },
+    {
+        "amount": 30,
+        "category": "fun",
+        "date": "2024-02-10T00:00:00",
+        "description": "cinema tickets",
+    },
+    {
+        "amount": 7.5,
+        "category": "food",
+        "date": "2024-02-12T00:00:00",
+        "description": "grocery run",
+    },
+    {
+        "amount": 45,
+        "category": "fun",
+        "date": "2024-03-03T00:00:00",
+        "description": "concert",
+    },
+]
+
+
+@pytest.fixture(params=["mongo", "mongo-shared", "sqlite"])
+def storage(request, tmp_path, monkeypatch):
+    if request.param.startswith("mongo"):
+        storage = MongoStorage(AsyncMongoMockClient(), "expenses")
+        # Every user's expenses in one collection, as with TENANCY=shared
+        if request.param == "mongo-shared":
+            monkeypatch.setattr(tenancy, "TENANCY", "shared")
+    else:
+        storage = SQLiteStorage(str(tmp_path / "expenses.db"))
+    asyncio.run(storage.open())
+    monkeypatch.setattr(main, "storage", storage)
+    # Results cached for one storage must not answer for the other
+    monkeypatch.setattr(main, "result_cache", create_cache())
+    yield storage
+    asyncio.run(storage.close())
+
+
+@pytest.fixture
+def client(storage):
+    # Not entered: the lifespan would open the storage of the environment
+    return TestClient(main.app)
+
+
+@pytest.fixture
+def expenses(client):
+    """
+    EXPENSES created in alice's collection, as returned by the API.
+    """
+    created = []
+    for expense in EXPENSES:
+        response = client.post("/expenses/", params=USER, json=expense)
+        assert response.status_code == 200, response.text
+        created.append(response.json())
+    return created
+
+
+def amounts(expenses):
+    return [expense["amount"] for expense in expenses]
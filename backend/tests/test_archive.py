@@ -0,0 +1,124 @@
+import asyncio
+
+import pytest
+from bson import ObjectId
+
+from archive import (
+    ARCHIVE_COLLECTION,
+    ARCHIVE_USER_FIELD,
+    archive_year,
+    archived_document,
+    move_batch,
+)
+from conftest import EXPENSES, USER, amounts
+from storage import MongoStorage
+from tenancy import expense_collection
+
+# mongomock has no time-series collections: the archive is left to be
+# created as a plain collection on first insert, as ensure_archive is not run
+OLD_EXPENSES = [
+    {**expense, "date": expense["date"].replace("2024", "2023")}
+    for expense in EXPENSES[:3]
+]
+
+
+@pytest.fixture
+def mongo(storage):
+    if not isinstance(storage, MongoStorage):
+        pytest.skip("only MongoDB has an archive")
+    return storage
+
+
+@pytest.fixture
+def old_expenses(client, mongo, expenses):
+    """
+    OLD_EXPENSES created in alice's collection, as returned by the API.
+    """
+    created = []
+    for expense in OLD_EXPENSES:
+        response = client.post("/expenses/", params=USER, json=expense)
+        assert response.status_code == 200, response.text
+        created.append(response.json())
+    return created
+
+
+def archive_ids(mongo):
+    return asyncio.run(
+        mongo.db[ARCHIVE_COLLECTION].distinct("_id", {ARCHIVE_USER_FIELD: "alice"})
+    )
+
+
+def test_lists_merge_hot_and_archived_expenses(client, mongo, old_expenses):
+    assert asyncio.run(archive_year(mongo.db, "alice", 2023)) == len(OLD_EXPENSES)
+    assert len(archive_ids(mongo)) == len(OLD_EXPENSES)
+
+    listed = client.get("/expenses/", params={**USER, "start": "2023-01-01"}).json()
+    assert amounts(listed) == amounts(old_expenses) + [800, 12.5, 800, 30, 7.5, 45]
+    listed = client.get("/expenses/", params={**USER, "start": "2024-01-01"}).json()
+    assert amounts(listed) == [800, 12.5, 800, 30, 7.5, 45]
+
+    params = {**USER, "start": "2023-01-01", "limit": 4}
+    pages = []
+    while True:
+        response = client.get("/expenses/", params=params)
+        pages.append(amounts(response.json()))
+        if "x-next-cursor" not in response.headers:
+            break
+        params["cursor"] = response.headers["x-next-cursor"]
+    assert pages == [[800, 12.5, 800, 800], [12.5, 800, 30, 7.5], [45]]
+
+    archived = client.get(f"/expenses/{old_expenses[0]['id']}", params=USER)
+    assert archived.json() == old_expenses[0]
+
+
+def test_archived_expenses_are_read_only(client, mongo, old_expenses):
+    asyncio.run(archive_year(mongo.db, "alice", 2023))
+    expense_id = old_expenses[1]["id"]
+    update = {**OLD_EXPENSES[1], "amount": 20}
+    response = client.put(f"/expenses/{expense_id}", params=USER, json=update)
+    assert response.status_code == 409
+    assert client.delete(f"/expenses/{expense_id}", params=USER).status_code == 409
+    assert client.get(f"/expenses/{expense_id}", params=USER).json()["amount"] == 12.5
+
+
+def test_move_batch_drops_copies_of_expenses_written_meanwhile(
+    client, mongo, old_expenses
+):
+    collection = expense_collection(mongo.db, "alice")
+    ids = [ObjectId(expense["id"]) for expense in old_expenses]
+    batch = asyncio.run(collection.find({"_id": {"$in": ids}}).to_list(length=None))
+
+    edited, deleted = old_expenses[0]["id"], old_expenses[1]["id"]
+    update = {**OLD_EXPENSES[0], "amount": 900}
+    assert client.put(f"/expenses/{edited}", params=USER, json=update).is_success
+    assert client.delete(f"/expenses/{deleted}", params=USER).is_success
+
+    assert asyncio.run(move_batch(mongo.db, collection, "alice", batch)) == 1
+    assert archive_ids(mongo) == [ids[2]]
+    # The edited expense stays hot for the next batch to read again
+    response = client.get(f"/expenses/{edited}", params=USER)
+    assert response.json()["amount"] == 900
+    assert client.get(f"/expenses/{deleted}", params=USER).status_code == 404
+
+
+def test_archive_year_can_be_run_again(client, mongo, old_expenses):
+    # A run interrupted after copying its first expense
+    collection = expense_collection(mongo.db, "alice")
+    first = asyncio.run(collection.find_one({"_id": ObjectId(old_expenses[0]["id"])}))
+    asyncio.run(
+        mongo.db[ARCHIVE_COLLECTION].insert_one(archived_document("alice", first))
+    )
+
+    assert asyncio.run(archive_year(mongo.db, "alice", 2023)) == len(OLD_EXPENSES)
+    assert asyncio.run(archive_year(mongo.db, "alice", 2023)) == 0
+    assert sorted(archive_ids(mongo)) == sorted(
+        ObjectId(expense["id"]) for expense in old_expenses
+    )
+    archive_count = asyncio.run(
+        mongo.db[ARCHIVE_COLLECTION].count_documents({ARCHIVE_USER_FIELD: "alice"})
+    )
+    assert archive_count == len(OLD_EXPENSES)
+
+    years = client.get("/expenses/archive", params=USER).json()
+    assert [(year["year"], year["count"]) for year in years] == [(2023, 3)]
+    assert years[0]["total_amount"] == 1612.5
@@ -0,0 +1,69 @@
+import asyncio
+
+import fakeredis
+
+from cache import LocalBackend, RedisBackend, ResultCache
+from conftest import EXPENSES, USER
+
+
+def test_writes_invalidate_cached_results(client, expenses):
+    summary = client.get("/expenses/summary/", params=USER).json()
+    assert client.get("/expenses/summary/", params=USER).json() == summary
+    stats = client.get("/cache/stats").json()
+    assert (stats["hits"], stats["misses"]) == (1, 1)
+
+    created = {**EXPENSES[0], "category": "travel"}
+    client.post("/expenses/", params=USER, json=created)
+    summary = client.get("/expenses/summary/", params=USER).json()
+    assert "travel" in [row["category"] for row in summary]
+    stats = client.get("/cache/stats").json()
+    assert (stats["hits"], stats["misses"]) == (1, 2)
+
+
+def test_identical_misses_share_one_computation():
+    cache = ResultCache(LocalBackend(maxsize=16, ttl=60))
+    calls = []
+
+    async def compute():
+        calls.append(1)
+        # Yield so the other readers arrive while this one is in flight
+        await asyncio.sleep(0.01)
+        return {"total": 42}
+
+    async def read_together():
+        reads = [
+            cache.get_or_compute("alice", {"route": "summary"}, compute)
+            for _ in range(5)
+        ]
+        return await asyncio.gather(*reads)
+
+    assert asyncio.run(read_together()) == [{"total": 42}] * 5
+    assert len(calls) == 1
+    stats = asyncio.run(cache.stats())
+    assert (stats["misses"], stats["coalesced"]) == (5, 4)
+
+
+def test_redis_backend():
+    calls = []
+
+    async def compute():
+        calls.append(1)
+        return [{"total": len(calls)}]
+
+    async def run():
+        client = fakeredis.aioredis.FakeRedis()
+        # A sub-second TTL must not round down to no expiry at all
+        cache = ResultCache(RedisBackend(None, ttl=0.5, client=client))
+        first = await cache.get_or_compute("alice", {"route": "summary"}, compute)
+        again = await cache.get_or_compute("alice", {"route": "summary"}, compute)
+        assert again == first
+        keys = await client.keys(RedisBackend.prefix + "[[]*")
+        assert len(keys) == 1 and 0 < await client.pttl(keys[0]) <= 500
+
+        await cache.invalidate("alice")
+        second = await cache.get_or_compute("alice", {"route": "summary"}, compute)
+        assert second == [{"total": 2}]
+        return await cache.stats()
+
+    stats = asyncio.run(run())
+    assert (stats["backend"], stats["hits"], stats["misses"]) == ("redis", 1, 2)
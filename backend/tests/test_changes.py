@@ -0,0 +1,86 @@
+import base64
+import csv
+import io
+from datetime import datetime, timedelta
+
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+import main
+from conftest import EXPENSES, USER, amounts
+
+
+def test_change_feed(client, expenses):
+    feed = client.get("/expenses/changes", params=USER).json()
+    assert feed["reset"] and not feed["has_more"]
+    assert sorted(amounts(feed["changes"])) == sorted(amounts(expenses))
+
+    update = {**EXPENSES[0], "amount": 900}
+    client.put(f"/expenses/{expenses[0]['id']}", params=USER, json=update)
+    client.delete(f"/expenses/{expenses[1]['id']}", params=USER)
+    feed = client.get(
+        "/expenses/changes", params={**USER, "since": feed["token"]}
+    ).json()
+    assert not feed["reset"]
+    # The overlap reads back recent writes, clients merge them by id
+    changed = {expense["id"]: expense["amount"] for expense in feed["changes"]}
+    assert changed[expenses[0]["id"]] == 900
+    assert expenses[1]["id"] not in changed
+    assert feed["deleted"] == [expenses[1]["id"]]
+
+
+def test_caught_up_feed_is_empty_without_writes(client, expenses, monkeypatch):
+    # Poll once the writes are older than the overlap
+    later = datetime.now() + timedelta(minutes=1)
+    monkeypatch.setattr(main, "now_ms", lambda: later)
+    feed = client.get("/expenses/changes", params=USER).json()
+    assert len(feed["changes"]) == len(EXPENSES)
+    for _ in range(2):
+        feed = client.get(
+            "/expenses/changes", params={**USER, "since": feed["token"]}
+        ).json()
+        assert (feed["changes"], feed["deleted"], feed["has_more"]) == ([], [], False)
+
+
+def test_change_feed_pages(client, expenses):
+    params = {**USER, "limit": 4}
+    pages = []
+    while True:
+        feed = client.get("/expenses/changes", params=params).json()
+        pages.append(len(feed["changes"]))
+        params["since"] = feed["token"]
+        if not feed["has_more"]:
+            break
+    assert pages == [4, 2]
+
+
+def test_change_feed_rejects_malformed_tokens(client, expenses):
+    # Not base64 JSON, then values of the wrong types
+    wrong_types = base64.urlsafe_b64encode(b'["x", 1]').decode()
+    for token in ("garbage", wrong_types):
+        feed = client.get("/expenses/changes", params={**USER, "since": token})
+        assert feed.status_code == 400
+
+
+def test_list_rejects_malformed_cursors(client, expenses):
+    params = {**USER, "start": "2024-01-01", "limit": 2}
+    for values in (b'["x", 1]', b'[{"$date": 0}, "x"]'):
+        cursor = base64.urlsafe_b64encode(values).decode()
+        response = client.get("/expenses/", params={**params, "cursor": cursor})
+        assert response.status_code == 400
+
+
+def test_export(client, expenses):
+    response = client.get("/expenses/export", params={**USER, "month": 2})
+    assert response.headers["content-type"] == "text/csv; charset=utf-8"
+    rows = list(csv.DictReader(io.StringIO(response.text)))
+    assert [row["amount"] for row in rows] == ["800.0", "30.0", "7.5"]
+    assert rows[0]["date"] == "2024-02-01T00:00:00"
+
+    response = client.get("/expenses/export", params={**USER, "format": "parquet"})
+    table = pq.read_table(pa.BufferReader(response.content))
+    assert table.column("amount").to_pylist() == amounts(expenses)
+
+    response = client.get("/expenses/export", params={**USER, "format": "xlsx"})
+    assert response.status_code == 200
+    assert response.content[:2] == b"PK"
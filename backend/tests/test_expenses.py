@@ -0,0 +1,400 @@
+import asyncio
+import json
+from datetime import datetime
+
+import pytest
+
+import main
+import tenancy
+from conftest import EXPENSES, USER, amounts
+from storage import MongoStorage
+
+
+def test_create_get_update_delete(client):
+    response = client.post("/expenses/", params=USER, json=EXPENSES[1])
+    assert response.status_code == 200
+    created = response.json()
+    assert created["month"] == 1 and created["year"] == 2024
+    assert created["updated_at"] == created["created_date"]
+
+    response = client.get(f"/expenses/{created['id']}", params=USER)
+    assert response.json() == created
+
+    update = {**EXPENSES[1], "amount": 20, "date": "2024-02-05T00:00:00"}
+    response = client.put(f"/expenses/{created['id']}", params=USER, json=update)
+    assert response.status_code == 200
+    assert response.json()["amount"] == 20
+    assert response.json()["month"] == 2
+
+    response = client.delete(f"/expenses/{created['id']}", params=USER)
+    assert response.json() == {"message": "Expense deleted successfully"}
+    assert client.delete(f"/expenses/{created['id']}", params=USER).status_code == 404
+    assert client.get(f"/expenses/{created['id']}", params=USER).status_code == 404
+
+
+def test_invalid_ids_and_collection_names(client):
+    assert client.get("/expenses/nope", params=USER).status_code == 400
+    assert client.delete("/expenses/nope", params=USER).status_code == 400
+    response = client.put("/expenses/nope", params=USER, json=EXPENSES[0])
+    assert response.status_code == 400
+    for name in ("_expense_rollups", "system.users"):
+        response = client.get("/expenses/", params={"collection_name": name})
+        assert response.status_code == 400
+
+
+def test_reads_do_not_create_collections(client, storage):
+    if tenancy.TENANCY == "shared":
+        pytest.skip("the shared collection holds every user")
+    params = {"collection_name": "mistyped"}
+    for path in ("/expenses/", "/expenses/changes", "/expenses/export"):
+        client.get(path, params=params)
+    client.get(f"/expenses/{'0' * 24}", params=params)
+    if isinstance(storage, MongoStorage):
+        names = asyncio.run(storage.db.list_collection_names())
+        assert "mistyped" not in names
+    client.post("/expenses/", params=params, json=EXPENSES[0])
+    if isinstance(storage, MongoStorage):
+        assert "mistyped" in asyncio.run(storage.db.list_collection_names())
+
+
+def test_collections_are_separate(client, expenses):
+    assert client.get("/expenses/", params={"collection_name": "bob"}).json() == []
+    assert len(client.get("/expenses/", params=USER).json()) == len(EXPENSES)
+
+
+def test_users_cannot_reach_each_others_expenses(client, expenses):
+    bob = {"collection_name": "bob"}
+    expense_id = expenses[0]["id"]
+    assert client.get(f"/expenses/{expense_id}", params=bob).status_code == 404
+    response = client.put(f"/expenses/{expense_id}", params=bob, json=EXPENSES[1])
+    assert response.status_code == 404
+    assert client.delete(f"/expenses/{expense_id}", params=bob).status_code == 404
+    update = {"id": expense_id, "data": EXPENSES[1]}
+    response = client.post(
+        "/expenses/bulk/",
+        params=bob,
+        json={"updates": [update], "deletes": [expense_id], "ordered": False},
+    )
+    body = response.json()
+    assert (body["modified_count"], body["deleted_count"]) == (0, 0)
+    assert client.get(f"/expenses/{expense_id}", params=USER).json() == expenses[0]
+    assert client.get("/expenses/summary/", params=bob).json() == []
+
+
+def test_bulk(client, expenses):
+    response = client.post(
+        "/expenses/bulk/",
+        params=USER,
+        json={
+            "creates": [EXPENSES[0]],
+            "updates": [
+                {"id": expenses[1]["id"], "data": {**EXPENSES[1], "amount": 15}},
+                {"id": "nope", "data": EXPENSES[1]},
+            ],
+            "deletes": [expenses[2]["id"], "0" * 24],
+            "ordered": False,
+        },
+    )
+    assert response.status_code == 200
+    body = response.json()
+    assert (body["inserted_count"], body["modified_count"]) == (1, 1)
+    assert body["deleted_count"] == 1
+    assert [(result["op"], result["status"]) for result in body["results"]] == [
+        ("create", "ok"),
+        ("update", "ok"),
+        ("update", "error"),
+        ("delete", "ok"),
+        ("delete", "error"),
+    ]
+    assert body["results"][2]["detail"] == "Invalid expense ID"
+    assert body["results"][4]["detail"] == "Expense not found"
+
+    listed = client.get("/expenses/", params=USER).json()
+    assert sorted(amounts(listed)) == [7.5, 15, 30, 45, 800, 800]
+    summary = client.get("/expenses/summary/", params={**USER, "month": 1}).json()
+    assert [row["total_amount"] for row in summary] == [15, 1600]
+
+
+class Interleaved:
+    """
+    A collection whose bulk_write lets another request write first.
+    """
+
+    def __init__(self, collection, other_request):
+        self.collection = collection
+        self.other_request = other_request
+
+    def __getattr__(self, name):
+        return getattr(self.collection, name)
+
+    async def bulk_write(self, operations, ordered=True):
+        await self.other_request()
+        return await self.collection.bulk_write(operations, ordered=ordered)
+
+
+class CountedReads:
+    """
+    A collection that counts its find_one calls.
+    """
+
+    def __init__(self, collection):
+        self.collection = collection
+        self.reads = 0
+
+    def __getattr__(self, name):
+        return getattr(self.collection, name)
+
+    async def find_one(self, *args, **kwargs):
+        self.reads += 1
+        return await self.collection.find_one(*args, **kwargs)
+
+
+def test_bulk_skips_expenses_written_concurrently(client, expenses, monkeypatch):
+    get_collection = main.get_collection
+
+    async def other_request():
+        monkeypatch.setattr(main, "get_collection", get_collection)
+        update = main.Expense(**{**EXPENSES[0], "amount": 900})
+        await main.update_expense(expenses[0]["id"], update, "alice")
+        await main.delete_expense(expenses[2]["id"], "alice")
+
+    async def interleaved_collection(collection_name, provision=False):
+        collection = await get_collection(collection_name, provision)
+        return Interleaved(collection, other_request)
+
+    monkeypatch.setattr(main, "get_collection", interleaved_collection)
+    response = client.post(
+        "/expenses/bulk/",
+        params=USER,
+        json={
+            "updates": [{"id": expenses[0]["id"], "data": EXPENSES[0]}],
+            "deletes": [expenses[2]["id"], expenses[3]["id"]],
+            "ordered": False,
+        },
+    )
+    body = response.json()
+    assert [(result["status"], result["detail"]) for result in body["results"]] == [
+        ("error", "Expense was modified"),
+        ("error", "Expense not found"),
+        ("ok", None),
+    ]
+    assert (body["modified_count"], body["deleted_count"]) == (0, 1)
+    summary = client.get("/expenses/summary/", params=USER).json()
+    assert [row["total_amount"] for row in summary] == [12.5, 900, 7.5, 45]
+
+
+def test_bulk_rebuilds_the_rollup_when_deletes_race(client, expenses, monkeypatch):
+    get_collection = main.get_collection
+
+    async def other_request():
+        # Deleted without a tombstone, as by a script
+        collection = await get_collection("alice")
+        await collection.delete_many({"category": "fun"})
+
+    async def interleaved_collection(collection_name, provision=False):
+        collection = await get_collection(collection_name, provision)
+        return Interleaved(collection, other_request)
+
+    monkeypatch.setattr(main, "get_collection", interleaved_collection)
+    response = client.post(
+        "/expenses/bulk/",
+        params=USER,
+        json={"deletes": [expenses[3]["id"], expenses[4]["id"]]},
+    )
+    assert response.json()["deleted_count"] == 1
+    summary = client.get("/expenses/summary/", params=USER).json()
+    assert [row["total_amount"] for row in summary] == [12.5, 800, 800]
+
+
+def test_bulk_ordered_stops_at_the_first_error(client, expenses):
+    response = client.post(
+        "/expenses/bulk/",
+        params=USER,
+        json={
+            "updates": [{"id": "nope", "data": EXPENSES[1]}],
+            "deletes": [expenses[0]["id"]],
+        },
+    )
+    body = response.json()
+    assert [result["status"] for result in body["results"]] == ["error", "skipped"]
+    assert body["deleted_count"] == 0
+    assert len(client.get("/expenses/", params=USER).json()) == len(EXPENSES)
+
+
+def test_list_filters(client, expenses):
+    params = {**USER, "start": "2024-01-05", "end": "2024-03-01", "min_amount": 10}
+    assert amounts(client.get("/expenses/", params=params).json()) == [12.5, 800, 30]
+    params = {**USER, "category": "food", "max_amount": 10}
+    assert amounts(client.get("/expenses/", params=params).json()) == [7.5]
+    params = {**USER, "month": 2, "year": 2024}
+    listed = client.get("/month_year/", params=params).json()
+    assert [expense["category"] for expense in listed] == ["food", "fun", "rent"]
+    listed = client.get("/expenses/ls_month_year/", params=params).json()
+    assert amounts(listed) == [800, 30, 7.5]
+
+
+def test_list_keyset_pages(client, expenses):
+    params = {**USER, "start": "2024-01-01", "limit": 4}
+    pages = []
+    while True:
+        response = client.get("/expenses/", params=params)
+        pages.append(amounts(response.json()))
+        if "x-next-cursor" not in response.headers:
+            break
+        params["cursor"] = response.headers["x-next-cursor"]
+    assert pages == [[800, 12.5, 800, 30], [7.5, 45]]
+
+
+def test_list_stream_and_fast(client, expenses):
+    listed = client.get("/expenses/", params=USER).json()
+    response = client.get("/expenses/", params={**USER, "stream": True})
+    assert response.headers["content-type"] == "application/x-ndjson"
+    streamed = [json.loads(line) for line in response.text.splitlines()]
+    assert streamed == listed
+    response = client.get("/expenses/", params={**USER, "fast": True})
+    assert response.json() == listed
+
+
+def test_not_modified(client, expenses):
+    response = client.get("/expenses/", params=USER)
+    etag = response.headers["etag"]
+    headers = {"If-None-Match": etag}
+    assert client.get("/expenses/", params=USER, headers=headers).status_code == 304
+    client.post("/expenses/", params=USER, json=EXPENSES[0])
+    assert client.get("/expenses/", params=USER, headers=headers).status_code == 200
+
+
+def test_not_modified_any_needs_an_existing_expense(client, expenses):
+    headers = {"If-None-Match": "*"}
+    path = f"/expenses/{expenses[0]['id']}"
+    assert client.get(path, params=USER, headers=headers).status_code == 304
+    path = f"/expenses/{'0' * 24}"
+    assert client.get(path, params=USER, headers=headers).status_code == 404
+
+
+def test_not_modified_expense_is_not_read(client, expenses, monkeypatch):
+    path = f"/expenses/{expenses[0]['id']}"
+    headers = {"If-None-Match": client.get(path, params=USER).headers["etag"]}
+    get_collection = main.get_collection
+    collections = []
+
+    async def counted_collection(collection_name, provision=False):
+        collections.append(CountedReads(await get_collection(collection_name)))
+        return collections[-1]
+
+    monkeypatch.setattr(main, "get_collection", counted_collection)
+    assert client.get(path, params=USER, headers=headers).status_code == 304
+    assert collections[0].reads == 0
+
+
+def test_import_csv(client):
+    upload = (
+        "date,amount,category,description\n"
+        "2024-04-01,12.5,food,market\n"
+        "not a date,1,food,broken\n"
+        "2024-04-02,8,,bus\n"
+    )
+    response = client.post("/expenses/import/", params=USER, content=upload)
+    summary = json.loads(response.text.splitlines()[-1])
+    assert summary["inserted"] == 2
+    assert [error["row"] for error in summary["errors"]] == [3]
+    listed = client.get("/expenses/", params=USER).json()
+    assert [expense["category"] for expense in listed] == ["food", "Uncategorized"]
+
+
+def test_import_reports_undecodable_lines(client):
+    upload = (
+        "date,amount,category,description\n"
+        "2024-04-01,12.5,food,market\n"
+        "2024-04-02,8,food,caf\xe9\n"
+    ).encode("cp1252")
+    response = client.post("/expenses/import/", params=USER, content=upload)
+    summary = json.loads(response.text.splitlines()[-1])
+    assert summary["done"] and summary["inserted"] == 1
+    assert [error["row"] for error in summary["errors"]] == [3]
+    assert "0xe9 is not valid utf-8-sig" in summary["errors"][0]["detail"]
+
+    params = {**USER, "encoding": "cp1252"}
+    response = client.post("/expenses/import/", params=params, content=upload)
+    assert json.loads(response.text.splitlines()[-1])["inserted"] == 2
+    listed = client.get("/expenses/", params=USER).json()
+    assert listed[-1]["description"] == "caf\xe9"
+
+    params = {**USER, "encoding": "nope"}
+    response = client.post("/expenses/import/", params=params, content=upload)
+    assert response.status_code == 400
+
+
+def test_import_reports_unparsable_csv(client):
+    # Longer than the csv module's field size limit
+    description = "x" * 200_000
+    upload = (
+        "date,amount,description\n"
+        "2024-04-01,12.5,ok\n"
+        f"2024-04-02,8,{description}\n"
+    )
+    response = client.post("/expenses/import/", params=USER, content=upload)
+    summary = json.loads(response.text.splitlines()[-1])
+    assert summary["inserted"] == 1
+    assert summary["errors"][0]["row"] == 3
+    assert summary["errors"][0]["detail"].startswith("invalid CSV")
+
+
+def test_dates_are_filed_in_utc(client):
+    expense = {**EXPENSES[1], "date": "2024-01-31T23:00:00-05:00"}
+    created = client.post("/expenses/", params=USER, json=expense).json()
+    assert created["date"] == "2024-02-01T04:00:00"
+    assert (created["month"], created["year"]) == (2, 2024)
+    params = {**USER, "start": "2024-02-01", "end": "2024-03-01"}
+    assert len(client.get("/expenses/", params=params).json()) == 1
+    summary = client.get("/expenses/summary/", params=USER).json()
+    assert [row["month"] for row in summary] == [2]
+
+
+def test_import_ofx_skips_credits(client):
+    upload = (
+        "OFXHEADER:100\n<OFX><BANKTRANLIST>"
+        "<STMTTRN><TRNTYPE>DEBIT<DTPOSTED>20240401<TRNAMT>-12.50<NAME>Market"
+        "</STMTTRN>"
+        "<STMTTRN><TRNTYPE>CREDIT<DTPOSTED>20240402<TRNAMT>2000.00<NAME>Salary"
+        "</STMTTRN>"
+        "</BANKTRANLIST></OFX>"
+    )
+    params = {**USER, "format": "ofx"}
+    response = client.post("/expenses/import/", params=params, content=upload)
+    summary = json.loads(response.text.splitlines()[-1])
+    assert (summary["inserted"], summary["skipped"]) == (1, 1)
+    assert (summary["failed"], summary["errors"]) == (0, [])
+    listed = client.get("/expenses/", params=USER).json()
+    assert [(e["amount"], e["description"]) for e in listed] == [(12.5, "Market")]
+
+
+def test_responses_return_month_and_year_as_stored(client, storage):
+    # Written before the server derived month and year from date
+    legacy = {
+        "amount": 5.0,
+        "date": datetime(2024, 3, 10),
+        "month": 2,
+        "year": 2024,
+        "category": "food",
+        "created_date": datetime(2024, 3, 10),
+        "updated_at": datetime(2024, 3, 10),
+    }
+    collection = asyncio.run(storage.expenses("alice", provision=True))
+    asyncio.run(collection.insert_one(legacy))
+    for params in (USER, {**USER, "fast": True}):
+        (expense,) = client.get("/expenses/", params=params).json()
+        assert (expense["month"], expense["date"]) == (2, "2024-03-10T00:00:00")
+
+
+def test_responses_match_the_stored_date(client):
+    expense = {**EXPENSES[1], "date": "2024-01-05T10:30:00.123456"}
+    created = client.post("/expenses/", params=USER, json=expense).json()
+    assert created["date"] == "2024-01-05T10:30:00.123000"
+    assert client.get(f"/expenses/{created['id']}", params=USER).json() == created
+    response = client.post(
+        "/expenses/bulk/",
+        params=USER,
+        json={"updates": [{"id": created["id"], "data": expense}]},
+    )
+    assert response.json()["results"][0]["status"] == "ok"
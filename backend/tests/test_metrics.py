@@ -0,0 +1,12 @@
+from conftest import USER
+
+
+def test_collection_latency_skips_rejected_requests(client):
+    client.get("/expenses/", params=USER)
+    client.get("/expenses/", params={"collection_name": "_rejected"})
+    client.get("/expenses/nope", params={"collection_name": "carol"})
+    metrics = client.get("/metrics").text
+    series = 'http_collection_request_duration_seconds_count{collection="alice"}'
+    assert series in metrics
+    assert 'collection="_rejected"' not in metrics
+    assert 'collection="carol"' not in metrics
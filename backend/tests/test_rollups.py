@@ -0,0 +1,89 @@
+import asyncio
+from datetime import datetime
+
+import pytest
+
+import rollups
+from conftest import USER
+from rollups import ROLLUP_COLLECTION, apply_rollup, rebuild_rollups
+from storage import MongoStorage
+
+LATE_EXPENSE = {
+    "amount": 20.0,
+    "date": datetime(2024, 4, 1),
+    "month": 4,
+    "year": 2024,
+    "category": "food",
+    "created_date": datetime(2024, 4, 1),
+    "updated_at": datetime(2024, 4, 1),
+}
+
+
+@pytest.fixture
+def mongo(storage):
+    if not isinstance(storage, MongoStorage):
+        pytest.skip("only MongoDB keeps a rollup")
+    return storage
+
+
+def totals(client):
+    summary = client.get("/expenses/summary/", params=USER).json()
+    return [(row["month"], row["category"], row["total_amount"]) for row in summary]
+
+
+def test_rebuild_repairs_drift(client, mongo, expenses):
+    expected = totals(client)
+    rollup = mongo.db[ROLLUP_COLLECTION]
+
+    async def drift():
+        await rollup.update_one(
+            {"collection": "alice", "month": 1, "category": "rent"},
+            {"$inc": {"total_amount": 5}},
+        )
+        # A key without expenses
+        await rollup.insert_one(
+            {
+                "collection": "alice",
+                "year": 2023,
+                "month": 12,
+                "category": "gifts",
+                "total_amount": 50,
+                "count": 1,
+            }
+        )
+
+    asyncio.run(drift())
+    assert asyncio.run(rebuild_rollups(mongo.db, "alice")) == len(expected)
+    assert totals(client) == expected
+    assert asyncio.run(rollup.count_documents({"collection": "alice"})) == 6
+
+
+def test_rebuild_keeps_writes_made_while_it_runs(client, mongo, expenses, monkeypatch):
+    expense_collection = rollups.expense_collection
+
+    class RacingCursor:
+        def __init__(self, cursor, collection):
+            self.cursor = cursor
+            self.collection = collection
+
+        async def to_list(self, length=None):
+            groups = await self.cursor.to_list(length)
+            # Written by the API once the aggregation has read the expenses
+            await self.collection.insert_one(dict(LATE_EXPENSE))
+            await apply_rollup(mongo.db, "alice", added=[LATE_EXPENSE])
+            return groups
+
+    class RacingCollection:
+        def __init__(self, collection):
+            self.collection = collection
+
+        def aggregate(self, pipeline):
+            return RacingCursor(self.collection.aggregate(pipeline), self.collection)
+
+    monkeypatch.setattr(
+        rollups,
+        "expense_collection",
+        lambda db, name: RacingCollection(expense_collection(db, name)),
+    )
+    asyncio.run(rebuild_rollups(mongo.db, "alice"))
+    assert (4, "food", 20) in totals(client)
@@ -0,0 +1,106 @@
+import pyarrow as pa
+import pytest
+
+from conftest import EXPENSES, USER
+from storage import MongoStorage
+
+SUMMARY = [
+    {"year": 2024, "month": 1, "category": "food", "total_amount": 12.5},
+    {"year": 2024, "month": 1, "category": "rent", "total_amount": 800},
+    {"year": 2024, "month": 2, "category": "food", "total_amount": 7.5},
+    {"year": 2024, "month": 2, "category": "fun", "total_amount": 30},
+    {"year": 2024, "month": 2, "category": "rent", "total_amount": 800},
+    {"year": 2024, "month": 3, "category": "fun", "total_amount": 45},
+]
+MONTHS = [
+    {"year": 2024, "month": 1, "total_amount": 812.5},
+    {"year": 2024, "month": 2, "total_amount": 837.5},
+    {"year": 2024, "month": 3, "total_amount": 45},
+]
+
+
+def mongomock_lacks(storage, feature: str):
+    if isinstance(storage, MongoStorage):
+        pytest.skip(f"mongomock does not implement {feature}")
+
+
+def test_summary(client, expenses):
+    assert client.get("/expenses/summary/", params=USER).json() == SUMMARY
+    response = client.get("/expenses/summary/", params={**USER, "month": 2})
+    assert response.json() == SUMMARY[2:5]
+    response = client.get("/expenses/summary/", params={**USER, "year": 2023})
+    assert response.json() == []
+
+
+def test_summary_follows_writes(client, expenses):
+    client.delete(f"/expenses/{expenses[1]['id']}", params=USER)
+    update = {**EXPENSES[3], "category": "food"}
+    client.put(f"/expenses/{expenses[3]['id']}", params=USER, json=update)
+    response = client.get("/expenses/summary/", params={**USER, "month": 2})
+    assert response.json() == [
+        {"year": 2024, "month": 2, "category": "food", "total_amount": 37.5},
+        {"year": 2024, "month": 2, "category": "rent", "total_amount": 800},
+    ]
+    response = client.get("/expenses/summary/", params={**USER, "month": 1})
+    assert response.json() == [SUMMARY[1]]
+
+
+def test_summary_periods_and_months(client, expenses):
+    response = client.get("/expenses/summary/periods/", params=USER)
+    assert response.json() == {"categories": SUMMARY, "months": MONTHS}
+    response = client.get("/month/year", params=USER)
+    assert response.json() == [
+        {"year": 2024, "month": month} for month in (1, 2, 3)
+    ]
+
+
+def test_pivot(client, expenses):
+    pivot = {
+        "year": [2024, 2024, 2024],
+        "month": [1, 2, 3],
+        "time": ["1-2024", "2-2024", "3-2024"],
+        "food": [12.5, 7.5, None],
+        "fun": [None, 30, 45],
+        "rent": [800, 800, None],
+        "total": [812.5, 837.5, 45],
+    }
+    assert client.get("/expenses/summary/pivot/", params=USER).json() == pivot
+    params = {**USER, "format": "arrow"}
+    response = client.get("/expenses/summary/pivot/", params=params)
+    assert pa.ipc.open_stream(response.content).read_all().to_pydict() == pivot
+
+
+def test_empty_summaries(client):
+    assert client.get("/expenses/summary/", params=USER).json() == []
+    response = client.get("/expenses/summary/periods/", params=USER)
+    assert response.json() == {"categories": [], "months": []}
+    assert client.get("/month/year", params=USER).json() == []
+
+
+def test_analytics(client, storage, expenses):
+    mongomock_lacks(storage, "$setWindowFields")
+    analytics = client.get("/expenses/analytics", params={**USER, "top": 2}).json()
+    assert [month["total"] for month in analytics["monthly"]] == [812.5, 837.5, 45]
+    assert analytics["monthly"][1]["month_over_month"] == pytest.approx(25 / 812.5)
+    assert analytics["monthly"][0]["month_over_month"] is None
+    fun = [row for row in analytics["categories"] if row["category"] == "fun"]
+    assert [row["moving_average_3m"] for row in fun] == [10, 25]
+    assert analytics["top_categories"] == [
+        {"category": "rent", "total": 1600, "count": 2},
+        {"category": "fun", "total": 75, "count": 2},
+    ]
+
+
+def test_search(client, storage, expenses):
+    mongomock_lacks(storage, "$text")
+
+    def search(q, **params):
+        response = client.get("/expenses/search", params={**USER, "q": q, **params})
+        return [expense["description"] for expense in response.json()]
+
+    assert sorted(search("grocery")) == ["groceries at the market", "grocery run"]
+    assert search("rent -February") == ["January rent"]
+    assert search('"cinema tickets"') == ["cinema tickets"]
+    assert search("rent", start="2024-02-01") == ["February rent"]
+    response = client.get("/expenses/search", params={**USER, "q": "rent", "limit": 1})
+    assert response.headers["x-next-offset"] == "1"
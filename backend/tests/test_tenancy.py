@@ -0,0 +1,37 @@
+import asyncio
+
+import pytest
+
+import tenancy
+from conftest import EXPENSES, USER, amounts
+from storage import MongoStorage
+from tenancy import SHARED_COLLECTION, TENANT_FIELD, migrate_collection
+
+
+@pytest.fixture
+def mongo(storage):
+    if not isinstance(storage, MongoStorage) or tenancy.TENANCY == "shared":
+        pytest.skip("migrates per-user MongoDB collections")
+    return storage
+
+
+def test_migrate_collection(client, mongo, expenses, monkeypatch):
+    db = mongo.db
+    bob = {"collection_name": "bob"}
+    client.post("/expenses/", params=bob, json=EXPENSES[0])
+
+    assert asyncio.run(migrate_collection(db, "alice")) == len(EXPENSES)
+    # Run again after an interruption: the copies are not made twice
+    assert asyncio.run(migrate_collection(db, "alice", drop=True)) == len(EXPENSES)
+    assert asyncio.run(migrate_collection(db, "bob")) == 1
+    names = asyncio.run(db.list_collection_names())
+    assert "alice" not in names and "bob" in names
+    tenants = asyncio.run(db[SHARED_COLLECTION].distinct(TENANT_FIELD))
+    assert sorted(tenants) == ["alice", "bob"]
+
+    monkeypatch.setattr(tenancy, "TENANCY", "shared")
+    listed = client.get("/expenses/", params=USER).json()
+    assert [expense["id"] for expense in listed] == [
+        expense["id"] for expense in expenses
+    ]
+    assert amounts(client.get("/expenses/", params=bob).json()) == [800]
@@ -0,0 +1,34 @@
+VERSION_COLLECTION = "_expense_versions"
+
+
+async def get_version(db, collection_name: str):
+    """
+    The number of writes made to a collection, 0 if it was never written.
+    """
+    document = await db[VERSION_COLLECTION].find_one({"_id": collection_name})
+    return document["version"] if document else 0
+
+
+async def bump_version(db, collection_name: str):
+    await db[VERSION_COLLECTION].update_one(
+        {"_id": collection_name}, {"$inc": {"version": 1}}, upsert=True
+    )
+
+
+def make_etag(version: int):
+    # The collection is already part of the URL the validator belongs to
+    return f'"v{version}"'
+
+
+def etag_matches(if_none_match: str, etag: str):
+    """
+    Whether an If-None-Match header value covers the given ETag.
+    """
+    if not if_none_match:
+        return False
+    candidates = [value.strip() for value in if_none_match.split(",")]
+    # Weak comparison: W/"x" and "x" name the same version
+    candidates = [
+        value[2:] if value.startswith("W/") else value for value in candidates
+    ]
+    return "*" in candidates or etag in candidates
@@ -1,23 +1,23 @@
 import streamlit_authenticator as stauth
-import yaml
-from yaml.loader import SafeLoader
 import datetime
+import json
 import pandas as pd
 import streamlit as st
-import requests
 import plotly.express as px
+import auth
+import client
+import frames
 
-with open("config.yaml") as file:
-    config = yaml.load(file, Loader=SafeLoader)
-
-# Pre-hashing all plain text passwords once
-stauth.Hasher.hash_passwords(config["credentials"])
+# Loaded and hashed once per process, not on every rerun
+store = auth.get_store()
 
 authenticator = stauth.Authenticate(
-    config["credentials"],
-    config["cookie"]["name"],
-    config["cookie"]["key"],
-    config["cookie"]["expiry_days"],
+    store.credentials,
+    store.cookie["name"],
+    store.cookie["key"],
+    store.cookie["expiry_days"],
+    # The passwords are hashed already
+    auto_hash=False,
 )
 
 try:
@@ -25,7 +25,6 @@ try:
 except Exception as e:
     st.error(e)
 
-BASE_URL = "http://backend:8000"  # Replace with your FastAPI backend URL
 # st.set_page_config(
 #     page_title="Expenses",
 #     page_icon="🏠",
@@ -90,6 +89,8 @@ if st.session_state["authentication_status"]:
             st.session_state.button_status = "Summary Expenses"
         if st.button("Detail Expenses", use_container_width=True, type="primary"):
             st.session_state.button_status = "Detail Expenses"
+        if st.button("Search Expenses", use_container_width=True, type="primary"):
+            st.session_state.button_status = "Search Expenses"
         if st.button("Update Expense", use_container_width=True, type="secondary"):
             st.session_state.button_status = "Update Expense"
         if st.button("Delete Expense", use_container_width=True, type="secondary"):
@@ -102,29 +103,57 @@ if st.session_state["authentication_status"]:
         params = {}
         if st.session_state.username is not None:
             params["collection_name"] = st.session_state.username
-            response = requests.post(
-                f"{BASE_URL}/expenses/", json=expense_data, params=params,
+            response = client.request(
+                "POST", "/expenses/", json=expense_data, params=params,
             )
             if response.status_code == 200:
+                client.invalidate(st.session_state.username)
                 return response
         st.error("Failed to fetch expenses.")
         return []
 
-    def fetch_expenses():
+    def import_expenses(uploaded_file, encoding):
         params = {}
         if st.session_state.username is not None:
             params["collection_name"] = st.session_state.username
-            response = requests.get(f"{BASE_URL}/expenses/", params=params)
+            is_ofx = uploaded_file.name.lower().endswith(".ofx")
+            params["format"] = "ofx" if is_ofx else "csv"
+            params["encoding"] = encoding
+            response = client.request(
+                "POST",
+                "/expenses/import/",
+                data=uploaded_file,
+                params=params,
+                stream=True,
+            )
             if response.status_code == 200:
-                return response.json()
+                status = st.empty()
+                progress = {}
+                for line in response.iter_lines():
+                    if line:
+                        progress = json.loads(line)
+                        status.text(
+                            f"Processed {progress['processed']:,} rows, "
+                            f"imported {progress['inserted']:,}"
+                        )
+                client.invalidate(st.session_state.username)
+                return progress
+        st.error("Failed to import expenses.")
+        return {}
+
+    def fetch_expenses():
+        if st.session_state.username is not None:
+            synced = client.synced_expenses(st.session_state.username)
+            if synced is not None:
+                return synced
         st.error("Failed to fetch expenses.")
-        return []
+        return [], None
 
     def fetch_expenses_by_id(expense_id):
         params = {}
         if st.session_state.username is not None:
             params["collection_name"] = st.session_state.username
-            response = requests.get(f"{BASE_URL}/expenses/{expense_id}", params=params)
+            response = client.request("GET", f"/expenses/{expense_id}", params=params)
             if response.status_code == 200:
                 return response
         st.error("Failed to fetch expenses.")
@@ -134,10 +163,11 @@ if st.session_state["authentication_status"]:
         params = {}
         if st.session_state.username is not None:
             params["collection_name"] = st.session_state.username
-            response = requests.put(
-                f"{BASE_URL}/expenses/{expense_id}", json=update_json, params=params
+            response = client.request(
+                "PUT", f"/expenses/{expense_id}", json=update_json, params=params
             )
             if response.status_code == 200:
+                client.invalidate(st.session_state.username)
                 return response
         st.error("Failed to fetch expenses.")
         return []
@@ -146,49 +176,71 @@ if st.session_state["authentication_status"]:
         params = {}
         if st.session_state.username is not None:
             params["collection_name"] = st.session_state.username
-            response = requests.delete(
-                f"{BASE_URL}/expenses/{expense_id}", params=params
+            response = client.request(
+                "DELETE", f"/expenses/{expense_id}", params=params
             )
             if response.status_code == 200:
+                client.invalidate(st.session_state.username)
                 st.success(response.json()["message"])
             else:
                 st.error(response.json()["detail"])
 
     def fetch_expense_summary(month=None, year=None):
-        params = {}
-        if month:
-            params["month"] = month
-        if year:
-            params["year"] = year
         if st.session_state.username is not None:
-            params["collection_name"] = st.session_state.username
-        response = requests.get(f"{BASE_URL}/expenses/summary/", params=params)
-        if response.status_code == 200:
-            return response.json()
+            summary = client.get_json(
+                "/expenses/summary/",
+                st.session_state.username,
+                {"month": month, "year": year},
+            )
+            if summary is not None:
+                return summary
         st.error("Failed to fetch summary.")
         return []
 
+    def fetch_expense_pivot():
+        if st.session_state.username is not None:
+            content = client.get_content(
+                "/expenses/summary/pivot/",
+                st.session_state.username,
+                {"format": "arrow"},
+            )
+            if content is not None:
+                key = client.data_key(
+                    "/expenses/summary/pivot/",
+                    st.session_state.username,
+                    {"format": "arrow"},
+                )
+                return frames.arrow_pivot(content, key)
+            st.error("Failed to fetch summary.")
+            return None
+
     def fetch_expense_by_month_and_year(month=None, year=None):
-        params = {}
-        if month:
-            params["month"] = month
-        if year:
-            params["year"] = year
         if st.session_state.username is not None:
-            params["collection_name"] = st.session_state.username
-        response = requests.get(f"{BASE_URL}/expenses/ls_month_year/", params=params)
-        if response.status_code == 200:
-            return response.json()
+            expenses = client.get_json(
+                "/expenses/ls_month_year/",
+                st.session_state.username,
+                {"month": month, "year": year, "fast": True},
+            )
+            if expenses is not None:
+                return expenses
         st.error("Failed to fetch summary.")
         return []
 
+    def search_expenses(params):
+        if st.session_state.username is not None:
+            expenses = client.get_json(
+                "/expenses/search", st.session_state.username, params
+            )
+            if expenses is not None:
+                return expenses
+        st.error("Failed to search expenses.")
+        return []
+
     def get_month_and_year():
-        params = {}
         if st.session_state.username is not None:
-            params["collection_name"] = st.session_state.username
-            response = requests.get(f"{BASE_URL}/month/year/", params=params)
-            if response.status_code == 200:
-                return response.json()
+            month_and_year = client.get_json("/month/year", st.session_state.username)
+            if month_and_year is not None:
+                return month_and_year
             st.error("Failed to fetch summary.")
             return []
 
@@ -198,8 +250,6 @@ if st.session_state["authentication_status"]:
         with st.form("create_expense_form"):
             amount = st.number_input("Amount", min_value=0.0, step=0.01)
             date = st.date_input("Date")
-            month = date.month
-            year = date.year
             category = st.selectbox(
                 "Categories", ("Bill", "Shopping", "Food & Drink"), index=None
             )
@@ -210,8 +260,6 @@ if st.session_state["authentication_status"]:
                 expense_data = {
                     "amount": amount,
                     "date": str(date),
-                    "month": month,
-                    "year": year,
                     "category": category,
                     "description": description,
                 }
@@ -221,58 +269,37 @@ if st.session_state["authentication_status"]:
                 else:
                     st.error(response.json().get("detail", "Failed to create expense"))
 
-    elif st.session_state.button_status == "Summary Expenses":
-        st.header("Expense Summary")
-
-        all_month_and_year = get_month_and_year()
-        if all_month_and_year is not None:
-            summary_current = []
-            if len(all_month_and_year) != 0:
-                for item in all_month_and_year:
-                    summary_current.append(
-                        fetch_expense_summary(item.get("month"), item.get("year"))
-                    )
-                list_expense = []
-                for item in summary_current:
-                    for each in item:
-                        list_expense.append(each)
-
-                df = pd.DataFrame(list_expense)
-                grouped_df = (
-                    df.groupby(["month", "year"])
-                    .agg(
-                        total_amount=("total_amount", "sum"),
-                        category=("category", "sum"),
+        st.markdown("#")
+        st.subheader("Import a Bank Statement")
+        uploaded_file = st.file_uploader("CSV or OFX file", type=["csv", "ofx"])
+        # Bank exports that are not UTF-8 are usually Windows-1252
+        encoding = st.selectbox("CSV encoding", ["utf-8-sig", "cp1252", "latin-1"])
+        if uploaded_file is not None and st.button("Import"):
+            result = import_expenses(uploaded_file, encoding)
+            if result.get("done"):
+                st.success(f"Imported {result['inserted']:,} expenses.")
+                if result.get("skipped"):
+                    st.info(f"Skipped {result['skipped']:,} credits.")
+                if result["failed"]:
+                    st.warning(f"{result['failed']:,} rows could not be imported.")
+                    st.dataframe(
+                        pd.DataFrame(result["errors"]),
+                        hide_index=True,
+                        use_container_width=True,
                     )
-                    .reset_index()
-                )
-                grouped_df["total_amount"] = grouped_df["total_amount"].apply(
-                    lambda x: f"{x:,.0f}"
-                )
 
-                df["time"] = df["month"].astype(str) + "-" + df["year"].astype(str)
-                df = df.drop(columns=["month", "year"])
-                df["total_amount"] = df["total_amount"].apply(lambda x: f"{x:,.0f}")
-                df = df[["time", "category", "total_amount"]]
-                pivot_df = df.pivot(
-                    index="time", columns="category", values="total_amount"
-                ).reset_index()
-                pivot_df["total"] = grouped_df["total_amount"]
-                pivot_df = pivot_df.sort_values(by=["time"], ascending=False)
-
-                columns_to_clean = pivot_df.columns.to_list()[1:]
-                for col in columns_to_clean:
-                    pivot_df[col] = (
-                        pivot_df[col].replace(",", "", regex=True).astype(float)
-                    )
+    elif st.session_state.button_status == "Summary Expenses":
+        st.header("Expense Summary")
 
-                # Reshape the DataFrame into long format
-                df_long = pivot_df.melt(
-                    id_vars=["time"],
-                    value_vars=pivot_df.columns.to_list()[1:-1],
-                    var_name="Category",
-                    value_name="Value",
+        pivot_df = fetch_expense_pivot()
+        if pivot_df is not None:
+            if len(pivot_df) != 0:
+                key = client.data_key(
+                    "/expenses/summary/pivot/",
+                    st.session_state.username,
+                    {"format": "arrow"},
                 )
+                df_long = frames.category_long(pivot_df, key)
 
                 # Create the bar chart
                 fig = px.bar(
@@ -288,11 +315,11 @@ if st.session_state["authentication_status"]:
                     },
                 )
 
-                # Select the first row
+                # Select the latest month
                 first_row = pivot_df.iloc[0]
 
                 # Calculate the percentages of each category relative to the total
-                categories = pivot_df.columns.to_list()[1:-1]
+                categories = frames.category_columns(pivot_df)
                 values = first_row[categories].fillna(0).values
                 labels = categories
 
@@ -307,7 +334,11 @@ if st.session_state["authentication_status"]:
                 st.plotly_chart(fig_pie, use_container_width=True)
                 st.plotly_chart(fig, use_container_width=True)
                 st.write("Total expense by categories")
-                st.dataframe(pivot_df, hide_index=True, use_container_width=True)
+                st.dataframe(
+                    frames.style_amounts(pivot_df),
+                    hide_index=True,
+                    use_container_width=True,
+                )
 
     elif st.session_state.button_status == "Detail Expenses":
         st.header("Detail Expenses")
@@ -317,59 +348,87 @@ if st.session_state["authentication_status"]:
             "Year", min_value=2000, max_value=2100, step=1, value=None
         )
         if st.button("Fetch Month Expense"):
+            username = st.session_state.username
             summary = fetch_expense_summary(month, year)
-            df = pd.DataFrame(summary)
-
             list_month_and_year = fetch_expense_by_month_and_year(month, year)
-            df_detail = pd.DataFrame(list_month_and_year)
 
-            grouped_df = (
-                df.groupby(["month", "year"])
-                .agg(
-                    total_amount=("total_amount", "sum"),
-                    category=("category", "sum"),  # Concatenate categories
+            if len(summary) != 0:
+                st.write("Total expense by categories")
+                key = client.data_key(
+                    "/expenses/summary/", username, {"month": month, "year": year}
+                )
+                pivot_df = frames.category_pivot(summary, key)
+                st.dataframe(
+                    frames.style_amounts(pivot_df),
+                    hide_index=True,
+                    use_container_width=True,
                 )
-                .reset_index()
-            )
-            grouped_df["total_amount"] = grouped_df["total_amount"].apply(
-                lambda x: f"{x:,.0f}"
-            )
 
-            st.write("Total expense by categories")
-            df["time"] = df["month"].astype(str) + "-" + df["year"].astype(str)
-            df = df.drop(columns=["month", "year"])
-            df["total_amount"] = df["total_amount"].apply(lambda x: f"{x:,.0f}")
-            df = df[["time", "category", "total_amount"]]
-            pivot_df = df.pivot(
-                index="time", columns="category", values="total_amount"
-            ).reset_index()
-            pivot_df["total"] = grouped_df["total_amount"]
-            st.dataframe(pivot_df, hide_index=True, use_container_width=True)
-
-            st.write("Detail expense")
-            df_detail = df_detail.drop(columns=["created_date", "month", "year"])
-            df_detail = df_detail.sort_values(by="date", ascending=False)
-            df_detail["date"] = pd.to_datetime(
-                df_detail["date"], format="mixed"
-            ).dt.strftime("%d-%m-%Y")
-            df_detail["amount"] = df_detail["amount"].apply(lambda x: f"{x:,.0f}")
-            df_detail = df_detail[["date", "amount", "category", "description", "id"]]
-            st.dataframe(df_detail, hide_index=True, use_container_width=True)
+                st.write("Detail expense")
+                key = client.data_key(
+                    "/expenses/ls_month_year/",
+                    username,
+                    {"month": month, "year": year, "fast": True},
+                )
+                df_detail = frames.expense_table(list_month_and_year, key)
+                st.dataframe(
+                    df_detail,
+                    hide_index=True,
+                    use_container_width=True,
+                    column_config=frames.expense_column_config(),
+                )
         st.markdown("#")
 
-        expenses = fetch_expenses()
+        expenses, token = fetch_expenses()
         if len(expenses) > 0:
             st.write("All expenses")
-            df = pd.DataFrame(expenses)
-            df = df.drop(columns=["created_date", "month", "year"])
-            df = df.sort_values(by="date", ascending=False)
-            df["date"] = pd.to_datetime(df["date"], format="mixed").dt.strftime(
-                "%d-%m-%Y"
+            key = ("/expenses/changes", st.session_state.username, token)
+            df = frames.expense_table(expenses, key)
+            st.dataframe(
+                df,
+                hide_index=True,
+                use_container_width=True,
+                column_config=frames.expense_column_config(),
             )
-            df["amount"] = df["amount"].apply(lambda x: f"{x:,.0f}")
-            df = df[["date", "amount", "category", "description", "id"]]
 
-            st.dataframe(df, hide_index=True, use_container_width=True)
+    elif st.session_state.button_status == "Search Expenses":
+        st.header("Search Expenses")
+
+        query = st.text_input("Search descriptions and categories")
+        date_range = st.date_input("Date range", value=[])
+        col1, col2 = st.columns(2)
+        min_amount = col1.number_input("Min amount", min_value=0, value=None)
+        max_amount = col2.number_input("Max amount", min_value=0, value=None)
+        page = st.number_input("Page", min_value=1, step=1, value=1)
+
+        if query:
+            page_size = 50
+            params = {
+                "q": query,
+                "min_amount": min_amount,
+                "max_amount": max_amount,
+                "limit": page_size,
+                "offset": (page - 1) * page_size,
+            }
+            if len(date_range) == 2:
+                # The end date is included, the API end is exclusive
+                params["start"] = date_range[0].isoformat()
+                params["end"] = (date_range[1] + datetime.timedelta(days=1)).isoformat()
+            results = search_expenses(params)
+            if len(results) > 0:
+                key = client.data_key(
+                    "/expenses/search", st.session_state.username, params
+                )
+                st.dataframe(
+                    frames.expense_table(results, key, by_date=False),
+                    hide_index=True,
+                    use_container_width=True,
+                    column_config=frames.expense_column_config(),
+                )
+                if len(results) == page_size:
+                    st.caption("More results on the next page.")
+            else:
+                st.info("No matching expenses.")
 
     elif st.session_state.button_status == "Update Expense":
         st.header("Update an Expense")
@@ -383,8 +442,6 @@ if st.session_state["authentication_status"]:
             # if st.session_state.update_get_resp.status_code == 200:
             expense = st.session_state.update_get_resp.json()
             date = datetime.datetime.fromisoformat(expense["date"])
-            month = expense["month"]
-            year = expense["year"]
             with st.form("john"):
                 amount = st.number_input(
                     "Amount", min_value=0.0, step=0.01, value=expense["amount"]
@@ -401,8 +458,6 @@ if st.session_state["authentication_status"]:
                     updated_data = {
                         "amount": amount,
                         "date": str(date) if date_update == date else str(date_update),
-                        "month": month,
-                        "year": year,
                         "category": category,
                         "description": description,
                     }
@@ -426,5 +481,5 @@ elif st.session_state["authentication_status"] is False:
 elif st.session_state["authentication_status"] is None:
     st.warning("Please enter your username and password")
 
-with open("../../config.yaml", "w") as file:
-    yaml.dump(config, file, default_flow_style=False)
+# Written only when a login or logout changed the credentials
+store.save()
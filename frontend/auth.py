@@ -0,0 +1,66 @@
+import os
+import threading
+
+import streamlit as st
+import streamlit_authenticator as stauth
+import yaml
+from yaml.loader import SafeLoader
+
+# The cookie settings and the users of the login form
+CONFIG_PATH = os.environ.get("AUTH_CONFIG_PATH", "config.yaml")
+
+
+class CredentialStore:
+    """
+    The login config, loaded once per process and shared by every session.
+
+    Plain-text passwords are hashed when the file is loaded, so the login
+    form only checks passwords against hashes. The authenticator updates
+    the credentials in place (logged_in, failed_login_attempts); save()
+    writes them back only when they differ from what is on disk.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.lock = threading.Lock()
+        with open(path) as file:
+            self.config = yaml.load(file, Loader=SafeLoader)
+        self.saved = self.dump()
+        stauth.Hasher.hash_passwords(self.config["credentials"])
+        # Later starts find the passwords already hashed
+        self.save()
+
+    @property
+    def credentials(self):
+        return self.config["credentials"]
+
+    @property
+    def cookie(self):
+        return self.config["cookie"]
+
+    def dump(self):
+        return yaml.dump(self.config, default_flow_style=False)
+
+    def save(self):
+        """
+        Write the config if it changed since it was loaded or last saved.
+
+        Returns:
+            bool: Whether the file was written.
+        """
+        with self.lock:
+            content = self.dump()
+            if content == self.saved:
+                return False
+            # Replaced in one step, a reader never sees half a file
+            temporary = f"{self.path}.tmp"
+            with open(temporary, "w") as file:
+                file.write(content)
+            os.replace(temporary, self.path)
+            self.saved = content
+            return True
+
+
+@st.cache_resource
+def get_store():
+    return CredentialStore(CONFIG_PATH)
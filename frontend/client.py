@@ -0,0 +1,177 @@
+import os
+import threading
+
+import requests
+import streamlit as st
+from cachetools import LRUCache
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+BASE_URL = os.environ.get("API_URL", "http://backend:8000")
+# (connect, read) timeouts in seconds
+TIMEOUT = (3.05, float(os.environ.get("API_READ_TIMEOUT", "30")))
+# How long a cached read is reused before it is revalidated with its ETag
+CACHE_TTL_SECONDS = int(os.environ.get("API_CACHE_TTL_SECONDS", "60"))
+
+
+@st.cache_resource
+def get_session():
+    """
+    One keep-alive session per process, shared by every script rerun.
+    Idempotent GETs are retried on connection errors and gateway errors.
+    """
+    retry = Retry(
+        total=3,
+        backoff_factor=0.2,
+        status_forcelist=(502, 503, 504),
+        allowed_methods=frozenset({"GET"}),
+    )
+    adapter = HTTPAdapter(pool_connections=4, pool_maxsize=16, max_retries=retry)
+    session = requests.Session()
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+def request(method: str, path: str, **kwargs):
+    kwargs.setdefault("timeout", TIMEOUT)
+    return get_session().request(method, f"{BASE_URL}{path}", **kwargs)
+
+
+@st.cache_resource
+def _data_versions():
+    # username -> number of writes made through this process
+    return {}
+
+
+def data_version(username: str):
+    return _data_versions().get(username, 0)
+
+
+def invalidate(username: str):
+    """
+    Drop the cached reads of a user after one of their expenses changed.
+    """
+    _data_versions()[username] = data_version(username) + 1
+
+
+@st.cache_resource
+def _validators():
+    # (path, params) -> (ETag, body) of the last full response
+    return LRUCache(maxsize=512), threading.Lock()
+
+
+def _conditional_get(path: str, params: tuple, decode):
+    validators, lock = _validators()
+    with lock:
+        cached = validators.get((path, params))
+    headers = {"If-None-Match": cached[0]} if cached else {}
+    response = request("GET", path, params=dict(params), headers=headers)
+    if response.status_code == 304 and cached:
+        return cached[1]
+    # Raising keeps failed responses out of the cache
+    response.raise_for_status()
+    body = decode(response)
+    if "ETag" in response.headers:
+        with lock:
+            validators[(path, params)] = (response.headers["ETag"], body)
+    return body
+
+
+# version is only part of the cache keys, a write moves readers to a new one
+@st.cache_data(ttl=CACHE_TTL_SECONDS, max_entries=512, show_spinner=False)
+def _get_json(path: str, params: tuple, version: int):
+    return _conditional_get(path, params, lambda response: response.json())
+
+
+@st.cache_data(ttl=CACHE_TTL_SECONDS, max_entries=64, show_spinner=False)
+def _get_content(path: str, params: tuple, version: int):
+    return _conditional_get(path, params, lambda response: response.content)
+
+
+def _query(username: str, params=None):
+    params = {key: value for key, value in (params or {}).items() if value}
+    params["collection_name"] = username
+    return tuple(sorted(params.items()))
+
+
+def get_json(path: str, username: str, params=None):
+    """
+    Cached GET of a backend route for one user.
+
+    Returns:
+        The decoded JSON body, or None if the request failed.
+    """
+    try:
+        return _get_json(path, _query(username, params), data_version(username))
+    except requests.RequestException:
+        return None
+
+
+def get_content(path: str, username: str, params=None):
+    """
+    Cached GET of a binary backend response, such as an Arrow stream.
+
+    Returns:
+        bytes: The response body, or None if the request failed.
+    """
+    try:
+        return _get_content(path, _query(username, params), data_version(username))
+    except requests.RequestException:
+        return None
+
+
+@st.cache_resource
+def _local_copies():
+    # username -> (change token, {id: expense}) of the last sync
+    return {}, threading.Lock()
+
+
+def synced_expenses(username: str):
+    """
+    All expenses of a user from a local copy, brought up to date with the
+    changes made since the last call.
+
+    Returns:
+        tuple: The expenses and the change token they are current to, or
+        None if the sync failed.
+    """
+    copies, lock = _local_copies()
+    with lock:
+        token, expenses = copies.get(username, (None, {}))
+    try:
+        while True:
+            params = {"collection_name": username}
+            if token:
+                params["since"] = token
+            response = request("GET", "/expenses/changes", params=params)
+            response.raise_for_status()
+            delta = response.json()
+            # A new dict, callers may still hold the previous one
+            expenses = {} if delta["reset"] else dict(expenses)
+            for expense in delta["changes"]:
+                expenses[expense["id"]] = expense
+            for expense_id in delta["deleted"]:
+                expenses.pop(expense_id, None)
+            token = delta["token"]
+            if not delta["has_more"]:
+                break
+    except requests.RequestException:
+        return None
+    with lock:
+        copies[username] = (token, expenses)
+    return list(expenses.values()), token
+
+
+def data_key(path: str, username: str, params=None):
+    """
+    Identify the body get_json or get_content last returned for the same
+    arguments: the query plus its ETag, a cheap cache key for anything
+    derived from it.
+    """
+    query = _query(username, params)
+    validators, lock = _validators()
+    with lock:
+        cached = validators.get((path, query))
+    version = cached[0] if cached else data_version(username)
+    return path, query, version
@@ -0,0 +1,98 @@
+import pandas as pd
+import pyarrow as pa
+import streamlit as st
+
+AMOUNT_FORMAT = "{:,.0f}"
+# The printf-style formats of st.column_config have no thousands separator
+AMOUNT_COLUMN_FORMAT = "%.0f"
+DETAIL_COLUMNS = ["date", "amount", "category", "description", "id"]
+
+# Frames are cached per client.data_key (query and ETag) so a rerun on
+# unchanged data reuses them; the data arguments start with "_" so they are
+# not hashed.
+
+
+@st.cache_data(max_entries=64, show_spinner=False)
+def category_pivot(_summary, key: tuple):
+    """
+    Build the time x category pivot of summary rows, newest month first.
+
+    Args:
+        _summary (list): Rows with month, year, category and total_amount.
+        key (tuple): client.data_key of the response the rows came from.
+
+    Returns:
+        DataFrame: A "time" column, one float column per category and a
+        "total" column.
+    """
+    df = pd.DataFrame(_summary)
+    pivot_df = df.pivot_table(
+        index=["year", "month"],
+        columns="category",
+        values="total_amount",
+        aggfunc="sum",
+    )
+    pivot_df.columns.name = None
+    pivot_df["total"] = pivot_df.sum(axis=1)
+    pivot_df = pivot_df.sort_index(ascending=False).reset_index()
+    time = pivot_df["month"].astype(str) + "-" + pivot_df["year"].astype(str)
+    pivot_df.insert(0, "time", time)
+    return pivot_df.drop(columns=["year", "month"])
+
+
+@st.cache_data(max_entries=64, show_spinner=False)
+def arrow_pivot(_content: bytes, key: tuple):
+    """
+    Load the Arrow pivot of /expenses/summary/pivot/ newest month first,
+    in the same shape category_pivot builds.
+    """
+    pivot_df = pa.ipc.open_stream(_content).read_pandas()
+    pivot_df = pivot_df.iloc[::-1].reset_index(drop=True)
+    return pivot_df.drop(columns=["year", "month"])
+
+
+def category_columns(pivot_df):
+    return pivot_df.columns.to_list()[1:-1]
+
+
+@st.cache_data(max_entries=64, show_spinner=False)
+def category_long(_pivot_df, key: tuple):
+    # Long format of the pivot for grouped bar charts
+    return _pivot_df.melt(
+        id_vars=["time"],
+        value_vars=category_columns(_pivot_df),
+        var_name="Category",
+        value_name="Value",
+    )
+
+
+@st.cache_data(max_entries=64, show_spinner=False)
+def expense_table(_expenses, key: tuple, by_date: bool = True):
+    """
+    Build the expense table, newest first unless by_date is off (search
+    results keep their relevance order), ready to display.
+
+    The date stays a datetime and the amount a float, so both sort by
+    value; expense_column_config formats them for display.
+    """
+    df = pd.DataFrame(_expenses, columns=DETAIL_COLUMNS)
+    df["date"] = pd.to_datetime(df["date"], format="ISO8601")
+    if by_date:
+        df = df.sort_values(by="date", ascending=False, kind="stable")
+    return df
+
+
+def style_amounts(pivot_df):
+    # Display-only formatting, the frame itself keeps its float columns
+    return pivot_df.style.format(
+        AMOUNT_FORMAT, subset=pivot_df.columns[1:], na_rep=""
+    )
+
+
+def expense_column_config():
+    return {
+        "date": st.column_config.DateColumn("date", format="DD-MM-YYYY"),
+        "amount": st.column_config.NumberColumn(
+            "amount", format=AMOUNT_COLUMN_FORMAT
+        ),
+    }